@@ -1,10 +1,10 @@
-import argparse, os, sys, datetime, glob, importlib
+import argparse, os, sys, datetime, glob, importlib, subprocess
 from omegaconf import OmegaConf
 import numpy as np
 from PIL import Image
 import torch
 import torchvision
-from torch.utils.data import random_split, DataLoader, Dataset
+from torch.utils.data import random_split, DataLoader, Dataset, IterableDataset
 import pytorch_lightning as pl
 from pytorch_lightning import seed_everything
 from pytorch_lightning.trainer import Trainer
@@ -132,9 +132,11 @@ class WrappedDataset(Dataset):
 
 class DataModuleFromConfig(pl.LightningDataModule):
     def __init__(self, batch_size, train=None, validation=None, test=None,
-                 wrap=False, num_workers=None):
+                 wrap=False, num_workers=None, pin_memory=False):
         super().__init__()
         self.batch_size = batch_size
+        # page-locked batches for asynchronous host to device copies, e.g. with uint8 datasets
+        self.pin_memory = pin_memory
         self.dataset_configs = dict()
         self.num_workers = num_workers if num_workers is not None else batch_size*2
         if train is not None:
@@ -147,6 +149,8 @@ class DataModuleFromConfig(pl.LightningDataModule):
             self.dataset_configs["test"] = test
             self.test_dataloader = self._test_dataloader
         self.wrap = wrap
+        # position of a streaming train dataset to resume from, see load_state_dict
+        self.resume_state = None
 
     def prepare_data(self):
         for data_cfg in self.dataset_configs.values():
@@ -158,20 +162,53 @@ class DataModuleFromConfig(pl.LightningDataModule):
             for k in self.dataset_configs)
         if self.wrap:
             for k in self.datasets:
-                self.datasets[k] = WrappedDataset(self.datasets[k])
+                if not isinstance(self.datasets[k], IterableDataset):
+                    self.datasets[k] = WrappedDataset(self.datasets[k])
+        self._apply_resume_state()
 
     def _train_dataloader(self):
-        return DataLoader(self.datasets["train"], batch_size=self.batch_size,
-                          num_workers=self.num_workers, shuffle=True, collate_fn=custom_collate, persistent_workers = True if self.num_workers>0 else False)
+        dataset = self.datasets["train"]
+        # streaming datasets shuffle themselves and split their shards over the ranks
+        if hasattr(dataset, "set_distributed") and self.trainer is not None:
+            dataset.set_distributed(self.trainer.global_rank, self.trainer.world_size)
+        return DataLoader(dataset, batch_size=self.batch_size,
+                          num_workers=self.num_workers, shuffle=not isinstance(dataset, IterableDataset),
+                          collate_fn=custom_collate, persistent_workers = True if self.num_workers>0 else False,
+                          pin_memory=self.pin_memory)
 
     def _val_dataloader(self):
         return DataLoader(self.datasets["validation"],
                           batch_size=self.batch_size,
-                          num_workers=self.num_workers, collate_fn=custom_collate, persistent_workers = True if self.num_workers>0 else False)
+                          num_workers=self.num_workers, collate_fn=custom_collate, persistent_workers = True if self.num_workers>0 else False,
+                          pin_memory=self.pin_memory)
 
     def _test_dataloader(self):
         return DataLoader(self.datasets["test"], batch_size=self.batch_size,
-                          num_workers=self.num_workers, collate_fn=custom_collate, persistent_workers = True if self.num_workers>0 else False)
+                          num_workers=self.num_workers, collate_fn=custom_collate, persistent_workers = True if self.num_workers>0 else False,
+                          pin_memory=self.pin_memory)
+
+    def _streaming_train_dataset(self):
+        dataset = getattr(self, "datasets", dict()).get("train")
+        return dataset if hasattr(dataset, "set_position") else None
+
+    def state_dict(self):
+        # saved with the checkpoints, so a streaming train dataset continues mid-epoch on resume
+        if self._streaming_train_dataset() is None or self.trainer is None:
+            return dict()
+        return {"epoch": self.trainer.current_epoch,
+                "batches": self.trainer.fit_loop.epoch_loop.batch_progress.current.processed}
+
+    def load_state_dict(self, state_dict):
+        if state_dict:
+            self.resume_state = dict(state_dict)
+            self._apply_resume_state()
+
+    def _apply_resume_state(self):
+        # also on fresh runs, the dataset splits its examples over the workers in whole batches
+        dataset = self._streaming_train_dataset()
+        if dataset is not None:
+            state = self.resume_state if self.resume_state is not None else {"epoch": 0, "batches": 0}
+            dataset.set_position(state["epoch"], state["batches"], self.batch_size)
 
 
 class SetupCallback(Callback):
@@ -315,6 +352,56 @@ class ImageLogger(Callback):
     #     self.log_img(pl_module, batch, batch_idx, split="val")
 
 
+class AsyncEvaluationCallback(Callback):
+    """
+    Runs sampling and the sample metrics of every written checkpoint in a separate
+    taming.evaluation process on `device`, instead of inline in validation_step.
+    Metrics are written to logdir/evaluation. A checkpoint is skipped while the
+    previous evaluation is still running.
+    """
+    def __init__(self, logdir, config, device="cpu", limit_batches=None, num_workers=0):
+        super().__init__()
+        self.evaldir = os.path.join(logdir, "evaluation")
+        self.config = config
+        self.device = device
+        self.limit_batches = limit_batches
+        self.num_workers = num_workers
+        self.process = None
+        self.last_step = None
+
+    @rank_zero_only
+    def on_fit_start(self, trainer, pl_module):
+        os.makedirs(os.path.join(self.evaldir, "snapshots"), exist_ok=True)
+        OmegaConf.save(self.config, os.path.join(self.evaldir, "config.yaml"))
+
+    def on_save_checkpoint(self, trainer, pl_module, checkpoint):
+        step = checkpoint["global_step"]
+        # save_last writes a second checkpoint of the same step
+        if not trainer.is_global_zero or trainer.sanity_checking or step == self.last_step:
+            return
+        if self.process is not None and self.process.poll() is None:
+            print(f"Evaluation of step {self.last_step} still running, skipping step {step}.")
+            return
+        self.last_step = step
+
+        ckpt = os.path.join(self.evaldir, "snapshots", f"step-{step:09}.ckpt")
+        torch.save({"state_dict": checkpoint["state_dict"], "global_step": step}, ckpt)
+        cmd = [sys.executable, "-m", "taming.evaluation",
+               "--config", os.path.join(self.evaldir, "config.yaml"),
+               "--ckpt", ckpt, "--step", str(step), "--outdir", self.evaldir,
+               "--device", self.device, "--num_workers", str(self.num_workers), "--delete_ckpt"]
+        limit_batches = self.limit_batches
+        if limit_batches is None and isinstance(trainer.limit_val_batches, int):
+            limit_batches = trainer.limit_val_batches
+        if limit_batches is not None:
+            cmd += ["--limit_batches", str(limit_batches)]
+        self.process = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def on_fit_end(self, trainer, pl_module):
+        if self.process is not None:
+            self.process.wait()
+
+
 
 if __name__ == "__main__":
 
@@ -544,6 +631,16 @@ if __name__ == "__main__":
                 }
             },
         }
+        if not config.model.params.get("validation_sampling", True):
+            # sampling metrics are computed by an evaluation worker on every checkpoint
+            default_callbacks_cfg["async_evaluation"] = {
+                "target": "main.AsyncEvaluationCallback",
+                "params": {
+                    "logdir": logdir,
+                    "config": config,
+                    "device": "cpu",
+                }
+            }
         callbacks_cfg = lightning_config.callbacks or OmegaConf.create()
         callbacks_cfg = OmegaConf.merge(default_callbacks_cfg, callbacks_cfg)
         trainer_kwargs["callbacks"] = [instantiate_from_config(callbacks_cfg[k]) for k in callbacks_cfg]
@@ -575,6 +672,12 @@ if __name__ == "__main__":
         print("Setting learning rate to {:.2e} = {} (accumulate_grad_batches) * {} (num_gpus) * {} (batchsize) * {:.2e} (base_lr)".format(
             model.learning_rate, accumulate_grad_batches, ngpu, bs, base_lr))
 
+        # losses of the timestep sampler are gathered in buffers of the same size on every rank
+        timestep_sampler = getattr(model, "timestep_sampler", None)
+        if getattr(timestep_sampler, "requires_losses", False) and timestep_sampler.gather_size is None:
+            timestep_sampler.gather_size = bs * getattr(model, "noise_levels_per_image", 1)
+            print(f"Setting gather_size of the timestep sampler to {timestep_sampler.gather_size}")
+
         # allow checkpointing via USR1
         def melk(*args, **kwargs):
             # run all checkpoint hooks
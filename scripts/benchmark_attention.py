@@ -0,0 +1,67 @@
+"""
+Micro-benchmark of the attention backends in taming.modules.attention.
+
+    python scripts/benchmark_attention.py --resolutions 16 32 64 --channels 256 --heads 4
+
+Reports the time per call and the largest deviation from the "math" backend.
+"""
+import argparse
+import time
+
+import torch
+
+from taming.modules.attention import ATTENTION_BACKENDS, attention, attention_backend
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[16, 32, 64],
+                        help="spatial resolutions, self-attention over res*res tokens")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--channels", type=int, default=256)
+    parser.add_argument("--heads", type=int, default=4)
+    parser.add_argument("--chunk_size", type=int, default=1024, help="query chunk size of the chunked backend")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--seed", type=int, default=23)
+    return parser
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def benchmark(backend, q, k, v, chunk_size, repeats):
+    with attention_backend(backend, chunk_size):
+        out = attention(q, k, v)  # warmup
+        sync(q.device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            attention(q, k, v)
+        sync(q.device)
+        elapsed = (time.perf_counter() - start) / repeats
+    return out, elapsed
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    torch.manual_seed(opt.seed)
+    device = torch.device(opt.device)
+    dim_head = opt.channels // opt.heads
+
+    if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        print(f"torch {torch.__version__} has no scaled_dot_product_attention, sdpa falls back to math")
+
+    print(f"{'tokens':>8} {'backend':>8} {'ms/call':>10} {'max |diff|':>12}")
+    for res in opt.resolutions:
+        tokens = res * res
+        q, k, v = (torch.randn(opt.batch_size * opt.heads, tokens, dim_head, device=device) for _ in range(3))
+        reference = None
+        for backend in ATTENTION_BACKENDS:
+            out, elapsed = benchmark(backend, q, k, v, opt.chunk_size, opt.repeats)
+            if reference is None:
+                reference = out
+            diff = (out - reference).abs().max().item()
+            print(f"{tokens:>8} {backend:>8} {1000 * elapsed:>10.2f} {diff:>12.2e}")
@@ -0,0 +1,45 @@
+"""
+Per-block report of the activation memory saved by checkpointing and the recompute time it costs.
+
+    python scripts/checkpointing_report.py --config configs/vqd_imagenet.yaml --batch_size 8
+
+The checkpointed column reflects the checkpoint_policy of the config's unet_config.
+"""
+import argparse
+
+import torch
+from omegaconf import OmegaConf
+
+from taming.util import instantiate_from_config
+from taming.modules.diffusionmodules.checkpointing import checkpointing_report, format_checkpointing_report
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="model config with model.params.unet_config")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--context_size", type=int, default=None,
+                        help="spatial size of the conditioning, defaults to the encoder's token grid")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    config = OmegaConf.load(opt.config).model.params
+    unet = instantiate_from_config(config.unet_config).to(opt.device).train()
+    unet_params = config.unet_config.params
+
+    context_size = opt.context_size
+    if context_size is None:
+        ddconfig = config.encoder_config.params.ddconfig
+        context_size = ddconfig.resolution // 2 ** (len(ddconfig.ch_mult) - 1)
+
+    x = torch.randn(opt.batch_size, unet_params.in_channels, unet_params.image_size, unet_params.image_size,
+                    device=opt.device)
+    t = torch.randint(0, config.get("timesteps", 1000), (opt.batch_size,), device=opt.device)
+    context = torch.randn(opt.batch_size, unet_params.context_dim, context_size, context_size, device=opt.device)
+
+    rows = checkpointing_report(unet, x, t, context, repeats=opt.repeats)
+    print(format_checkpointing_report(rows))
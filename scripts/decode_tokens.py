@@ -0,0 +1,94 @@
+"""
+Decode images from stored token grids, without running the encoder.
+
+    python scripts/decode_tokens.py --config configs/vqd_imagenet.yaml --ckpt last.ckpt \
+        --tokens tokens/*.npy --outdir decoded --steps 50
+
+Every token file holds a single [H x W] grid or a batch [B x H x W] of integer indices
+(.npy, .npz with an "indices" array, or a torch .pt tensor). One PNG is written per grid.
+"""
+import argparse
+import os
+from collections import Counter
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from PIL import Image
+from tqdm import tqdm
+
+from taming.util import instantiate_from_config
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--ckpt", type=str, required=True)
+    parser.add_argument("--tokens", type=str, nargs="+", required=True, help="token files to decode")
+    parser.add_argument("--outdir", type=str, required=True)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=None, help="sampling steps, defaults to ddim_timesteps")
+    parser.add_argument("--t_start", type=int, default=None,
+                        help="warm-start from the coarse reconstruction at this step, defaults to decode_t_start")
+    parser.add_argument("--guidance_scale", type=float, default=1.0)
+    parser.add_argument("--no_ema", action="store_true", help="decode with the training instead of the EMA weights")
+    parser.add_argument("--seed", type=int, default=23)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser
+
+
+def load_tokens(path):
+    if path.endswith(".npz"):
+        indices = np.load(path)["indices"]
+    elif path.endswith(".pt"):
+        indices = torch.load(path, map_location="cpu").numpy()
+    else:
+        indices = np.load(path)
+    indices = torch.from_numpy(np.asarray(indices).astype(np.int64))
+    if indices.dim() == 2:
+        indices = indices[None]
+    assert indices.dim() == 3, f"{path}: expected [H x W] or [B x H x W] token indices, got {tuple(indices.shape)}"
+    return indices
+
+
+def load_model(config_path, ckpt_path, device):
+    config = OmegaConf.load(config_path)
+    model = instantiate_from_config(config.model)
+    model.init_from_ckpt(ckpt_path)
+    return model.to(device).eval()
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    torch.manual_seed(opt.seed)
+    os.makedirs(opt.outdir, exist_ok=True)
+    model = load_model(opt.config, opt.ckpt, opt.device)
+
+    kwargs = {"unconditional_guidance_scale": opt.guidance_scale}
+    if opt.t_start is not None:
+        kwargs["t_start"] = opt.t_start
+
+    # (file stem, index within the file, tokens) for every grid, batched by grid size
+    grids = []
+    for path in opt.tokens:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        indices = load_tokens(path)
+        grids.extend((stem, i, indices[i]) for i in range(indices.shape[0]))
+    grids.sort(key=lambda g: tuple(g[2].shape))
+    per_file = Counter(stem for stem, _, _ in grids)
+
+    batches = []
+    for grid in grids:
+        if batches and len(batches[-1]) < opt.batch_size and batches[-1][0][2].shape == grid[2].shape:
+            batches[-1].append(grid)
+        else:
+            batches.append([grid])
+
+    for batch in tqdm(batches, desc="Decoding tokens"):
+        indices = torch.stack([grid[2] for grid in batch]).to(opt.device)
+        samples = model.decode_tokens(indices, steps=opt.steps, use_ema=not opt.no_ema, **kwargs)
+        samples = ((samples.clamp(-1., 1.) + 1.) * 127.5).round().to(torch.uint8)
+        samples = samples.permute(0, 2, 3, 1).cpu().numpy()
+        for (stem, i, _), sample in zip(batch, samples):
+            name = f"{stem}.png" if per_file[stem] == 1 else f"{stem}_{i:04}.png"
+            Image.fromarray(sample).save(os.path.join(opt.outdir, name))
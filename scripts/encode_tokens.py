@@ -0,0 +1,57 @@
+"""
+Encode a dataset of the model config into a bit-packed token archive.
+
+    python scripts/encode_tokens.py --config configs/vqd_imagenet.yaml --ckpt last.ckpt \
+        --split train --out data/imagenet_train_tokens
+
+writes data/imagenet_train_tokens.bin and .npz, readable with taming.data.token_archive.TokenArchive.
+For decoder fine-tuning with freeze_encoder, the split can then be replaced by a
+taming.data.token_archive.TokenCachedDataset over the same dataset config.
+"""
+import argparse
+
+import torch
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from taming.data.token_archive import TokenArchiveWriter
+from taming.data.utils import custom_collate
+from taming.util import instantiate_from_config, images_to_tensor
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="model config with a data section")
+    parser.add_argument("--ckpt", type=str, required=True)
+    parser.add_argument("--split", type=str, default="train", help="dataset of data.params to encode")
+    parser.add_argument("--out", type=str, required=True, help="archive path, without extension")
+    parser.add_argument("--labels", type=str, nargs="*", default=["file_path_"],
+                        help="per-example labels to store alongside the tokens")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    config = OmegaConf.load(opt.config)
+    model = instantiate_from_config(config.model)
+    model.init_from_ckpt(opt.ckpt)
+    model = model.to(opt.device).eval()
+
+    dataset = instantiate_from_config(config.data.params[opt.split])
+    loader = DataLoader(dataset, batch_size=opt.batch_size, num_workers=opt.num_workers, shuffle=False,
+                        collate_fn=custom_collate)
+
+    quantize = model.encoder.quantize
+    n_embed = getattr(quantize, "re_embed", quantize.n_e)
+    with TokenArchiveWriter(opt.out, n_embed) as writer:
+        for batch in tqdm(loader, desc=f"Encoding {opt.split}"):
+            x = images_to_tensor(batch["image"], opt.device)
+            indices = model.encode_tokens(x)
+            labels = {k: batch[k] for k in opt.labels if k in batch}
+            labels = {k: v.cpu().numpy() if isinstance(v, torch.Tensor) else v for k, v in labels.items()}
+            writer.add(indices, **labels)
+    print(f"Wrote {len(writer)} token grids at {writer.bits} bits per token to {opt.out}.bin")
@@ -0,0 +1,42 @@
+"""
+Pack a dataset of the config into tar shards for streaming training.
+
+    python scripts/write_shards.py --config configs/vqd_imagenet.yaml --split train \
+        --outdir data/imagenet_train_shards --examples_per_shard 2000
+
+The split can then be replaced by taming.data.shards.ShardedDataset with path
+data/imagenet_train_shards. Use a dataset config without random crops, the reader
+crops and resizes itself.
+"""
+import argparse
+
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from taming.data.shards import ShardWriter
+from taming.util import instantiate_from_config
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="config with a data section")
+    parser.add_argument("--split", type=str, default="train", help="dataset of data.params to write")
+    parser.add_argument("--outdir", type=str, required=True)
+    parser.add_argument("--examples_per_shard", type=int, default=1000)
+    parser.add_argument("--image_format", type=str, default="png", choices=["png", "jpeg"])
+    parser.add_argument("--num_workers", type=int, default=8)
+    return parser
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    config = OmegaConf.load(opt.config)
+    dataset = instantiate_from_config(config.data.params[opt.split])
+    # batch_size=None passes the examples through unbatched, in dataset order
+    loader = DataLoader(dataset, batch_size=None, num_workers=opt.num_workers, shuffle=False)
+
+    with ShardWriter(opt.outdir, opt.examples_per_shard, opt.image_format) as writer:
+        for example in tqdm(loader, desc=f"Writing {opt.split}", total=len(dataset)):
+            writer.write({k: v.numpy() if hasattr(v, "numpy") else v for k, v in example.items()})
+    print(f"Wrote {writer.count} examples in {len(writer.shards)} shards to {opt.outdir}")
@@ -21,9 +21,11 @@ class ConcatDatasetWithIndex(ConcatDataset):
 
 
 class ImagePaths(Dataset):
-    def __init__(self, paths, size=None, random_crop=False, labels=None):
+    def __init__(self, paths, size=None, random_crop=False, labels=None, uint8=False):
         self.size = size
         self.random_crop = random_crop
+        # return the images as uint8 HWC, the model normalises them on device
+        self.uint8 = uint8
 
         self.labels = dict() if labels is None else labels
         self.labels["file_path_"] = paths
@@ -48,6 +50,8 @@ class ImagePaths(Dataset):
             image = image.convert("RGB")
         image = np.array(image).astype(np.uint8)
         image = self.preprocessor(image=image)["image"]
+        if self.uint8:
+            return image
         image = (image/127.5 - 1.0).astype(np.float32)
         return image
 
@@ -66,5 +70,7 @@ class NumpyPaths(ImagePaths):
         image = Image.fromarray(image, mode="RGB")
         image = np.array(image).astype(np.uint8)
         image = self.preprocessor(image=image)["image"]
+        if self.uint8:
+            return image
         image = (image/127.5 - 1.0).astype(np.float32)
         return image
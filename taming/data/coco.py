@@ -22,8 +22,10 @@ class Examples(SegmentationBase):
 class CocoBase(Dataset):
     """needed for (image, caption, segmentation) pairs"""
     def __init__(self, size=None, dataroot="", datajson="", onehot_segmentation=False, use_stuffthing=False,
-                 crop_size=None, force_no_crop=False, given_files=None):
+                 crop_size=None, force_no_crop=False, given_files=None, uint8=False):
         self.split = self.get_split()
+        # return the images as uint8 HWC, the model normalises them on device
+        self.uint8 = uint8
         self.size = size
         if crop_size is None:
             self.crop_size = size
@@ -116,7 +118,8 @@ class CocoBase(Dataset):
 
         processed = self.preprocessor(image=image, segmentation=segmentation)
         image, segmentation = processed["image"], processed["segmentation"]
-        image = (image / 127.5 - 1.0).astype(np.float32)
+        if not self.uint8:
+            image = (image / 127.5 - 1.0).astype(np.float32)
 
         if self.onehot:
             assert segmentation.dtype == np.uint8
@@ -150,12 +153,14 @@ class CocoBase(Dataset):
 
 class CocoImagesAndCaptionsTrain(CocoBase):
     """returns a pair of (image, caption)"""
-    def __init__(self, size, onehot_segmentation=False, use_stuffthing=False, crop_size=None, force_no_crop=False):
+    def __init__(self, size, onehot_segmentation=False, use_stuffthing=False, crop_size=None, force_no_crop=False,
+                 uint8=False):
         super().__init__(size=size,
                          dataroot="data/coco/train2017",
                          datajson="data/coco/annotations/captions_train2017.json",
                          onehot_segmentation=onehot_segmentation,
-                         use_stuffthing=use_stuffthing, crop_size=crop_size, force_no_crop=force_no_crop)
+                         use_stuffthing=use_stuffthing, crop_size=crop_size, force_no_crop=force_no_crop,
+                         uint8=uint8)
 
     def get_split(self):
         return "train"
@@ -164,13 +169,13 @@ class CocoImagesAndCaptionsTrain(CocoBase):
 class CocoImagesAndCaptionsValidation(CocoBase):
     """returns a pair of (image, caption)"""
     def __init__(self, size, onehot_segmentation=False, use_stuffthing=False, crop_size=None, force_no_crop=False,
-                 given_files=None):
+                 given_files=None, uint8=False):
         super().__init__(size=size,
                          dataroot="data/coco/val2017",
                          datajson="data/coco/annotations/captions_val2017.json",
                          onehot_segmentation=onehot_segmentation,
                          use_stuffthing=use_stuffthing, crop_size=crop_size, force_no_crop=force_no_crop,
-                         given_files=given_files)
+                         given_files=given_files, uint8=uint8)
 
     def get_split(self):
         return "validation"
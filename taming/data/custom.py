@@ -21,18 +21,18 @@ class CustomBase(Dataset):
 
 
 class CustomTrain(CustomBase):
-    def __init__(self, size, training_images_list_file):
+    def __init__(self, size, training_images_list_file, uint8=False):
         super().__init__()
         with open(training_images_list_file, "r") as f:
             paths = f.read().splitlines()
-        self.data = ImagePaths(paths=paths, size=size, random_crop=False)
+        self.data = ImagePaths(paths=paths, size=size, random_crop=False, uint8=uint8)
 
 
 class CustomTest(CustomBase):
-    def __init__(self, size, test_images_list_file):
+    def __init__(self, size, test_images_list_file, uint8=False):
         super().__init__()
         with open(test_images_list_file, "r") as f:
             paths = f.read().splitlines()
-        self.data = ImagePaths(paths=paths, size=size, random_crop=False)
+        self.data = ImagePaths(paths=paths, size=size, random_crop=False, uint8=uint8)
 
 
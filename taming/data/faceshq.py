@@ -27,54 +27,54 @@ class FacesBase(Dataset):
 
 
 class CelebAHQTrain(FacesBase):
-    def __init__(self, size, keys=None):
+    def __init__(self, size, keys=None, uint8=False):
         super().__init__()
         root = "data/celebahq"
         with open("data/celebahqtrain.txt", "r") as f:
             relpaths = f.read().splitlines()
         paths = [os.path.join(root, relpath) for relpath in relpaths]
-        self.data = NumpyPaths(paths=paths, size=size, random_crop=False)
+        self.data = NumpyPaths(paths=paths, size=size, random_crop=False, uint8=uint8)
         self.keys = keys
 
 
 class CelebAHQValidation(FacesBase):
-    def __init__(self, size, keys=None):
+    def __init__(self, size, keys=None, uint8=False):
         super().__init__()
         root = "data/celebahq"
         with open("data/celebahqvalidation.txt", "r") as f:
             relpaths = f.read().splitlines()
         paths = [os.path.join(root, relpath) for relpath in relpaths]
-        self.data = NumpyPaths(paths=paths, size=size, random_crop=False)
+        self.data = NumpyPaths(paths=paths, size=size, random_crop=False, uint8=uint8)
         self.keys = keys
 
 
 class FFHQTrain(FacesBase):
-    def __init__(self, size, keys=None):
+    def __init__(self, size, keys=None, uint8=False):
         super().__init__()
         root = "data/ffhq"
         with open("data/ffhqtrain.txt", "r") as f:
             relpaths = f.read().splitlines()
         paths = [os.path.join(root, relpath) for relpath in relpaths]
-        self.data = ImagePaths(paths=paths, size=size, random_crop=False)
+        self.data = ImagePaths(paths=paths, size=size, random_crop=False, uint8=uint8)
         self.keys = keys
 
 
 class FFHQValidation(FacesBase):
-    def __init__(self, size, keys=None):
+    def __init__(self, size, keys=None, uint8=False):
         super().__init__()
         root = "data/ffhq"
         with open("data/ffhqvalidation.txt", "r") as f:
             relpaths = f.read().splitlines()
         paths = [os.path.join(root, relpath) for relpath in relpaths]
-        self.data = ImagePaths(paths=paths, size=size, random_crop=False)
+        self.data = ImagePaths(paths=paths, size=size, random_crop=False, uint8=uint8)
         self.keys = keys
 
 
 class FacesHQTrain(Dataset):
     # CelebAHQ [0] + FFHQ [1]
-    def __init__(self, size, keys=None, crop_size=None, coord=False):
-        d1 = CelebAHQTrain(size=size, keys=keys)
-        d2 = FFHQTrain(size=size, keys=keys)
+    def __init__(self, size, keys=None, crop_size=None, coord=False, uint8=False):
+        d1 = CelebAHQTrain(size=size, keys=keys, uint8=uint8)
+        d2 = FFHQTrain(size=size, keys=keys, uint8=uint8)
         self.data = ConcatDatasetWithIndex([d1, d2])
         self.coord = coord
         if crop_size is not None:
@@ -104,9 +104,9 @@ class FacesHQTrain(Dataset):
 
 class FacesHQValidation(Dataset):
     # CelebAHQ [0] + FFHQ [1]
-    def __init__(self, size, keys=None, crop_size=None, coord=False):
-        d1 = CelebAHQValidation(size=size, keys=keys)
-        d2 = FFHQValidation(size=size, keys=keys)
+    def __init__(self, size, keys=None, crop_size=None, coord=False, uint8=False):
+        d1 = CelebAHQValidation(size=size, keys=keys, uint8=uint8)
+        d2 = FFHQValidation(size=size, keys=keys, uint8=uint8)
         self.data = ConcatDatasetWithIndex([d1, d2])
         self.coord = coord
         if crop_size is not None:
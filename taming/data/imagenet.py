@@ -8,6 +8,7 @@ from omegaconf import OmegaConf
 from torch.utils.data import Dataset
 
 from taming.data.base import ImagePaths
+from taming.data.tar_index import TarImagePaths, build_tar_index
 from taming.util import download, retrieve
 import taming.data.utils as bdu
 
@@ -47,6 +48,8 @@ class ImageNetBase(Dataset):
         self.config = config or OmegaConf.create()
         if not type(self.config)==dict:
             self.config = OmegaConf.to_container(self.config)
+        # read the images from the downloaded tars instead of extracting them
+        self.use_tar_index = retrieve(self.config, "use_tar_index", default=False)
         self._prepare()
         #self._prepare_synset_to_human()
         #self._prepare_idx_to_synset()
@@ -92,7 +95,30 @@ class ImageNetBase(Dataset):
         if (not os.path.exists(self.idx2syn)):
             download(URL, self.idx2syn)
 
+    def _prepare_tar_index(self, name_fn=None):
+        self.tar_index = os.path.join(self.root, "tar_index.npz")
+        if not os.path.exists(self.tar_index):
+            path = os.path.join(self.root, self.FILES[0])
+            if not os.path.exists(path) or not os.path.getsize(path)==self.SIZES[0]:
+                import academictorrents as at
+                atpath = at.get(self.AT_HASH, datastore=self.root)
+                assert atpath == path
+            print("Indexing {} into {}".format(path, self.tar_index))
+            build_tar_index([path], self.tar_index, name_fn=name_fn)
+
+    def _load_tar_index(self):
+        self.data = TarImagePaths(self.tar_index,
+                                  labels=None,
+                                  size=retrieve(self.config, "size", default=0),
+                                  random_crop=self.random_crop,
+                                  uint8=retrieve(self.config, "uint8", default=False))
+        self.relpaths = self.data.labels["file_path_"]
+        self.synsets = [p.split("/")[0] for p in self.relpaths]
+
     def _load(self):
+        if self.use_tar_index:
+            self._load_tar_index()
+            return
         with open(self.txt_filelist, "r") as f:
             self.relpaths = f.read().splitlines()
             #l1 = len(self.relpaths)
@@ -121,7 +147,8 @@ class ImageNetBase(Dataset):
         self.data = ImagePaths(self.abspaths,
                                labels=None,
                                size=retrieve(self.config, "size", default=0),
-                               random_crop=self.random_crop)
+                               random_crop=self.random_crop,
+                               uint8=retrieve(self.config, "uint8", default=False))
 
 
 class ImageNetTrain(ImageNetBase):
@@ -144,6 +171,10 @@ class ImageNetTrain(ImageNetBase):
         self.datadir = os.path.join(self.root, "data")
         self.txt_filelist = os.path.join(self.root, "filelist.txt")
         self.expected_length = 1281167
+        if self.use_tar_index:
+            # the class sub-tars are indexed inside the outer tar as <synset>/<file>
+            self._prepare_tar_index()
+            return
         if not bdu.is_prepared(self.root):
             # prep
             print("Preparing dataset {} in {}".format(self.NAME, self.root))
@@ -204,6 +235,15 @@ class ImageNetValidation(ImageNetBase):
         self.txt_filelist = os.path.join(self.root, "filelist.txt")
         self.expected_length = 50000
 
+        if self.use_tar_index:
+            vspath = os.path.join(self.root, self.FILES[1])
+            if not os.path.exists(vspath) or not os.path.getsize(vspath)==self.SIZES[1]:
+                download(self.VS_URL, vspath)
+            with open(vspath, "r") as f:
+                synset_dict = dict(line.split() for line in f.read().splitlines())
+            self._prepare_tar_index(name_fn=lambda name: "{}/{}".format(synset_dict[name], name))
+            return
+
         if not bdu.is_prepared(self.root):
             # prep
             print("Preparing dataset {} in {}".format(self.NAME, self.root))
@@ -10,9 +10,11 @@ class SegmentationBase(Dataset):
     def __init__(self,
                  data_csv, data_root, segmentation_root,
                  size=None, random_crop=False, interpolation="bicubic",
-                 n_labels=182, shift_segmentation=False,
+                 n_labels=182, shift_segmentation=False, uint8=False,
                  ):
         self.n_labels = n_labels
+        # return the images as uint8 HWC, the model normalises them on device
+        self.uint8 = uint8
         self.shift_segmentation = shift_segmentation
         self.data_csv = data_csv
         self.data_root = data_root
@@ -76,7 +78,10 @@ class SegmentationBase(Dataset):
             processed = {"image": image,
                          "mask": segmentation
                          }
-        example["image"] = (processed["image"]/127.5 - 1.0).astype(np.float32)
+        if self.uint8:
+            example["image"] = processed["image"]
+        else:
+            example["image"] = (processed["image"]/127.5 - 1.0).astype(np.float32)
         segmentation = processed["mask"]
         onehot = np.eye(self.n_labels)[segmentation]
         example["segmentation"] = onehot
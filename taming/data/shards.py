@@ -0,0 +1,251 @@
+"""
+Sharded sequential-read dataset format for streaming training.
+
+A sharded dataset is a directory of tar shards plus a manifest:
+    shards.json        {"shards": [{"path": "shard-000000.tar", "count": 1000}, ...]}
+    shard-000000.tar   per example <key>.image.png|jpg (the encoded "image"),
+                       <key>.<field>.npy for other arrays and <key>.json for
+                       the remaining json-serialisable fields
+ShardWriter packs the examples of any dataset, e.g. with scripts/write_shards.py.
+ShardedDataset streams the shards sequentially: shards are split over ranks and
+dataloader workers, examples go through an in-memory shuffle buffer and the
+position in the epoch can be restored, see DataModuleFromConfig.
+"""
+import io
+import json
+import os
+import random
+import tarfile
+
+import albumentations
+import numpy as np
+import torch.distributed as dist
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+MANIFEST = "shards.json"
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return value
+
+
+class ShardWriter(object):
+    """
+    Packs examples (dicts with an HWC "image" in [-1, 1] or uint8) into tar shards of
+    examples_per_shard examples each.
+        with ShardWriter("data/imagenet_train_shards") as writer:
+            for example in dataset:
+                writer.write(example)
+    :param image_format: "png" (lossless) or "jpeg".
+    """
+    def __init__(self, outdir, examples_per_shard=1000, image_format="png", quality=95):
+        assert image_format in ["png", "jpeg"]
+        self.outdir = outdir
+        self.examples_per_shard = examples_per_shard
+        self.image_format = image_format
+        self.quality = quality
+        os.makedirs(outdir, exist_ok=True)
+        self.shards = []
+        self.tar = None
+        self.count = 0
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def encode_image(self, image):
+        image = np.asarray(image)
+        if image.dtype != np.uint8:
+            image = ((image + 1.0) * 127.5).round().clip(0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        if self.image_format == "png":
+            Image.fromarray(image).save(buffer, format="PNG")
+        else:
+            Image.fromarray(image).save(buffer, format="JPEG", quality=self.quality)
+        return buffer.getvalue()
+
+    def write(self, example):
+        if self.tar is None or self.shards[-1]["count"] == self.examples_per_shard:
+            self.next_shard()
+        key = f"{self.count:09}"
+        extension = "png" if self.image_format == "png" else "jpg"
+        self._add(f"{key}.image.{extension}", self.encode_image(example["image"]))
+        fields = dict()
+        for k, v in example.items():
+            if k == "image":
+                continue
+            if isinstance(v, np.ndarray) and v.ndim > 1:
+                buffer = io.BytesIO()
+                np.save(buffer, v)
+                self._add(f"{key}.{k}.npy", buffer.getvalue())
+            else:
+                fields[k] = _to_json(v)
+        self._add(f"{key}.json", json.dumps(fields).encode())
+        self.shards[-1]["count"] += 1
+        self.count += 1
+
+    def next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        path = f"shard-{len(self.shards):06}.tar"
+        self.tar = tarfile.open(os.path.join(self.outdir, path), "w")
+        self.shards.append({"path": path, "count": 0})
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        with open(os.path.join(self.outdir, MANIFEST), "w") as f:
+            json.dump({"shards": self.shards}, f, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_shard(path):
+    """raw examples of a shard in storage order, dicts of field -> bytes"""
+    example, key = dict(), None
+    # "r|" streams the tar front to back without seeking
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, field = member.name.split(".", 1)
+            if key is not None and member_key != key:
+                yield example
+                example = dict()
+            key = member_key
+            example[field] = tar.extractfile(member).read()
+    if key is not None:
+        yield example
+
+
+class ShardedDataset(IterableDataset):
+    """
+    Streams the examples of a ShardWriter directory. Every epoch the shards are
+    shuffled with seed and epoch, split over the ranks and then over the dataloader
+    workers, which produce their share of the num_examples // world_size examples
+    per rank. A worker with fewer examples in its shards repeats some of them, so
+    use a number of equally sized shards divisible by ranks * workers. shuffle_buffer
+    examples are mixed in memory before decoding. size and random_crop preprocess
+    the images like ImagePaths, uint8 returns them as uint8 HWC.
+    """
+    def __init__(self, path, shuffle_buffer=1000, seed=23, size=None, random_crop=False, uint8=False):
+        self.path = path
+        with open(os.path.join(path, MANIFEST), "r") as f:
+            self.shards = json.load(f)["shards"]
+        self.num_examples = sum(shard["count"] for shard in self.shards)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.uint8 = uint8
+        if size is not None and size > 0:
+            cropper = albumentations.RandomCrop if random_crop else albumentations.CenterCrop
+            self.preprocessor = albumentations.Compose([albumentations.SmallestMaxSize(max_size=size),
+                                                        cropper(height=size, width=size)])
+        else:
+            self.preprocessor = lambda **kwargs: kwargs
+        self.rank, self.world_size = (dist.get_rank(), dist.get_world_size()) \
+            if dist.is_available() and dist.is_initialized() else (0, 1)
+        # position to resume from, see set_position
+        self.epoch = 0
+        self.start_batch = 0
+        self.batch_size = 1
+        self._epochs_started = 0
+
+    def set_distributed(self, rank, world_size):
+        self.rank, self.world_size = rank, world_size
+
+    def set_position(self, epoch, start_batch=0, batch_size=1):
+        """
+        Start at epoch, after the first start_batch batches of this rank. Later
+        epochs follow on every new iteration, which relies on persistent workers.
+        :param batch_size: batch size of the dataloader, the workers produce whole batches in turn.
+        """
+        self.epoch, self.start_batch, self.batch_size = epoch, start_batch, batch_size
+        self._epochs_started = 0
+
+    def __len__(self):
+        return self.num_examples // self.world_size
+
+    def worker_shards(self, epoch, worker, num_workers):
+        shards = list(self.shards)
+        random.Random(self.seed + epoch).shuffle(shards)
+        shards = shards[self.rank::self.world_size][worker::num_workers]
+        assert len(shards) > 0, f"{len(self.shards)} shards are too few for {self.world_size} ranks " \
+                                f"with {num_workers} dataloader workers"
+        return shards
+
+    def raw_examples(self, shards, rng, num_examples):
+        # passes over the shards of this worker, reshuffled every time, until num_examples are covered.
+        # the stream is finite so the shuffle buffer drains before a shard is repeated
+        passes = -(-num_examples // sum(shard["count"] for shard in shards))
+        for _ in range(max(passes, 1)):
+            rng.shuffle(shards)
+            for shard in shards:
+                yield from read_shard(os.path.join(self.path, shard["path"]))
+
+    def shuffled(self, examples, rng):
+        buffer = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = example
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def decode(self, raw):
+        example = json.loads(raw["json"]) if "json" in raw else dict()
+        for field, data in raw.items():
+            if field.startswith("image."):
+                image = Image.open(io.BytesIO(data))
+                if not image.mode == "RGB":
+                    image = image.convert("RGB")
+                image = self.preprocessor(image=np.array(image).astype(np.uint8))["image"]
+                example["image"] = image if self.uint8 else (image/127.5 - 1.0).astype(np.float32)
+            elif field.endswith(".npy"):
+                example[field[:-len(".npy")]] = np.load(io.BytesIO(data))
+        return example
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        # persistent workers keep their copy of the dataset, so they count the epochs themselves
+        epoch = self.epoch + self._epochs_started
+        start_batch = self.start_batch if self._epochs_started == 0 else 0
+        self._epochs_started += 1
+
+        # the dataloader fetches its j-th batch from worker j % num_workers. worker stands in
+        # for the worker that produced batch start_batch + j of the epoch, produces the examples
+        # of its batches and skips those of the first start_batch batches
+        worker = (worker + start_batch) % num_workers
+        per_rank, batch_size = len(self), self.batch_size
+        num_batches = -(-per_rank // batch_size)
+        batches = range(worker, num_batches, num_workers)
+        quota = len(batches) * batch_size
+        if num_batches - 1 in batches:
+            quota -= num_batches * batch_size - per_rank
+        skip = min(len(range(worker, start_batch, num_workers)) * batch_size, quota)
+
+        rng = random.Random(f"{self.seed}-{epoch}-{self.rank}-{worker}")
+        shards = self.worker_shards(epoch, worker, num_workers)
+        stream = self.shuffled(self.raw_examples(shards, rng, quota), rng)
+        for i, raw in enumerate(stream):
+            if i >= quota:
+                break
+            if i >= skip:
+                yield self.decode(raw)
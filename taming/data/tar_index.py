@@ -0,0 +1,103 @@
+"""
+Random access to images stored in (nested) uncompressed tar archives.
+
+build_tar_index scans the archives once and records name, archive, byte offset
+and size of every image in a .npz index. Members of tars inside a tar (as in the
+ImageNet train archive) are addressed directly in the outer file and named
+"<inner tar stem>/<member>". TarImagePaths then reads images with os.pread,
+without extracting them and without a file per image on the filesystem.
+"""
+import io
+import os
+import tarfile
+
+import numpy as np
+from tqdm import tqdm
+
+from taming.data.base import ImagePaths
+
+
+IMAGE_EXTENSIONS = (".jpeg", ".jpg", ".png")
+
+
+def _scan(tar, base_offset, prefix, records, archive_id):
+    for member in tar:
+        if not member.isfile():
+            continue
+        name = member.name
+        if name.endswith(".tar"):
+            # a tar in the tar, its members are stored uncompressed at an offset of the outer file
+            inner = tarfile.open(fileobj=tar.extractfile(member), mode="r:")
+            stem = os.path.splitext(os.path.basename(name))[0]
+            _scan(inner, base_offset + member.offset_data, stem + "/", records, archive_id)
+        elif name.lower().endswith(IMAGE_EXTENSIONS):
+            records.append((prefix + name, archive_id, base_offset + member.offset_data, member.size))
+
+
+def build_tar_index(archives, index_path, name_fn=None):
+    """
+    :param archives: paths of the uncompressed tar archives.
+    :param index_path: .npz file to write.
+    :param name_fn: optional mapping of the member names, e.g. to prepend a class folder.
+    """
+    records = []
+    for archive_id, archive in enumerate(tqdm(archives, desc="Indexing tars")):
+        with tarfile.open(archive, mode="r:") as tar:
+            _scan(tar, 0, "", records, archive_id)
+    if name_fn is not None:
+        records = [(name_fn(name),) + tuple(rest) for name, *rest in records]
+    # same order as a sorted list of the extracted files
+    records.sort(key=lambda record: record[0])
+    names, archive_ids, offsets, sizes = zip(*records)
+    tmp_path = index_path + ".tmp.npz"
+    np.savez(tmp_path,
+             names=np.asarray(names, dtype=np.bytes_),
+             archives=np.asarray([os.path.abspath(a) for a in archives]),
+             archive_ids=np.asarray(archive_ids, dtype=np.int32),
+             offsets=np.asarray(offsets, dtype=np.int64),
+             sizes=np.asarray(sizes, dtype=np.int64))
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+class TarImagePaths(ImagePaths):
+    """
+    ImagePaths over the images of a tar index. file_path_ holds the member names
+    and the image bytes are read with os.pread from the archives. File handles are
+    opened lazily in every dataloader worker.
+    """
+    def __init__(self, index_path, size=None, random_crop=False, labels=None, uint8=False):
+        index = np.load(index_path)
+        self.archives = [str(a) for a in index["archives"]]
+        self.archive_ids = index["archive_ids"]
+        self.offsets = index["offsets"]
+        self.sizes = index["sizes"]
+        paths = [name.decode() for name in index["names"]]
+        super().__init__(paths, size=size, random_crop=random_crop, labels=labels, uint8=uint8)
+        self._files = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"] = None
+        return state
+
+    def read(self, i):
+        if self._files is None or self._pid != os.getpid():
+            self._files = dict()
+            self._pid = os.getpid()
+        archive_id = int(self.archive_ids[i])
+        if archive_id not in self._files:
+            self._files[archive_id] = os.open(self.archives[archive_id], os.O_RDONLY)
+        fd, offset, size = self._files[archive_id], int(self.offsets[i]), int(self.sizes[i])
+        if hasattr(os, "pread"):
+            return os.pread(fd, size, offset)
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+    def __getitem__(self, i):
+        example = dict()
+        example["image"] = self.preprocess_image(io.BytesIO(self.read(i)))
+        for k in self.labels:
+            example[k] = self.labels[k][i]
+        return example
@@ -0,0 +1,206 @@
+"""
+Bit-packed archive of VQ token grids.
+
+An archive at `path` consists of two files:
+    path.bin  records of token indices, each packed at ceil(log2(n_embed)) bits
+              and starting at a byte boundary
+    path.npz  the index: byte offsets and [H, W] shapes of all records, n_embed,
+              the bit width and per-record labels (e.g. file_path_, class_label).
+              String labels are stored as one utf-8 blob with offsets, not as a
+              fixed-width unicode array
+
+TokenArchive reads the records through np.memmap, so random access only touches
+the bytes of the requested grid. TokenCachedDataset pairs an archive with the image
+dataset it was encoded from, for training the decoder with a frozen encoder.
+"""
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from taming.util import instantiate_from_config
+
+
+def bits_per_token(n_embed):
+    return max(1, int(np.ceil(np.log2(n_embed))))
+
+
+def pack_tokens(indices, bits):
+    """[N] non-negative integers < 2**bits -> ceil(N * bits / 8) bytes"""
+    indices = np.asarray(indices).reshape(-1).astype(">u4")
+    bitplanes = np.unpackbits(indices.view(np.uint8)).reshape(-1, 32)[:, 32 - bits:]
+    return np.packbits(bitplanes.reshape(-1))
+
+
+def unpack_tokens(data, bits, n):
+    """inverse of pack_tokens, returns [n] int64 indices"""
+    bitplanes = np.unpackbits(np.asarray(data, dtype=np.uint8), count=n * bits).reshape(n, bits)
+    bitplanes = np.pad(bitplanes, ((0, 0), (32 - bits, 0)))
+    return np.packbits(bitplanes.reshape(-1)).view(">u4").astype(np.int64)
+
+
+class StringLabels(object):
+    """per-record strings of an archive, decoded on access from a utf-8 blob and offsets"""
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def encode(strings):
+        encoded = [str(v).encode("utf-8") for v in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+
+class TokenArchiveWriter(object):
+    """
+    Appends token grids to an archive, the index is written on close.
+        with TokenArchiveWriter("data/imagenet_train_tokens", n_embed=8192) as writer:
+            writer.add(indices, file_path_=paths)
+    """
+    def __init__(self, path, n_embed):
+        self.path = path
+        self.n_embed = n_embed
+        self.bits = bits_per_token(n_embed)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path + ".bin", "wb")
+        self.offsets = [0]
+        self.shapes = []
+        self.labels = {}
+
+    def add(self, indices, **labels):
+        """
+        :param indices: an [H x W] grid or a [B x H x W] batch of token indices.
+        :param labels: per-grid labels, one value per grid of the batch.
+        """
+        if isinstance(indices, torch.Tensor):
+            indices = indices.detach().cpu().numpy()
+        indices = np.asarray(indices)
+        if indices.ndim == 2:
+            indices = indices[None]
+            labels = {k: [v] for k, v in labels.items()}
+        assert indices.ndim == 3, f"expected [B x H x W] token indices, got {indices.shape}"
+        assert indices.min() >= 0 and indices.max() < self.n_embed, f"token indices out of range [0, {self.n_embed})"
+        assert not self.shapes or set(labels) == set(self.labels), "every grid needs the same labels"
+        for i, grid in enumerate(indices):
+            packed = pack_tokens(grid, self.bits)
+            self.file.write(packed.tobytes())
+            self.offsets.append(self.offsets[-1] + packed.size)
+            self.shapes.append(grid.shape)
+            for k, v in labels.items():
+                self.labels.setdefault(k, []).append(v[i])
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        labels = dict()
+        for k, v in self.labels.items():
+            if all(isinstance(x, (str, np.str_)) for x in v):
+                labels[f"strlabel_data_{k}"], labels[f"strlabel_offsets_{k}"] = StringLabels.encode(v)
+            else:
+                labels[f"label_{k}"] = np.asarray(v)
+        np.savez(self.path + ".npz",
+                 offsets=np.asarray(self.offsets, dtype=np.int64),
+                 shapes=np.asarray(self.shapes, dtype=np.int32).reshape(-1, 2),
+                 n_embed=self.n_embed, bits=self.bits, **labels)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TokenArchive(Dataset):
+    """
+    Token grids of an archive written by TokenArchiveWriter.
+    Examples are dicts with "tokens", an [H x W] int64 array, and the stored labels.
+    """
+    def __init__(self, path):
+        self.path = path
+        index = np.load(path + ".npz")
+        self.offsets = index["offsets"]
+        self.shapes = index["shapes"]
+        self.n_embed = int(index["n_embed"])
+        self.bits = int(index["bits"])
+        self.labels = {k[len("label_"):]: index[k] for k in index.files if k.startswith("label_")}
+        for k in index.files:
+            if k.startswith("strlabel_data_"):
+                name = k[len("strlabel_data_"):]
+                self.labels[name] = StringLabels(index[k], index["strlabel_offsets_" + name])
+        self._data = None
+
+    @property
+    def data(self):
+        # opened lazily, so every dataloader worker maps the file itself instead of receiving a pickled copy
+        if self._data is None:
+            self._data = np.memmap(self.path + ".bin", dtype=np.uint8, mode="r")
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def get_tokens(self, i):
+        h, w = self.shapes[i]
+        return unpack_tokens(self.data[self.offsets[i]:self.offsets[i + 1]], self.bits, h * w).reshape(h, w)
+
+    def __getitem__(self, i):
+        example = dict()
+        example["tokens"] = self.get_tokens(i)
+        for k in self.labels:
+            example[k] = self.labels[k][i]
+        return example
+
+
+class TokenCachedDataset(Dataset):
+    """
+    Examples of an image dataset with their token grids added under "tokens", read from
+    an archive of scripts/encode_tokens.py for the same dataset and split. The dataset
+    has to be preprocessed deterministically (no random crops), otherwise the tokens do
+    not match the images. Used with VQDiffusion(freeze_encoder=True), e.g.
+        train:
+          target: taming.data.token_archive.TokenCachedDataset
+          params:
+            archive: data/imagenet_train_tokens
+            dataset_config:
+              target: taming.data.imagenet.ImageNetTrain
+              params: ...
+    :param check_key: label compared between dataset and archive to catch a different order.
+    """
+    def __init__(self, dataset_config, archive, check_key="file_path_"):
+        self.data = instantiate_from_config(dataset_config)
+        self.tokens = TokenArchive(archive)
+        assert len(self.data) == len(self.tokens), \
+            f"dataset has {len(self.data)} examples but the token archive {len(self.tokens)}"
+        images = getattr(self.data, "data", self.data)
+        assert not getattr(self.data, "random_crop", False) and not getattr(images, "random_crop", False), \
+            "cached tokens need a dataset without random crops"
+        self.check_key = check_key if check_key in self.tokens.labels else None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        example = self.data[i]
+        example["tokens"] = self.tokens.get_tokens(i)
+        if self.check_key is not None and self.check_key in example:
+            assert str(example[self.check_key]) == str(self.tokens.labels[self.check_key][i]), \
+                f"token archive does not match the dataset at example {i}"
+        return example
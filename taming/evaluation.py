@@ -0,0 +1,100 @@
+"""
+Evaluation worker: sampling and metrics of a checkpoint, outside of the training process.
+
+    python -m taming.evaluation --config logs/<run>/evaluation/config.yaml \
+        --ckpt logs/<run>/evaluation/snapshots/step-000020000.ckpt --step 20000 \
+        --outdir logs/<run>/evaluation --device cuda:7
+
+Decodes the validation set with the EMA weights, computes the model's metrics_dict
+(PSNR, FID, CodebookUsage) and writes them to a tensorboard log and metrics.jsonl in
+outdir. Started by main.AsyncEvaluationCallback when validation_sampling is disabled.
+"""
+import argparse
+import json
+import os
+import time
+
+import torch
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from taming.data.utils import custom_collate
+from taming.util import instantiate_from_config
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True, help="project config with model and data sections")
+    parser.add_argument("--ckpt", type=str, required=True)
+    parser.add_argument("--outdir", type=str, required=True)
+    parser.add_argument("--step", type=int, default=None, help="global step of the checkpoint")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--limit_batches", type=int, default=None, help="number of validation batches")
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--delete_ckpt", action="store_true", help="remove the checkpoint when done")
+    return parser
+
+
+def load_model(config, ckpt, device):
+    model = instantiate_from_config(config.model)
+    model.init_from_ckpt(ckpt)
+    return model.to(device).eval()
+
+
+@torch.no_grad()
+def evaluate(model, dataloader, limit_batches=None, fid_cache_key=None):
+    """
+    :param fid_cache_key: identifies the evaluated subset for the real statistics cache of FIDMetric.
+    :return: a dict of the computed metrics and the images of the first batch
+    """
+    for metric in model.metrics_dict.values():
+        metric.reset()
+    fid = model.metrics_dict["FID"] if "FID" in model.metrics_dict else None
+    if fid_cache_key is not None and hasattr(fid, "set_cache_key"):
+        fid.set_cache_key(fid_cache_key)
+
+    images = None
+    total = len(dataloader) if limit_batches is None else min(limit_batches, len(dataloader))
+    with model.ema_scope():
+        for batch_idx, batch in enumerate(tqdm(dataloader, desc="Evaluating", total=total)):
+            if batch_idx >= total:
+                break
+            batch = {k: v.to(model.device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+            x, c = model.get_input(batch)
+            img = model.sample_and_update_metrics(x, c)
+            if images is None:
+                images = img
+    metrics = {f"val_{k}": float(metric.compute()) for k, metric in model.metrics_dict.items()}
+    return metrics, images
+
+
+def write_metrics(outdir, step, metrics, images=None):
+    from torch.utils.tensorboard import SummaryWriter
+    os.makedirs(outdir, exist_ok=True)
+    writer = SummaryWriter(log_dir=outdir)
+    for k, v in metrics.items():
+        writer.add_scalar(k, v, global_step=step)
+    if images is not None:
+        writer.add_images("val_images", images, global_step=step, dataformats="NHWC")
+    writer.close()
+    with open(os.path.join(outdir, "metrics.jsonl"), "a") as f:
+        f.write(json.dumps(dict(step=step, time=time.time(), **metrics)) + "\n")
+
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    config = OmegaConf.load(opt.config)
+    model = load_model(config, opt.ckpt, opt.device)
+
+    dataset = instantiate_from_config(config.data.params.validation)
+    dataloader = DataLoader(dataset, batch_size=config.data.params.batch_size, num_workers=opt.num_workers,
+                            collate_fn=custom_collate)
+    fid_cache_key = repr((OmegaConf.to_container(config.data.params.validation, resolve=True),
+                          dataloader.batch_size, opt.limit_batches))
+    metrics, images = evaluate(model, dataloader, opt.limit_batches, fid_cache_key)
+    write_metrics(opt.outdir, opt.step, metrics, images)
+    print(f"Step {opt.step}: " + ", ".join(f"{k} {v:.4f}" for k, v in metrics.items()))
+
+    if opt.delete_ckpt:
+        os.remove(opt.ckpt)
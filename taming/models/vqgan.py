@@ -4,6 +4,7 @@ import torch.nn.functional as F
 import pytorch_lightning as pl
 
 from main import instantiate_from_config
+from taming.util import images_to_tensor
 
 from taming.modules.diffusionmodules.model import Encoder, Decoder
 from taming.modules.metrics.metrics import FIDMetric, InceptionMetric, CodebookUsageMetric
@@ -26,6 +27,7 @@ class VQModel(pl.LightningModule):
                  monitor=None,
                  remap=None,
                  sane_index_shape=False,  # tell vector quantizer to return indices as bhw
+                 fid_cache_dir=None,
                  ):
         super().__init__()
         self.image_key = image_key
@@ -46,7 +48,7 @@ class VQModel(pl.LightningModule):
             self.monitor = monitor
 
         self.metrics_dict = torch.nn.ModuleDict({"PSNR":torchmetrics.PeakSignalNoiseRatio(data_range=1.0),
-                             "FID":FIDMetric(),
+                             "FID":FIDMetric(cache_dir=fid_cache_dir),
                              #"Inception":InceptionMetric()
                             "CodebookUsage":CodebookUsageMetric(n_embed),
                             })
@@ -88,8 +90,7 @@ class VQModel(pl.LightningModule):
         x = batch[k]
         if len(x.shape) == 3:
             x = x[..., None]
-        x = x.permute(0, 3, 1, 2).to(memory_format=torch.contiguous_format)
-        return x.float()
+        return images_to_tensor(x, self.device)
 
     def training_step(self, batch, batch_idx, optimizer_idx=None):
         x = self.get_input(batch, self.image_key)
@@ -112,6 +113,11 @@ class VQModel(pl.LightningModule):
             self.log_dict(log_dict_disc, prog_bar=False, logger=True, on_step=True, on_epoch=True)
             return discloss
 
+    def on_validation_start(self):
+        # the sanity check only runs a few batches, keep it out of the real statistics cache
+        key = None if self.trainer.sanity_checking else FIDMetric.cache_key_from_trainer(self.trainer)
+        self.metrics_dict["FID"].set_cache_key(key)
+
     def validation_step(self, batch, batch_idx):
         x = self.get_input(batch, self.image_key)
         xrec, qloss = self(x)
@@ -1,4 +1,5 @@
 from inspect import isfunction
+from contextlib import contextmanager
 import math
 import torch
 import torch.nn.functional as F
@@ -33,6 +34,80 @@ def init_(tensor):
     return tensor
 
 
+# attention backends
+ATTENTION_BACKENDS = ["math", "sdpa", "chunked"]
+_attention_backend = {"name": "math", "chunk_size": 1024}
+
+
+def set_attention_backend(name, chunk_size=None):
+    """
+    Select the implementation used by attention() for all attention layers.
+    "math": the explicit einsum + softmax computation of the previous layers, with their softmax
+            dtype (float32 for the UNet QKV attention, the input dtype otherwise).
+    "sdpa": torch.nn.functional.scaled_dot_product_attention, falls back to "math" on torch < 2.0.
+    "chunked": "math" over chunks of chunk_size queries, peak memory is chunk_size x keys per head.
+    """
+    assert name in ATTENTION_BACKENDS, f'attention backend {name} unknown, choose from {ATTENTION_BACKENDS}'
+    _attention_backend["name"] = name
+    if chunk_size is not None:
+        _attention_backend["chunk_size"] = chunk_size
+
+
+def get_attention_backend():
+    return _attention_backend["name"]
+
+
+@contextmanager
+def attention_backend(name, chunk_size=None):
+    old = dict(_attention_backend)
+    set_attention_backend(name, chunk_size)
+    try:
+        yield None
+    finally:
+        _attention_backend.update(old)
+
+
+def _math_attention(q, k, v, mask=None, scale=None, upcast_softmax=False):
+    sim = einsum('b i d, b j d -> b i j', q, k) * scale
+    if exists(mask):
+        sim.masked_fill_(~mask, -torch.finfo(sim.dtype).max)
+    if upcast_softmax:
+        attn = sim.float().softmax(dim=-1).type(sim.dtype)
+    else:
+        attn = sim.softmax(dim=-1)
+    return einsum('b i j, b j d -> b i d', attn, v)
+
+
+def attention(q, k, v, mask=None, scale=None, backend=None, upcast_softmax=False):
+    """
+    softmax(q k^T * scale) v with the selected backend.
+    :param q: [B x N x D] queries.
+    :param k: [B x M x D] keys.
+    :param v: [B x M x Dv] values.
+    :param mask: optional boolean [B x 1 x M] or [B x N x M] mask, False entries are not attended to.
+    :param scale: defaults to D ** -0.5.
+    :param upcast_softmax: "math" and "chunked" compute the softmax in float32, like the
+                           QKV attention of the UNet did, the other layers keep the input dtype.
+    :return: [B x N x Dv]
+    """
+    scale = default(scale, q.shape[-1] ** -0.5)
+    backend = default(backend, _attention_backend["name"])
+    if backend == "sdpa" and hasattr(F, "scaled_dot_product_attention"):
+        # the default scale of sdpa is D ** -0.5, fold any other scale into q
+        if scale != q.shape[-1] ** -0.5:
+            q = q * (scale * math.sqrt(q.shape[-1]))
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    if backend == "chunked":
+        chunk_size = _attention_backend["chunk_size"]
+        if q.shape[1] > chunk_size:
+            out = []
+            for i in range(0, q.shape[1], chunk_size):
+                chunk_mask = mask if not exists(mask) or mask.shape[1] == 1 else mask[:, i:i + chunk_size]
+                out.append(_math_attention(q[:, i:i + chunk_size], k, v, chunk_mask, scale, upcast_softmax))
+            return torch.cat(out, dim=1)
+    return _math_attention(q, k, v, mask, scale, upcast_softmax)
+
+
 # feedforward
 class GEGLU(nn.Module):
     def __init__(self, dim_in, dim_out):
@@ -142,18 +217,9 @@ class SpatialSelfAttention(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = rearrange(q, 'b c h w -> b (h w) c')
-        k = rearrange(k, 'b c h w -> b c (h w)')
-        w_ = torch.einsum('bij,bjk->bik', q, k)
-
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = rearrange(v, 'b c h w -> b c (h w)')
-        w_ = rearrange(w_, 'b i j -> b j i')
-        h_ = torch.einsum('bij,bjk->bik', v, w_)
-        h_ = rearrange(h_, 'b c (h w) -> b c h w', h=h)
+        q, k, v = map(lambda t: rearrange(t, 'b c h w -> b (h w) c'), (q, k, v))
+        h_ = attention(q, k, v, scale=int(c)**(-0.5))
+        h_ = rearrange(h_, 'b (h w) c -> b c h w', h=h)
         h_ = self.proj_out(h_)
 
         return x+h_
@@ -187,18 +253,12 @@ class CrossAttention(nn.Module):
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
-
         if exists(mask):
             mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
             mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
 
         # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
-
-        out = einsum('b i j, b j d -> b i d', attn, v)
+        out = attention(q, k, v, mask=mask, scale=self.scale)
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
         return self.to_out(out)
 
@@ -0,0 +1,172 @@
+"""
+Activation checkpointing policy for UNetModel.
+
+Which blocks recompute their activations in the backward pass is configured
+through the `checkpoint_policy` parameter of the unet_config, e.g.
+
+    checkpoint_policy:
+      block_types: [AttentionBlock, ResBlock]
+      resolutions: [4, 8]    # downsample rates, as in attention_resolutions
+
+checkpointing_report measures, for every block, the activation memory that
+checkpointing saves and the forward time it costs to recompute them.
+"""
+
+import time
+
+import torch
+
+CHECKPOINT_BLOCK_TYPES = ["ResBlock", "AttentionBlock", "BasicTransformerBlock"]
+
+
+def is_checkpointed(block):
+    if type(block).__name__ == "BasicTransformerBlock":
+        return block.checkpoint
+    return block.use_checkpoint
+
+
+def set_checkpointed(block, flag):
+    if type(block).__name__ == "BasicTransformerBlock":
+        block.checkpoint = flag
+    else:
+        block.use_checkpoint = flag
+
+
+def checkpoint_blocks(unet):
+    """
+    Yields (name, block, ds) for all blocks of the UNet that support checkpointing,
+    where ds is the downsample rate the block operates at.
+    """
+    from taming.modules.diffusionmodules.openaimodel import ResBlock, Upsample, Downsample
+
+    def resamples(block, cls):
+        # a Downsample/Upsample layer, or a ResBlock built with resblock_updown
+        return any(isinstance(layer, cls) or (isinstance(layer, ResBlock) and isinstance(layer.h_upd, cls))
+                   for layer in block)
+
+    def layers(prefix, block, ds):
+        for j, layer in enumerate(block):
+            if type(layer).__name__ == "SpatialTransformer":
+                for k, transformer_block in enumerate(layer.transformer_blocks):
+                    yield f"{prefix}.{j}.transformer_blocks.{k}", transformer_block, ds
+            elif type(layer).__name__ in CHECKPOINT_BLOCK_TYPES:
+                yield f"{prefix}.{j}", layer, ds
+
+    ds = 1
+    for i, block in enumerate(unet.input_blocks):
+        yield from layers(f"input_blocks.{i}", block, ds)
+        if resamples(block, Downsample):
+            ds *= 2
+    yield from layers("middle_block", unet.middle_block, ds)
+    for i, block in enumerate(unet.output_blocks):
+        yield from layers(f"output_blocks.{i}", block, ds)
+        if resamples(block, Upsample):
+            ds //= 2
+
+
+class CheckpointPolicy(object):
+    """
+    Selects the blocks of a UNetModel that use activation checkpointing in training.
+    Checkpointing is never used when gradients are disabled, see util.checkpoint.
+    :param block_types: block types to checkpoint, any of CHECKPOINT_BLOCK_TYPES.
+    :param resolutions: downsample rates at which the selected block types are
+        checkpointed, None for all.
+    :param exclude: names of blocks (see checkpoint_blocks) never to checkpoint.
+    """
+    def __init__(self, block_types=("AttentionBlock", "BasicTransformerBlock"), resolutions=None, exclude=()):
+        for block_type in block_types:
+            assert block_type in CHECKPOINT_BLOCK_TYPES, \
+                f'cannot checkpoint {block_type}, choose from {CHECKPOINT_BLOCK_TYPES}'
+        self.block_types = list(block_types)
+        self.resolutions = None if resolutions is None else list(resolutions)
+        self.exclude = set(exclude)
+
+    def selects(self, name, block, ds):
+        if name in self.exclude or type(block).__name__ not in self.block_types:
+            return False
+        return self.resolutions is None or ds in self.resolutions
+
+    def apply(self, unet):
+        for name, block, ds in checkpoint_blocks(unet):
+            set_checkpointed(block, self.selects(name, block, ds))
+        return unet
+
+
+def _tensors(args):
+    return [a for a in args if isinstance(a, torch.Tensor)]
+
+
+def _saved_activation_bytes(fn, args, kwargs):
+    """bytes autograd saves for the backward pass of fn, excluding the inputs and the weights"""
+    seen = {t.data_ptr() for t in _tensors(args) + _tensors(kwargs.values())}
+    # parameters and buffers stay in memory with or without checkpointing
+    module = getattr(fn, '__self__', fn)
+    if isinstance(module, torch.nn.Module):
+        seen.update(t.data_ptr() for t in list(module.parameters()) + list(module.buffers()))
+    saved = {}
+
+    def pack(t):
+        if t.data_ptr() not in seen:
+            saved[t.data_ptr()] = t.numel() * t.element_size()
+        return t
+
+    with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        fn(*args, **kwargs)
+    return sum(saved.values())
+
+
+def checkpointing_report(unet, x, timesteps, context=None, repeats=3):
+    """
+    Profiles every checkpointable block on the inputs it receives in unet(x, timesteps, context).
+    :return: a list of dicts with the activation memory checkpointing saves (MB) and the
+        time of the extra forward pass it costs in backward (ms), per block.
+    """
+    blocks = list(checkpoint_blocks(unet))
+    inputs = {}
+
+    def recorder(name, forward):
+        def record(*args, **kwargs):
+            inputs[name] = (args, kwargs)
+            return forward(*args, **kwargs)
+        return record
+
+    for name, block, _ in blocks:
+        block.forward = recorder(name, block.forward)
+    try:
+        with torch.no_grad():
+            unet(x, timesteps, context)
+    finally:
+        for _, block, _ in blocks:
+            del block.forward
+
+    rows = []
+    for name, block, ds in blocks:
+        args, kwargs = inputs[name]
+        args = [a.detach().requires_grad_(a.is_floating_point()) if isinstance(a, torch.Tensor) else a for a in args]
+        saved = _saved_activation_bytes(block._forward, args, kwargs)
+        with torch.no_grad():
+            block._forward(*args, **kwargs)
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                block._forward(*args, **kwargs)
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+        recompute = (time.perf_counter() - start) / repeats
+        rows.append({"name": name, "type": type(block).__name__, "ds": ds, "checkpointed": is_checkpointed(block),
+                     "saved_mb": saved / 2 ** 20, "recompute_ms": 1000 * recompute})
+    return rows
+
+
+def format_checkpointing_report(rows):
+    lines = [f"{'block':<40} {'type':<22} {'ds':>3} {'ckpt':>5} {'saved MB':>9} {'recompute ms':>13} {'MB/ms':>7}"]
+    for row in rows:
+        ratio = row["saved_mb"] / max(row["recompute_ms"], 1e-6)
+        lines.append(f"{row['name']:<40} {row['type']:<22} {row['ds']:>3} {str(row['checkpointed']):>5} "
+                     f"{row['saved_mb']:>9.2f} {row['recompute_ms']:>13.2f} {ratio:>7.2f}")
+    checkpointed = [row for row in rows if row["checkpointed"]]
+    lines.append(f"checkpointed {len(checkpointed)}/{len(rows)} blocks: "
+                 f"{sum(row['saved_mb'] for row in checkpointed):.1f} MB saved for "
+                 f"{sum(row['recompute_ms'] for row in checkpointed):.1f} ms of recompute per step")
+    return "\n".join(lines)
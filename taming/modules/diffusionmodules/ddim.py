@@ -1,20 +1,41 @@
 """SAMPLING ONLY."""
 
+import warnings
+
 import torch
 import numpy as np
 from tqdm import tqdm
 from functools import partial
+from contextlib import contextmanager
 
 from taming.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
-    extract_into_tensor
+    extract_into_tensor, cached_timestep_embedding, make_feature_reuse_mask, deep_feature_reuse
+from taming.modules.diffusionmodules.guidance import GuidedDenoiser
 
 
 class DDIMSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    def __init__(self, model, schedule="linear", fast_path=False, nan_check_every=0, cache_timestep_embedding=True,
+                 feature_reuse_branch=None, feature_reuse_segments=((0., 2),), **kwargs):
+        """
+        :param fast_path: sample without per-step host synchronisation, see fast_ddim_sampling.
+                          Calls with mask, x0, score_corrector or corrector_kwargs use the
+                          regular loop instead.
+        :param nan_check_every: fast path only. None disables the non-finite check, 0 only checks
+                                once at the end, N > 0 checks every N steps and at the end.
+        :param cache_timestep_embedding: precompute the UNet timestep embeddings for the schedule.
+        :param feature_reuse_branch: if set, reuse the deep UNet features between steps and only
+                                     recompute this many input blocks on cheap steps.
+        :param feature_reuse_segments: (start fraction, K) pairs, see make_feature_reuse_mask.
+        """
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        self.fast_path = fast_path
+        self.nan_check_every = nan_check_every
+        self.cache_timestep_embedding = cache_timestep_embedding
+        self.feature_reuse_branch = feature_reuse_branch
+        self.feature_reuse_segments = feature_reuse_segments
 
     def register_buffer(self, name, attr):
         # if type(attr) == torch.Tensor:
@@ -53,6 +74,35 @@ class DDIMSampler(object):
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
 
+        # device copies of the per-step coefficients for the fast path, indexed by ddim step
+        device = self.model.betas.device
+        to_device = lambda x: torch.as_tensor(np.asarray(x, dtype=np.float64), dtype=torch.float32,
+                                              device=device).reshape(-1, 1, 1, 1)
+        ddim_alphas_np = np.asarray(ddim_alphas, dtype=np.float64)
+        ddim_alphas_prev_np = np.asarray(ddim_alphas_prev, dtype=np.float64)
+        ddim_sigmas_np = np.asarray(ddim_sigmas, dtype=np.float64)
+        self.register_buffer('fast_timesteps', torch.as_tensor(self.ddim_timesteps, dtype=torch.long, device=device))
+        self.register_buffer('fast_sqrt_alphas', to_device(np.sqrt(ddim_alphas_np)))
+        self.register_buffer('fast_sqrt_one_minus_alphas', to_device(np.sqrt(1. - ddim_alphas_np)))
+        self.register_buffer('fast_sqrt_alphas_prev', to_device(np.sqrt(ddim_alphas_prev_np)))
+        self.register_buffer('fast_dir_xt', to_device(np.sqrt(1. - ddim_alphas_prev_np - ddim_sigmas_np ** 2)))
+        self.register_buffer('fast_sigmas', to_device(ddim_sigmas_np))
+        self.fast_eta_is_zero = ddim_eta == 0.
+
+    @contextmanager
+    def nan_check_disabled(self):
+        diffusion_model = getattr(getattr(self.model, 'model', None), 'diffusion_model', None)
+        if diffusion_model is None or not hasattr(diffusion_model, 'nan_check_disabled'):
+            yield None
+        else:
+            with diffusion_model.nan_check_disabled():
+                yield None
+
+    def make_denoiser(self, cond, unconditional_guidance_scale=1., unconditional_conditioning=None,
+                      guidance_interval=None):
+        return GuidedDenoiser(self.model, cond, unconditional_conditioning=unconditional_conditioning,
+                              guidance_scale=unconditional_guidance_scale, guidance_interval=guidance_interval)
+
     @torch.no_grad()
     def sample(self,
                S,
@@ -76,8 +126,16 @@ class DDIMSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               guidance_interval=None,
+               fast_path=None,
+               nan_check_every=None,
                **kwargs
                ):
+        """
+        :param fast_path: overrides the fast_path of the sampler. The fast path has no
+                          inpainting or score correction, if mask, x0, score_corrector or
+                          corrector_kwargs are given the regular loop is used with a warning.
+        """
         if conditioning is not None:
             if isinstance(conditioning, dict):
                 cbs = conditioning[list(conditioning.keys())[0]].shape[0]
@@ -93,6 +151,27 @@ class DDIMSampler(object):
         size = (batch_size, C, H, W)
         #print(f'Data shape for DDIM sampling is {size}, eta {eta}')
 
+        fast_path = fast_path if fast_path is not None else self.fast_path
+        if fast_path and not all(v is None for v in (mask, x0, score_corrector, corrector_kwargs)):
+            # the fast path has no support for inpainting and score correction
+            warnings.warn("DDIMSampler: mask, x0, score_corrector or corrector_kwargs given, "
+                          "sampling with ddim_sampling instead of the fast path")
+            fast_path = False
+        if fast_path:
+            nan_check_every = nan_check_every if nan_check_every is not None else self.nan_check_every
+            return self.fast_ddim_sampling(conditioning, size,
+                                           callback=callback,
+                                           img_callback=img_callback,
+                                           noise_dropout=noise_dropout,
+                                           temperature=temperature,
+                                           x_T=x_T,
+                                           log_every_t=log_every_t,
+                                           nan_check_every=nan_check_every,
+                                           unconditional_guidance_scale=unconditional_guidance_scale,
+                                           unconditional_conditioning=unconditional_conditioning,
+                                           guidance_interval=guidance_interval,
+                                           )
+
         samples, intermediates = self.ddim_sampling(conditioning, size,
                                                     callback=callback,
                                                     img_callback=img_callback,
@@ -107,6 +186,7 @@ class DDIMSampler(object):
                                                     log_every_t=log_every_t,
                                                     unconditional_guidance_scale=unconditional_guidance_scale,
                                                     unconditional_conditioning=unconditional_conditioning,
+                                                    guidance_interval=guidance_interval,
                                                     )
         return samples, intermediates
 
@@ -116,7 +196,7 @@ class DDIMSampler(object):
                       callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance_interval=None):
         device = self.model.betas.device
         b = shape[0]
         if x_T is None:
@@ -130,52 +210,57 @@ class DDIMSampler(object):
             subset_end = int(min(timesteps / self.ddim_timesteps.shape[0], 1) * self.ddim_timesteps.shape[0]) - 1
             timesteps = self.ddim_timesteps[:subset_end]
 
+        denoiser = self.make_denoiser(cond, unconditional_guidance_scale, unconditional_conditioning,
+                                      guidance_interval)
+
         intermediates = {'x_inter': [img], 'pred_x0': [img]}
         time_range = reversed(range(0,timesteps)) if ddim_use_original_steps else np.flip(timesteps)
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         #print(f"Running DDIM Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
+        schedule = np.arange(timesteps) if ddim_use_original_steps else timesteps
+
+        refresh = make_feature_reuse_mask(total_steps, self.feature_reuse_segments)
+        with cached_timestep_embedding(self.model, schedule, self.cache_timestep_embedding) as emb_cache, \
+                deep_feature_reuse(self.model, self.feature_reuse_branch) as feature_reuse:
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = torch.full((b,), step, device=device, dtype=torch.long)
+                if emb_cache is not None:
+                    emb_cache.set_step(step)
+                if feature_reuse is not None:
+                    feature_reuse.refresh = refresh[i]
+
+                # if mask is not None:
+                #     assert x0 is not None
+                #     img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass?
+                #     img = img_orig * mask + (1. - mask) * img
+
+                outs = self.p_sample_ddim(img, cond, ts, index=index, use_original_steps=ddim_use_original_steps,
+                                          quantize_denoised=quantize_denoised, temperature=temperature,
+                                          noise_dropout=noise_dropout, score_corrector=score_corrector,
+                                          corrector_kwargs=corrector_kwargs, denoiser=denoiser, step=int(step))
+                img, pred_x0 = outs
+                if callback: callback(i)
+                if img_callback: img_callback(pred_x0, i)
 
-        for i, step in enumerate(iterator):
-            index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
-
-            # if mask is not None:
-            #     assert x0 is not None
-            #     img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass?
-            #     img = img_orig * mask + (1. - mask) * img
-
-            outs = self.p_sample_ddim(img, cond, ts, index=index, use_original_steps=ddim_use_original_steps,
-                                      quantize_denoised=quantize_denoised, temperature=temperature,
-                                      noise_dropout=noise_dropout, score_corrector=score_corrector,
-                                      corrector_kwargs=corrector_kwargs,
-                                      unconditional_guidance_scale=unconditional_guidance_scale,
-                                      unconditional_conditioning=unconditional_conditioning)
-            img, pred_x0 = outs
-            if callback: callback(i)
-            if img_callback: img_callback(pred_x0, i)
-
-            if index % log_every_t == 0 or index == total_steps - 1:
-                intermediates['x_inter'].append(img.detach().cpu().numpy())
-                intermediates['pred_x0'].append(pred_x0.detach().cpu().numpy())
+                if index % log_every_t == 0 or index == total_steps - 1:
+                    intermediates['x_inter'].append(img.detach().cpu().numpy())
+                    intermediates['pred_x0'].append(pred_x0.detach().cpu().numpy())
 
         return img, intermediates
 
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, denoiser=None, step=None):
         b, *_, device = *x.shape, x.device
         assert not torch.isnan(x).any()
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-            e_t = self.model.model(x, t, c)
-        else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
-            e_t_uncond, e_t = self.model(x_in, t_in, c_in).chunk(2)
-            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+        if denoiser is None:
+            denoiser = GuidedDenoiser(self.model, c, unconditional_conditioning=unconditional_conditioning,
+                                      guidance_scale=unconditional_guidance_scale, precompute=False)
+        e_t = denoiser(x, t, step)
 
         if score_corrector is not None:
             assert self.model.parameterization == "eps"
@@ -203,6 +288,71 @@ class DDIMSampler(object):
         x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
         return x_prev, pred_x0
 
+    @torch.no_grad()
+    def fast_ddim_sampling(self, cond, shape, x_T=None, timesteps=None, callback=None, img_callback=None,
+                           log_every_t=None, temperature=1., noise_dropout=0., nan_check_every=0,
+                           unconditional_guidance_scale=1., unconditional_conditioning=None, guidance_interval=None):
+        """
+        DDIM sampling without per-step host synchronisation: coefficients are read
+        from the precomputed device tables, no progress bar, no noise is drawn for
+        eta=0 and the check for non-finite values is accumulated on the device and
+        only read back every nan_check_every steps (None disables it, 0 checks at
+        the end). Intermediates stay on the device, log_every_t=None drops them.
+        sample uses ddim_sampling instead if mask, x0, score_corrector or corrector_kwargs
+        are given, with a warning.
+        """
+        device = self.model.betas.device
+        b = shape[0]
+        if x_T is None:
+            img = torch.randn(shape, device=device)
+        else:
+            img = x_T
+
+        total_steps = self.ddim_timesteps.shape[0]
+        if timesteps is not None:
+            total_steps = int(min(timesteps / total_steps, 1) * total_steps) - 1
+
+        denoiser = self.make_denoiser(cond, unconditional_guidance_scale, unconditional_conditioning,
+                                      guidance_interval)
+        intermediates = {'x_inter': [img], 'pred_x0': [img]} if log_every_t else None
+        nonfinite = torch.zeros((), dtype=torch.bool, device=device) if nan_check_every is not None else None
+
+        refresh = make_feature_reuse_mask(total_steps, self.feature_reuse_segments)
+        with self.nan_check_disabled(), cached_timestep_embedding(self.model, self.ddim_timesteps[:total_steps],
+                                                                  self.cache_timestep_embedding) as emb_cache, \
+                deep_feature_reuse(self.model, self.feature_reuse_branch) as feature_reuse:
+            for i in range(total_steps):
+                index = total_steps - i - 1
+                ts = self.fast_timesteps[index].expand(b)
+                if emb_cache is not None:
+                    emb_cache.set_step(self.ddim_timesteps[index])
+                if feature_reuse is not None:
+                    feature_reuse.refresh = refresh[i]
+                e_t = denoiser(img, ts, int(self.ddim_timesteps[index]))
+
+                pred_x0 = (img - self.fast_sqrt_one_minus_alphas[index] * e_t) / self.fast_sqrt_alphas[index]
+                img = self.fast_sqrt_alphas_prev[index] * pred_x0 + self.fast_dir_xt[index] * e_t
+                if not self.fast_eta_is_zero:
+                    noise = self.fast_sigmas[index] * torch.randn_like(img) * temperature
+                    if noise_dropout > 0.:
+                        noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+                    img = img + noise
+
+                if nonfinite is not None:
+                    nonfinite |= ~torch.isfinite(img).all()
+                    if nan_check_every > 0 and (i + 1) % nan_check_every == 0:
+                        assert not nonfinite.item(), f'Non-finite values in DDIM sampling before step {i}'
+                if callback: callback(i)
+                if img_callback: img_callback(pred_x0, i)
+
+                if intermediates is not None and (index % log_every_t == 0 or index == total_steps - 1):
+                    intermediates['x_inter'].append(img)
+                    intermediates['pred_x0'].append(pred_x0)
+
+        if nonfinite is not None:
+            assert not nonfinite.item(), 'Non-finite values in DDIM sampling'
+        return img, intermediates
+
     @torch.no_grad()
     def stochastic_encode(self, x0, t, use_original_steps=False, noise=None):
         # fast, but does not allow for exact reconstruction
@@ -216,12 +366,15 @@ class DDIMSampler(object):
 
         if noise is None:
             noise = torch.randn_like(x0)
+        # the ddim tables are kept on the host
+        sqrt_alphas_cumprod = torch.as_tensor(sqrt_alphas_cumprod, dtype=x0.dtype, device=x0.device)
+        sqrt_one_minus_alphas_cumprod = torch.as_tensor(sqrt_one_minus_alphas_cumprod, dtype=x0.dtype, device=x0.device)
         return (extract_into_tensor(sqrt_alphas_cumprod, t, x0.shape) * x0 +
                 extract_into_tensor(sqrt_one_minus_alphas_cumprod, t, x0.shape) * noise)
 
     @torch.no_grad()
     def decode(self, x_latent, cond, t_start, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
-               use_original_steps=False):
+               use_original_steps=False, guidance_interval=None):
 
         timesteps = np.arange(self.ddpm_num_timesteps) if use_original_steps else self.ddim_timesteps
         timesteps = timesteps[:t_start]
@@ -231,11 +384,19 @@ class DDIMSampler(object):
         #print(f"Running DDIM Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
+        denoiser = self.make_denoiser(cond, unconditional_guidance_scale, unconditional_conditioning,
+                                      guidance_interval)
         x_dec = x_latent
-        for i, step in enumerate(iterator):
-            index = total_steps - i - 1
-            ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
-            x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
-                                          unconditional_guidance_scale=unconditional_guidance_scale,
-                                          unconditional_conditioning=unconditional_conditioning)
+        refresh = make_feature_reuse_mask(total_steps, self.feature_reuse_segments)
+        with cached_timestep_embedding(self.model, timesteps, self.cache_timestep_embedding) as emb_cache, \
+                deep_feature_reuse(self.model, self.feature_reuse_branch) as feature_reuse:
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
+                if emb_cache is not None:
+                    emb_cache.set_step(step)
+                if feature_reuse is not None:
+                    feature_reuse.refresh = refresh[i]
+                x_dec, _ = self.p_sample_ddim(x_dec, cond, ts, index=index, use_original_steps=use_original_steps,
+                                              denoiser=denoiser, step=int(step))
         return x_dec
\ No newline at end of file
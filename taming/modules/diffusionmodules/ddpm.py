@@ -18,11 +18,14 @@ from tqdm import tqdm
 from torchvision.utils import make_grid
 from pytorch_lightning.utilities.distributed import rank_zero_only
 
-from taming.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat, count_params, instantiate_from_config
+from taming.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat, count_params, instantiate_from_config, \
+    images_to_tensor
 from taming.modules.ema import LitEma
 from taming.models.vqgan import VQModelInterface
 from taming.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
 from taming.modules.diffusionmodules.ddim import DDIMSampler
+from taming.modules.diffusionmodules.openaimodel import ConditioningCache
+from taming.modules.diffusionmodules.timestep_sampler import create_timestep_sampler, UniformSampler
 
 
 __conditioning_keys__ = {'concat': 'c_concat',
@@ -69,6 +72,9 @@ class DDPM(pl.LightningModule):
                  scheduler_config=None,
                  use_positional_encodings=False,
                  ddim_timesteps=200,
+                 ema_update_every=1,
+                 ema_offload=False,
+                 timestep_sampler_config=None,
                  ):
         super().__init__()
         assert parameterization in ["eps", "x0"], 'currently only supporting "eps" and "x0"'
@@ -86,8 +92,8 @@ class DDPM(pl.LightningModule):
         count_params(self.model, verbose=True)
         self.use_ema = use_ema
         if self.use_ema:
-            self.model_ema = LitEma(self.model)
-            print(f"Keeping EMAs of {len(list(self.model_ema.buffers()))}.")
+            self.model_ema = LitEma(self.model, update_every=ema_update_every, offload=ema_offload)
+            print(f"Keeping EMAs of {len(self.model_ema.m_name2s_name)}.")
 
         self.use_scheduler = scheduler_config is not None
         if self.use_scheduler:
@@ -104,6 +110,8 @@ class DDPM(pl.LightningModule):
 
         self.register_schedule(given_betas=given_betas, beta_schedule=beta_schedule, timesteps=timesteps,
                                linear_start=linear_start, linear_end=linear_end, cosine_s=cosine_s)
+        # distribution of the training timesteps, uniform by default
+        self.timestep_sampler = create_timestep_sampler(timestep_sampler_config, self.num_timesteps)
 
         self.loss_type = loss_type
 
@@ -163,16 +171,15 @@ class DDPM(pl.LightningModule):
 
     @contextmanager
     def ema_scope(self, context=None):
-        if self.use_ema:
-            self.model_ema.store(self.model.parameters())
-            self.model_ema.copy_to(self.model)
+        if not self.use_ema:
+            yield None
+            return
+        with self.model_ema.swap(self.model):
             if context is not None:
                 print(f"{context}: Switched to EMA weights")
-        try:
-            yield None
-        finally:
-            if self.use_ema:
-                self.model_ema.restore(self.model.parameters())
+            try:
+                yield None
+            finally:
                 if context is not None:
                     print(f"{context}: Restored training weights")
 
@@ -295,7 +302,7 @@ class DDPM(pl.LightningModule):
 
         return loss
 
-    def p_losses(self, x_start, t, noise=None):
+    def p_losses(self, x_start, t, noise=None, weights=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
         x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
         model_out = self.model(x_noisy, t)
@@ -313,7 +320,10 @@ class DDPM(pl.LightningModule):
         log_prefix = 'train' if self.training else 'val'
 
         loss_dict.update({f'{log_prefix}/loss_simple': loss.mean()})
-        loss_simple = loss.mean() * self.l_simple_weight
+        if self.training:
+            self.timestep_sampler.update_with_local_losses(t, loss)
+        # importance weights of the timestep sampler
+        loss_simple = (loss if weights is None else loss * weights).mean() * self.l_simple_weight
 
         loss_vlb = (self.lvlb_weights[t] * loss).mean()
         loss_dict.update({f'{log_prefix}/loss_vlb': loss_vlb})
@@ -327,16 +337,50 @@ class DDPM(pl.LightningModule):
     def forward(self, x, *args, **kwargs):
         # b, c, h, w, device, img_size, = *x.shape, x.device, self.image_size
         # assert h == img_size and w == img_size, f'height and width of image must be {img_size}'
-        t = torch.randint(0, self.num_timesteps, (x.shape[0],), device=self.device).long()
-        return self.p_losses(x, t, *args, **kwargs)
+        if not self.training:
+            t = torch.randint(0, self.num_timesteps, (x.shape[0],), device=self.device).long()
+            return self.p_losses(x, t, *args, **kwargs)
+        t, weights = self.timestep_sampler.sample(x.shape[0], self.device)
+        return self.p_losses(x, t, *args, weights=weights, **kwargs)
+
+    def log_timestep_distribution(self, prefix, buckets=10):
+        """probability mass of the timestep sampler in buckets equal ranges of timesteps"""
+        if isinstance(self.timestep_sampler, UniformSampler):
+            return
+        p = self.timestep_sampler.probabilities()
+        bucket = torch.arange(self.num_timesteps, device=p.device) * buckets // self.num_timesteps
+        mass = torch.zeros(buckets, device=p.device, dtype=p.dtype).index_add_(0, bucket, p)
+        for i in range(buckets):
+            start, end = i * self.num_timesteps // buckets, (i + 1) * self.num_timesteps // buckets - 1
+            self.log(f'{prefix}/timestep_p_{start:04}-{end:04}', mass[i],
+                     prog_bar=False, logger=True, on_step=True, on_epoch=False)
+
+    def meshgrid(self, h, w):
+        y = torch.arange(0, h).view(h, 1, 1).repeat(1, w, 1)
+        x = torch.arange(0, w).view(1, w, 1).repeat(h, 1, 1)
+
+        arr = torch.cat([y, x], dim=-1)
+        return arr
+
+    def delta_border(self, h, w):
+        """
+        :param h: height
+        :param w: width
+        :return: normalized distance to image border,
+         wtith min distance = 0 at border and max dist = 0.5 at image center
+        """
+        lower_right_corner = torch.tensor([h - 1, w - 1]).view(1, 1, 2)
+        arr = self.meshgrid(h, w) / lower_right_corner
+        dist_left_up = torch.min(arr, dim=-1, keepdims=True)[0]
+        dist_right_down = torch.min(1 - arr, dim=-1, keepdims=True)[0]
+        edge_dist = torch.min(torch.cat([dist_left_up, dist_right_down], dim=-1), dim=-1)[0]
+        return edge_dist
 
     def get_input(self, batch, k):
         x = batch[k]
         if len(x.shape) == 3:
             x = x[..., None]
-        x = rearrange(x, 'b h w c -> b c h w')
-        x = x.to(memory_format=torch.contiguous_format).float()
-        return x
+        return images_to_tensor(x, self.device)
 
     def shared_step(self, batch):
         x = self.get_input(batch, self.first_stage_key)
@@ -352,6 +396,8 @@ class DDPM(pl.LightningModule):
         self.log("global_step", self.global_step,
                  prog_bar=True, logger=True, on_step=True, on_epoch=False)
 
+        self.log_timestep_distribution('train')
+
         if self.use_scheduler:
             lr = self.optimizers().param_groups[0]['lr']
             self.log('lr_abs', lr, prog_bar=True, logger=True, on_step=True, on_epoch=False)
@@ -562,27 +608,6 @@ class LatentDiffusion(DDPM):
             c = getattr(self.cond_stage_model, self.cond_stage_forward)(c)
         return c
 
-    def meshgrid(self, h, w):
-        y = torch.arange(0, h).view(h, 1, 1).repeat(1, w, 1)
-        x = torch.arange(0, w).view(1, w, 1).repeat(h, 1, 1)
-
-        arr = torch.cat([y, x], dim=-1)
-        return arr
-
-    def delta_border(self, h, w):
-        """
-        :param h: height
-        :param w: width
-        :return: normalized distance to image border,
-         wtith min distance = 0 at border and max dist = 0.5 at image center
-        """
-        lower_right_corner = torch.tensor([h - 1, w - 1]).view(1, 1, 2)
-        arr = self.meshgrid(h, w) / lower_right_corner
-        dist_left_up = torch.min(arr, dim=-1, keepdims=True)[0]
-        dist_right_down = torch.min(1 - arr, dim=-1, keepdims=True)[0]
-        edge_dist = torch.min(torch.cat([dist_left_up, dist_right_down], dim=-1), dim=-1)[0]
-        return edge_dist
-
     def get_weighting(self, h, w, Ly, Lx, device):
         weighting = self.delta_border(h, w)
         weighting = torch.clip(weighting, self.split_input_params["clip_min_weight"],
@@ -1393,6 +1418,22 @@ class DiffusionWrapper(pl.LightningModule):
         self.conditioning_key = conditioning_key
         assert self.conditioning_key in [None, 'concat', 'crossattn', 'hybrid', 'adm', 'cat_init']
 
+    def precompute_conditioning(self, c_concat=None, c_crossattn=None):
+        """
+        Run the conditioning-only part of the diffusion model once, so that the
+        returned cache can be passed in place of c_concat/c_crossattn on every
+        sampling step. Keys without a conditioning branch get the input back.
+        """
+        if not hasattr(self.diffusion_model, 'precompute_conditioning'):
+            return c_concat if c_crossattn is None else c_crossattn
+        if self.conditioning_key == 'cat_init':
+            return self.diffusion_model.precompute_conditioning(c_concat)
+        elif self.conditioning_key == 'crossattn':
+            if isinstance(c_crossattn, ConditioningCache):
+                return c_crossattn
+            return self.diffusion_model.precompute_conditioning(torch.cat(c_crossattn, 1))
+        return c_concat if c_crossattn is None else c_crossattn
+
     def forward(self, x, t, c_concat=None, c_crossattn= None):
         if self.conditioning_key is None:
             out = self.diffusion_model(x, t)
@@ -1402,7 +1443,7 @@ class DiffusionWrapper(pl.LightningModule):
         elif self.conditioning_key == 'cat_init':
             out = self.diffusion_model(x, t, context = c_concat)
         elif self.conditioning_key == 'crossattn':
-            cc = torch.cat(c_crossattn, 1)
+            cc = c_crossattn if isinstance(c_crossattn, ConditioningCache) else torch.cat(c_crossattn, 1)
             out = self.diffusion_model(x, t, context=cc)
         elif self.conditioning_key == 'hybrid':
             xc = torch.cat([x] + c_concat, dim=1)
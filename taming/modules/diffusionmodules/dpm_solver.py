@@ -0,0 +1,176 @@
+"""SAMPLING ONLY.
+
+Multistep DPM-Solver++ (https://arxiv.org/abs/2211.01095) for the discrete-time
+schedule registered in DDPM.register_schedule. Drop-in replacement for DDIMSampler.
+"""
+
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from taming.modules.diffusionmodules.guidance import GuidedDenoiser
+from taming.modules.diffusionmodules.util import cached_timestep_embedding, make_feature_reuse_mask, \
+    deep_feature_reuse
+
+
+class DPMSolverSampler(object):
+    def __init__(self, model, order=2, discretize="uniform", lower_order_final=True, clip_denoised=False,
+                 cache_timestep_embedding=True, feature_reuse_branch=None, feature_reuse_segments=((0., 1),),
+                 **kwargs):
+        super().__init__()
+        assert order in [1, 2, 3], 'DPM-Solver++ is implemented for orders 1, 2 and 3'
+        assert model.parameterization == "eps", 'DPM-Solver++ sampler expects an eps-prediction model'
+        self.model = model
+        self.ddpm_num_timesteps = model.num_timesteps
+        self.order = order
+        self.discretize = discretize
+        self.lower_order_final = lower_order_final
+        self.clip_denoised = clip_denoised
+        self.cache_timestep_embedding = cache_timestep_embedding
+        self.feature_reuse_branch = feature_reuse_branch
+        self.feature_reuse_segments = feature_reuse_segments
+
+    def make_timesteps(self, num_steps):
+        # num_steps solver steps need num_steps + 1 time points, from t=T-1 down to t=0
+        T = self.ddpm_num_timesteps - 1
+        if self.discretize == "uniform":
+            timesteps = np.linspace(T, 0, num_steps + 1)
+        elif self.discretize == "quad":
+            timesteps = np.linspace(np.sqrt(T), 0, num_steps + 1) ** 2
+        else:
+            raise NotImplementedError(f'There is no discretization method called "{self.discretize}"')
+        timesteps = np.round(timesteps).astype(np.int64)
+        assert np.all(np.diff(timesteps) < 0), f'{num_steps} steps are too many for {self.ddpm_num_timesteps} timesteps'
+        return timesteps
+
+    def make_schedule(self, num_steps, verbose=True):
+        """
+        All solver coefficients only depend on the schedule, so they are computed
+        once on the host in float64 and used as python scalars in the loop.
+        """
+        self.timesteps = self.make_timesteps(num_steps)
+        alphas_cumprod = self.model.alphas_cumprod.detach().cpu().double().numpy()[self.timesteps]
+        self.alphas = np.sqrt(alphas_cumprod)
+        self.sigmas = np.sqrt(1. - alphas_cumprod)
+        self.lambdas = np.log(self.alphas) - np.log(self.sigmas)
+        if verbose:
+            print(f'Selected timesteps for DPM-Solver++ sampler: {self.timesteps}')
+
+    def step_orders(self, num_steps):
+        orders = []
+        for i in range(1, num_steps + 1):
+            step_order = min(self.order, i)
+            if self.lower_order_final and num_steps < 15:
+                step_order = min(step_order, num_steps + 1 - i)
+            orders.append(step_order)
+        return orders
+
+    def data_prediction(self, x, denoiser, i, emb_cache=None):
+        if emb_cache is not None:
+            emb_cache.set_step(self.timesteps[i])
+        ts = torch.full((x.shape[0],), int(self.timesteps[i]), device=x.device, dtype=torch.long)
+        e_t = denoiser(x, ts, int(self.timesteps[i]))
+        x0 = (x - self.sigmas[i] * e_t) / self.alphas[i]
+        if self.clip_denoised:
+            x0 = x0.clamp(-1., 1.)
+        return x0
+
+    def update(self, x, model_outputs, i, order):
+        """
+        One multistep DPM-Solver++ update from time point i-1 to i, using the last
+        `order` data predictions (most recent last).
+        """
+        lambda_prev, lambda_t = self.lambdas[i - 1], self.lambdas[i]
+        h = lambda_t - lambda_prev
+        phi_1 = np.expm1(-h)
+        x_t = (self.sigmas[i] / self.sigmas[i - 1]) * x - (self.alphas[i] * phi_1) * model_outputs[-1]
+        if order == 1:
+            return x_t
+
+        m0, m1 = model_outputs[-1], model_outputs[-2]
+        r0 = (lambda_prev - self.lambdas[i - 2]) / h
+        D1_0 = (m0 - m1) / r0
+        if order == 2:
+            return x_t - (0.5 * self.alphas[i] * phi_1) * D1_0
+
+        m2 = model_outputs[-3]
+        r1 = (self.lambdas[i - 2] - self.lambdas[i - 3]) / h
+        D1_1 = (m1 - m2) / r1
+        D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+        D2 = (D1_0 - D1_1) / (r0 + r1)
+        phi_2 = phi_1 / h + 1.
+        phi_3 = phi_2 / h - 0.5
+        return x_t + (self.alphas[i] * phi_2) * D1 - (self.alphas[i] * phi_3) * D2
+
+    @torch.no_grad()
+    def sample(self,
+               S,
+               batch_size,
+               shape,
+               conditioning=None,
+               callback=None,
+               img_callback=None,
+               verbose=True,
+               x_T=None,
+               log_every_t=100,
+               unconditional_guidance_scale=1.,
+               unconditional_conditioning=None,
+               guidance_interval=None,
+               **kwargs
+               ):
+        if conditioning is not None:
+            if isinstance(conditioning, dict):
+                cbs = conditioning[list(conditioning.keys())[0]].shape[0]
+                if cbs != batch_size:
+                    print(f"Warning: Got {cbs} conditionings but batch-size is {batch_size}")
+            else:
+                if conditioning.shape[0] != batch_size:
+                    print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
+
+        self.make_schedule(num_steps=S, verbose=verbose)
+        C, H, W = shape
+        size = (batch_size, C, H, W)
+
+        denoiser = GuidedDenoiser(self.model, conditioning, unconditional_conditioning=unconditional_conditioning,
+                                  guidance_scale=unconditional_guidance_scale, guidance_interval=guidance_interval)
+        return self.dpm_solver_sampling(denoiser, size, callback=callback, img_callback=img_callback,
+                                        x_T=x_T, log_every_t=log_every_t, verbose=verbose)
+
+    @torch.no_grad()
+    def dpm_solver_sampling(self, denoiser, shape, x_T=None, callback=None, img_callback=None, log_every_t=100,
+                            verbose=True):
+        device = self.model.betas.device
+        if x_T is None:
+            img = torch.randn(shape, device=device)
+        else:
+            img = x_T
+
+        num_steps = len(self.timesteps) - 1
+        orders = self.step_orders(num_steps)
+
+        intermediates = {'x_inter': [img], 'pred_x0': [img]}
+        iterator = range(1, num_steps + 1)
+        if verbose:
+            iterator = tqdm(iterator, desc='DPM-Solver++ Sampler', total=num_steps)
+
+        refresh = make_feature_reuse_mask(num_steps, self.feature_reuse_segments)
+        with cached_timestep_embedding(self.model, self.timesteps[:-1], self.cache_timestep_embedding) as emb_cache, \
+                deep_feature_reuse(self.model, self.feature_reuse_branch) as feature_reuse:
+            model_outputs = [self.data_prediction(img, denoiser, 0, emb_cache)]
+            for i in iterator:
+                img = self.update(img, model_outputs, i, orders[i - 1])
+                if i < num_steps:
+                    if feature_reuse is not None:
+                        feature_reuse.refresh = refresh[i]
+                    # the last point needs no model evaluation, num_steps evaluations in total
+                    model_outputs.append(self.data_prediction(img, denoiser, i, emb_cache))
+                    model_outputs = model_outputs[-self.order:]
+                if callback: callback(i - 1)
+                if img_callback: img_callback(model_outputs[-1], i - 1)
+
+                index = num_steps - i
+                if index % log_every_t == 0 or i == 1:
+                    intermediates['x_inter'].append(img.detach().cpu().numpy())
+                    intermediates['pred_x0'].append(model_outputs[-1].detach().cpu().numpy())
+
+        return img, intermediates
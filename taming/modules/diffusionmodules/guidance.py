@@ -0,0 +1,57 @@
+"""SAMPLING ONLY."""
+
+import torch
+
+from taming.modules.diffusionmodules.openaimodel import ConditioningCache
+
+
+class GuidedDenoiser(object):
+    """
+    eps-prediction with classifier-free guidance, shared by the samplers.
+    The conditional and unconditional branch are evaluated in a single forward
+    of twice the batch size. Both conditionings are precomputed once, and with
+    guidance_interval=(t_min, t_max) guidance is only applied for timesteps in
+    that range, all other steps cost one unguided forward.
+    """
+    def __init__(self, model, cond, unconditional_conditioning=None, guidance_scale=1., guidance_interval=None,
+                 precompute=True):
+        self.model = model
+        self.guidance_scale = guidance_scale
+        self.guidance_interval = guidance_interval
+        self.guided = unconditional_conditioning is not None and guidance_scale != 1.
+        self.precompute = precompute
+        self.cond = self.prepare(cond)
+        if self.guided:
+            joint_cond = torch.cat([self.unwrap(unconditional_conditioning), self.unwrap(cond)])
+            self.joint_cond = self.prepare(joint_cond)
+
+    @staticmethod
+    def unwrap(c):
+        if isinstance(c, ConditioningCache):
+            return c.conditioning
+        if isinstance(c, (tuple, list)):
+            return c[0]
+        return c
+
+    def prepare(self, c):
+        # the conditioning is constant over the sampling loop, only compute its features once
+        if c is None or not self.precompute or not hasattr(self.model, 'precompute_conditioning'):
+            return c
+        return self.model.precompute_conditioning(self.unwrap(c))
+
+    def guided_at(self, step):
+        """host-side decision, step is the integer timestep of the current sampling step"""
+        if not self.guided:
+            return False
+        if self.guidance_interval is None or step is None:
+            return True
+        t_min, t_max = self.guidance_interval
+        return t_min <= step <= t_max
+
+    def __call__(self, x, t, step=None):
+        if not self.guided_at(step):
+            return self.model.apply_model(x, t, self.cond)
+        x_in = torch.cat([x] * 2)
+        t_in = torch.cat([t] * 2)
+        e_t_uncond, e_t = self.model.apply_model(x_in, t_in, self.joint_cond).chunk(2)
+        return e_t_uncond + self.guidance_scale * (e_t - e_t_uncond)
@@ -5,7 +5,7 @@ import torch.nn as nn
 import numpy as np
 from einops import rearrange
 from taming.modules.vqvae.quantize import VectorQuantizer2 as VectorQuantizer, SamplingQuantizer
-from taming.modules.attention import LinearAttention
+from taming.modules.attention import LinearAttention, attention
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -183,18 +183,11 @@ class AttnBlock(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = q.reshape(b,c,h*w)
-        q = q.permute(0,2,1)   # b,hw,c
-        k = k.reshape(b,c,h*w) # b,c,hw
-        w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = v.reshape(b,c,h*w)
-        w_ = w_.permute(0,2,1)   # b,hw,hw (first hw of k, second of q)
-        h_ = torch.bmm(v,w_)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-        h_ = h_.reshape(b,c,h,w)
+        q = q.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+        k = k.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+        v = v.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+        h_ = attention(q, k, v, scale=int(c)**(-0.5))  # b,hw,c
+        h_ = h_.permute(0,2,1).reshape(b,c,h,w)
 
         h_ = self.proj_out(h_)
 
@@ -374,12 +367,15 @@ class VQEncoder(nn.Module):
                  monitor=None,
                  remap=None,
                  sane_index_shape=False,  # tell vector quantizer to return indices as bhw):
+                 search_chunk_size=None,
+                 index_config=None,
                  ):
         super().__init__()
         self.encoder = Encoder(**ddconfig)
 
         self.quantize = SamplingQuantizer(n_embed, embed_dim, beta=0.25,
-                                        remap=remap, sane_index_shape=sane_index_shape)
+                                        remap=remap, sane_index_shape=sane_index_shape,
+                                        search_chunk_size=search_chunk_size, index_config=index_config)
         self.quant_conv = torch.nn.Conv2d(ddconfig["z_channels"], embed_dim, 1)
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys=ignore_keys)
@@ -680,6 +676,37 @@ class UpsampleDecoder(nn.Module):
         return h
 
 
+class CoarseDecoder(nn.Module):
+    """
+    Cheap upsampling head from the quantized tokens to a coarse image, the
+    coarse_decoder_config of VQDiffusion for warm-start decoding. Every level
+    runs num_res_blocks ResnetBlocks and doubles the resolution, so num_upsamples
+    should match the downsampling factor of the encoder (4 for f=16).
+    """
+    def __init__(self, in_channels, out_channels=3, ch=64, num_upsamples=4, num_res_blocks=1, dropout=0.0):
+        super().__init__()
+        self.conv_in = torch.nn.Conv2d(in_channels, ch, kernel_size=3, stride=1, padding=1)
+        self.up = nn.ModuleList()
+        for _ in range(num_upsamples):
+            level = nn.Module()
+            level.block = nn.ModuleList([ResnetBlock(in_channels=ch, out_channels=ch, temb_channels=0,
+                                                     dropout=dropout) for _ in range(num_res_blocks)])
+            level.upsample = Upsample(ch, with_conv=True)
+            self.up.append(level)
+        self.norm_out = Normalize(ch)
+        self.conv_out = torch.nn.Conv2d(ch, out_channels, kernel_size=3, stride=1, padding=1)
+
+    def forward(self, x):
+        h = self.conv_in(x)
+        for level in self.up:
+            for block in level.block:
+                h = block(h, None)
+            h = level.upsample(h)
+        h = self.norm_out(h)
+        h = nonlinearity(h)
+        return self.conv_out(h)
+
+
 class LatentRescaler(nn.Module):
     def __init__(self, factor, in_channels, mid_channels, out_channels, depth=2):
         super().__init__()
@@ -1,4 +1,5 @@
 from abc import abstractmethod
+from contextlib import contextmanager
 from functools import partial
 import math
 from typing import Iterable
@@ -18,7 +19,8 @@ from taming.modules.diffusionmodules.util import (
     normalization,
     timestep_embedding,
 )
-from taming.modules.attention import SpatialTransformer, LinearAttention
+from taming.modules.attention import SpatialTransformer, LinearAttention, attention
+from taming.modules.diffusionmodules.checkpointing import CheckpointPolicy
 
 
 # dummy replace
@@ -59,6 +61,141 @@ class AttentionPool2d(nn.Module):
         return x[:, :, 0]
 
 
+class ConditioningCache(object):
+    """
+    Holds the outputs of the UNet conditioning branch for a fixed context.
+    The conditioning is constant across all denoising steps of a sample, so the
+    interpolated and projected features are computed on the first step and
+    looked up on every following one.
+    :param context: the conditioning as it would be passed to UNetModel.forward.
+    """
+
+    def __init__(self, context):
+        if isinstance(context, ConditioningCache):
+            context = context.conditioning
+        elif isinstance(context, (tuple, list)):
+            context = context[0]
+        self.conditioning = context
+        self.features = dict()
+        self.children = dict()
+
+    def get(self, key, fn):
+        if key not in self.features:
+            self.features[key] = fn()
+        return self.features[key]
+
+    def child(self, key, fn):
+        """
+        Cache for a derived conditioning, e.g. the token crop of a tile, which is
+        created from fn() on first use and kept for all further steps.
+        """
+        if key not in self.children:
+            self.children[key] = ConditioningCache(fn())
+        return self.children[key]
+
+    def __getitem__(self, item):
+        # allows `cond[:batch_size]` slicing like the raw conditioning tensor
+        return ConditioningCache(self.conditioning[item])
+
+    @property
+    def shape(self):
+        return self.conditioning.shape
+
+
+class DeepFeatureReuse(object):
+    """
+    State of a feature reuse sampling loop, see UNetModel.reuse_deep_features.
+    :param branch: number of input_blocks that are recomputed on cheap steps.
+    """
+
+    def __init__(self, branch):
+        self.branch = branch
+        # counts the full steps, cached features are only reused if they were stored on the latest one
+        self.full_steps = 0
+        self.refresh = True
+
+    @property
+    def refresh(self):
+        return self._refresh
+
+    @refresh.setter
+    def refresh(self, refresh):
+        # set by the sampler before each step, True runs the full UNet and refreshes the cached features
+        self._refresh = refresh
+        if refresh:
+            self.full_steps += 1
+
+    def cached(self, cond_cache, key, batch_size):
+        """
+        Features stored in cond_cache on the latest full step for a batch of batch_size, else None.
+        With guidance_interval the conditional and the guided batch have separate caches, a
+        cache that was not used on the latest full step holds features of an older step.
+        """
+        if self.refresh or key not in cond_cache.features:
+            return None
+        full_step, h = cond_cache.features[key]
+        if full_step != self.full_steps or h.shape[0] != batch_size:
+            return None
+        return h
+
+    def store(self, cond_cache, key, h):
+        cond_cache.features[key] = (self.full_steps, h)
+
+
+class TimestepEmbeddingCache(object):
+    """
+    Timestep embeddings of a UNetModel for a fixed sampling schedule.
+    The time_embed output and optionally the emb_layers output of every ResBlock
+    are computed once for all timesteps of the schedule. The sampler announces the
+    integer timestep of every step with set_step, which is looked up on the host;
+    for a timestep of the schedule the forward returns the table rows, any other
+    timestep (or no set_step) computes the embeddings as usual.
+    :param unet: the UNetModel.
+    :param timesteps: the integer timesteps of the schedule.
+    :param cache_resblocks: also cache the per-ResBlock projections.
+    """
+
+    def __init__(self, unet, timesteps, cache_resblocks=True):
+        self.timesteps = np.asarray(timesteps, dtype=np.int64)
+        self.cache_resblocks = cache_resblocks
+        self.key = unet.timestep_embedding_key(cache_resblocks)
+        device = unet.time_embed[0].weight.device
+        ts = th.as_tensor(self.timesteps, dtype=th.long, device=device)
+        with th.no_grad():
+            self.emb_table = unet.time_embed(timestep_embedding(ts, unet.model_channels, repeat_only=False))
+            self.block_tables = dict()
+            if cache_resblocks:
+                for module in unet.modules():
+                    if isinstance(module, ResBlock):
+                        self.block_tables[module] = module.emb_layers(self.emb_table)
+        self.index_of = {int(t): i for i, t in enumerate(self.timesteps)}
+        self.index = None
+
+    def matches(self, unet, timesteps, cache_resblocks):
+        return (self.cache_resblocks == cache_resblocks and np.array_equal(self.timesteps, timesteps)
+                and self.key == unet.timestep_embedding_key(cache_resblocks))
+
+    def set_step(self, step):
+        """
+        :param step: the integer timestep of all examples of the next forwards, None computes the embeddings.
+        """
+        self.index = self.index_of.get(int(step)) if step is not None else None
+
+    def emb(self, batch_size, compute):
+        """
+        :param compute: computes the embeddings, used for timesteps outside the schedule.
+        """
+        if self.index is None:
+            return compute()
+        return self.emb_table[self.index][None].expand(batch_size, -1)
+
+    def block_emb(self, block, emb):
+        table = self.block_tables.get(block)
+        if table is None or self.index is None:
+            return block.emb_layers(emb)
+        return table[self.index][None].expand(emb.shape[0], -1)
+
+
 class TimestepBlock(nn.Module):
     """
     Any module where forward() takes timestep embeddings as a second argument.
@@ -198,6 +335,8 @@ class ResBlock(TimestepBlock):
         self.use_conv = use_conv
         self.use_checkpoint = use_checkpoint
         self.use_scale_shift_norm = use_scale_shift_norm
+        # set by UNetModel.cached_timestep_embedding
+        self.emb_cache = None
 
         self.in_layers = nn.Sequential(
             normalization(channels),
@@ -262,7 +401,11 @@ class ResBlock(TimestepBlock):
             h = in_conv(h)
         else:
             h = self.in_layers(x)
-        emb_out = self.emb_layers(emb).type(h.dtype)
+        if self.emb_cache is not None:
+            emb_out = self.emb_cache.block_emb(self, emb)
+        else:
+            emb_out = self.emb_layers(emb)
+        emb_out = emb_out.type(h.dtype)
         while len(emb_out.shape) < len(h.shape):
             emb_out = emb_out[..., None]
         if self.use_scale_shift_norm:
@@ -295,6 +438,7 @@ class AttentionBlock(nn.Module):
         super().__init__()
         self.channels = channels
         self.use_linear = use_linear
+        self.use_checkpoint = use_checkpoint
         if num_head_channels == -1:
             raise ValueError("num_head_channels cannot be -1")
         else:
@@ -305,7 +449,6 @@ class AttentionBlock(nn.Module):
         if self.use_linear:
             self.attention = LinearAttention(channels, heads=num_heads, dim_head=num_head_channels)
         else:
-            self.use_checkpoint = use_checkpoint
             self.norm = normalization(channels)
             self.qkv = conv_nd(1, channels, channels * 3, 1)
             if use_new_attention_order:
@@ -318,8 +461,7 @@ class AttentionBlock(nn.Module):
             self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
-        return checkpoint(self._forward, (x,), self.parameters(), True)   # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
-        #return pt_checkpoint(self._forward, x)  # pytorch
+        return checkpoint(self._forward, (x,), self.parameters(), self.use_checkpoint)
 
     def _forward(self, x):
         if self.use_linear:
@@ -375,12 +517,10 @@ class QKVAttentionLegacy(nn.Module):
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
         scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v)
-        return a.reshape(bs, -1, length)
+        # More stable with f16 than dividing afterwards
+        a = attention((q * scale).transpose(1, 2), (k * scale).transpose(1, 2), v.transpose(1, 2), scale=1.,
+                      upcast_softmax=True)
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -407,14 +547,15 @@ class QKVAttention(nn.Module):
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
         scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
-        return a.reshape(bs, -1, length)
+        # More stable with f16 than dividing afterwards
+        a = attention(
+            (q * scale).view(bs * self.n_heads, ch, length).transpose(1, 2),
+            (k * scale).view(bs * self.n_heads, ch, length).transpose(1, 2),
+            v.reshape(bs * self.n_heads, ch, length).transpose(1, 2),
+            scale=1.,
+            upcast_softmax=True,
+        )
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -440,6 +581,9 @@ class UNetModel(nn.Module):
     :param num_classes: if specified (as an int), then this model will be
         class-conditional with `num_classes` classes.
     :param use_checkpoint: use gradient checkpointing to reduce memory usage.
+    :param checkpoint_policy: kwargs of a CheckpointPolicy selecting the checkpointed
+        blocks by type and resolution. Defaults to checkpointing the attention
+        blocks, and the ResBlocks if use_checkpoint is set.
     :param num_heads: the number of attention heads in each attention layer.
     :param num_heads_channels: if specified, ignore num_heads and instead use
                                a fixed channel width per attention head.
@@ -474,7 +618,8 @@ class UNetModel(nn.Module):
         use_new_attention_order=False,
         use_spatial_transformer=False,    # custom transformer support
         transformer_depth=1,              # custom transformer support
-        n_embed=None                      # custom support for prediction of discrete ids into codebook of first stage vq model
+        n_embed=None,                     # custom support for prediction of discrete ids into codebook of first stage vq model
+        checkpoint_policy=None,
     ):
         super().__init__()
 
@@ -499,6 +644,13 @@ class UNetModel(nn.Module):
         self.num_head_channels = num_head_channels
         self.num_heads_upsample = num_heads_upsample
         self.predict_codebook_ids = n_embed is not None
+        # the NaN check synchronises with the device, samplers may defer it (see nan_check_disabled)
+        self.check_nan = True
+        # see cached_timestep_embedding
+        self.embedding_cache = None
+        self._last_embedding_cache = None
+        # see reuse_deep_features
+        self.feature_reuse = None
 
         time_embed_dim = model_channels * 4
         self.time_embed = nn.Sequential(
@@ -669,6 +821,11 @@ class UNetModel(nn.Module):
             #nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
         )
 
+        if checkpoint_policy is None:
+            block_types = ["AttentionBlock", "BasicTransformerBlock"] + (["ResBlock"] if use_checkpoint else [])
+            checkpoint_policy = {"block_types": block_types}
+        CheckpointPolicy(**checkpoint_policy).apply(self)
+
     def convert_to_fp16(self):
         """
         Convert the torso of the model to float16.
@@ -689,12 +846,105 @@ class UNetModel(nn.Module):
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
 
+    def get_cond_features(self, level, conditioning, size, cond_cache=None):
+        """
+        Project the conditioning to the given spatial size with cond_conv[level].
+        :param cond_cache: optional ConditioningCache, the result is computed once
+                           and reused for all further calls with the same cache.
+        """
+        def compute():
+            cond_input = nn.functional.interpolate(conditioning, size=size, mode='bilinear', align_corners=True)
+            return self.cond_conv[level](cond_input)
+
+        if cond_cache is None:
+            return compute()
+        return cond_cache.get((level, tuple(size)), compute)
+
+    @contextmanager
+    def nan_check_disabled(self):
+        """
+        Skip the per-call NaN assertion, e.g. while the caller checks for
+        non-finite values itself at a lower frequency.
+        """
+        check_nan = self.check_nan
+        self.check_nan = False
+        try:
+            yield None
+        finally:
+            self.check_nan = check_nan
+
+    def timestep_embedding_key(self, cache_resblocks=True):
+        """
+        Identifies the weights a TimestepEmbeddingCache depends on. In-place updates
+        (optimizer steps, EMA swaps) bump the version counter, moving or replacing
+        the weights changes the data pointer.
+        """
+        params = list(self.time_embed.parameters())
+        if cache_resblocks:
+            for module in self.modules():
+                if isinstance(module, ResBlock):
+                    params.extend(module.emb_layers.parameters())
+        return tuple((p.data_ptr(), p._version) for p in params)
+
+    @contextmanager
+    def cached_timestep_embedding(self, timesteps, cache_resblocks=True):
+        """
+        Look up the timestep embeddings for the given schedule instead of computing
+        them in every forward, the sampler calls set_step on the yielded cache before
+        each step. The cache is kept and reused by later calls with the same schedule
+        as long as the weights did not change.
+        """
+        cache = self._last_embedding_cache
+        if cache is None or not cache.matches(self, timesteps, cache_resblocks):
+            cache = TimestepEmbeddingCache(self, timesteps, cache_resblocks)
+            self._last_embedding_cache = cache
+        resblocks = [module for module in self.modules() if isinstance(module, ResBlock)]
+        self.embedding_cache = cache
+        for module in resblocks:
+            module.emb_cache = cache
+        cache.set_step(None)
+        try:
+            yield cache
+        finally:
+            cache.set_step(None)
+            self.embedding_cache = None
+            for module in resblocks:
+                module.emb_cache = None
+
+    @contextmanager
+    def reuse_deep_features(self, branch):
+        """
+        Reuse the deep (low resolution) part of the UNet across sampling steps.
+        On full steps the input to output_blocks[len(input_blocks) - branch] is
+        stored in the ConditioningCache of the call; on cheap steps only input_conv,
+        the first `branch` input_blocks and the matching output_blocks are run on
+        top of the stored features. Calls without a ConditioningCache always run
+        the full UNet. Stored features are only reused for the same batch size and
+        if they are from the latest full step, so a cheap step right after switching
+        between guided and unguided sampling runs the full UNet.
+        :param branch: number of input_blocks recomputed on cheap steps.
+        """
+        assert 0 <= branch < len(self.input_blocks), f'branch has to be in [0, {len(self.input_blocks)})'
+        feature_reuse = DeepFeatureReuse(branch)
+        self.feature_reuse = feature_reuse
+        try:
+            yield feature_reuse
+        finally:
+            self.feature_reuse = None
+
+    def precompute_conditioning(self, context):
+        """
+        Wrap a context into a ConditioningCache that can be passed to forward in
+        place of the context for all steps of a sampling loop.
+        """
+        return ConditioningCache(context)
+
     def forward(self, x, timesteps=None, context=None, y=None,**kwargs):
         """
         Apply the model to an input batch.
         :param x: an [N x C x ...] Tensor of inputs.
         :param timesteps: a 1-D batch of timesteps.
-        :param context: conditioning plugged in via crossattn
+        :param context: conditioning plugged in via crossattn, or a ConditioningCache
         :param y: an [N] Tensor of labels, if class-conditional.
         :return: an [N x C x ...] Tensor of outputs.
         """
@@ -702,34 +952,60 @@ class UNetModel(nn.Module):
         assert context is not None
         assert timesteps is not None, 'need to implement no-timestep usage'
 
-        if isinstance(context, tuple):
+        cond_cache = None
+        if isinstance(context, ConditioningCache):
+            cond_cache = context
+            conditioning = context.conditioning
+        elif isinstance(context, tuple):
             conditioning = context[0]
         elif isinstance(context,torch.Tensor):
             conditioning = context
         else:
             raise ValueError(f"Got context of type {type(context)}")
         hs = []
-        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
+        compute_emb = lambda: self.time_embed(timestep_embedding(timesteps, self.model_channels, repeat_only=False))
+        if self.embedding_cache is not None:
+            emb = self.embedding_cache.emb(timesteps.shape[0], compute_emb)
+        else:
+            emb = compute_emb()
 
         h = x.type(self.dtype)
         h = self.input_conv(h, emb, conditioning)
 
+        reuse = self.feature_reuse if cond_cache is not None else None
+        if reuse is not None:
+            deep_key = ('deep', reuse.branch)
+            first_shallow = len(self.input_blocks) - reuse.branch
+            deep_features = reuse.cached(cond_cache, deep_key, h.shape[0])
+        else:
+            deep_features = None
+        cheap = deep_features is not None
+
         # cat in context
-        cond_input = nn.functional.interpolate(conditioning, size=h.shape[-2:], mode='bilinear', align_corners=True)
-        h = torch.cat([h, self.cond_conv[0](cond_input)], dim=1)
+        h = torch.cat([h, self.get_cond_features(0, conditioning, h.shape[-2:], cond_cache)], dim=1)
         hs.append(h)
 
-        for module in self.input_blocks:
-            h = module(h, emb, conditioning)
-            hs.append(h)
+        if cheap:
+            for module in self.input_blocks[:reuse.branch]:
+                h = module(h, emb, conditioning)
+                hs.append(h)
+            h = deep_features
+            output_blocks = self.output_blocks[first_shallow:]
+        else:
+            for module in self.input_blocks:
+                h = module(h, emb, conditioning)
+                hs.append(h)
+
+            h = torch.cat([h, self.get_cond_features(1, conditioning, h.shape[-2:], cond_cache)], dim=1)
 
-        cond_input2 = nn.functional.interpolate(conditioning, size=h.shape[-2:], mode='bilinear', align_corners=True)
-        h = torch.cat([h, self.cond_conv[1](cond_input2)], dim=1)
+            h = self.middle_block(h, emb, conditioning)
+            if self.check_nan:
+                assert not torch.isnan(h).any()
+            output_blocks = self.output_blocks
 
-        h = self.middle_block(h, emb, conditioning)
-        assert not torch.isnan(h).any()
-        for module in self.output_blocks:
+        for i, module in enumerate(output_blocks):
+            if reuse is not None and not cheap and i == first_shallow:
+                reuse.store(cond_cache, deep_key, h)
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, conditioning)
         h = h.type(x.dtype)
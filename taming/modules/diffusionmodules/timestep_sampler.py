@@ -0,0 +1,157 @@
+"""
+Distributions over the diffusion timesteps used to draw t during training.
+
+The sampler is chosen with timestep_sampler_config of DDPM, e.g.
+    timestep_sampler_config:
+      target: taming.modules.diffusionmodules.timestep_sampler.LossSecondMomentResampler
+      params:
+        history_per_term: 10
+num_timesteps is filled in by the model. Samples come with importance weights
+1 / (T * p(t)), so the weighted loss is an unbiased estimate of the uniform one.
+"""
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+from taming.util import get_obj_from_str
+
+
+def create_timestep_sampler(config, num_timesteps):
+    if config is None:
+        return UniformSampler(num_timesteps)
+    return get_obj_from_str(config["target"])(num_timesteps=num_timesteps, **config.get("params", dict()))
+
+
+class TimestepSampler(nn.Module):
+    """
+    Base class of the timestep distributions. Subclasses implement weights(), the
+    unnormalised probability of every timestep, and may learn from the training
+    losses in update_with_all_losses.
+    :param gather_size: number of losses every rank contributes per update under DDP,
+        smaller batches are padded and larger ones are an error. main.py sets it to
+        batch_size * noise_levels_per_image of the config, otherwise the size of the
+        first gathered batch is used, which all ranks have to agree on.
+    """
+    requires_losses = False
+
+    def __init__(self, num_timesteps, gather_size=None):
+        super().__init__()
+        self.num_timesteps = num_timesteps
+        self.gather_size = gather_size
+
+    def weights(self):
+        raise NotImplementedError()
+
+    def probabilities(self):
+        weights = self.weights()
+        return weights / weights.sum()
+
+    @torch.no_grad()
+    def sample(self, batch_size, device, strata=1):
+        """
+        :param strata: timesteps per example. They are drawn from strata equal
+            quantile ranges of the distribution, one from each, and are
+            consecutive in the output.
+        :return: [batch_size * strata] timesteps and their importance weights.
+        """
+        p = self.probabilities().to(device)
+        u = torch.rand(batch_size * strata, device=device)
+        if strata > 1:
+            u = (torch.arange(strata, device=device).repeat(batch_size) + u) / strata
+        # inverse cdf
+        t = torch.searchsorted(torch.cumsum(p, dim=0), u, right=True).clamp(max=self.num_timesteps - 1)
+        weights = 1. / (self.num_timesteps * p[t])
+        return t, weights
+
+    def update_with_local_losses(self, t, losses):
+        """
+        Update the distribution with the per-example losses of this rank, which
+        are first gathered from all ranks so the samplers stay in sync.
+        :param t: [N] timesteps of the examples.
+        :param losses: [N] their unweighted losses.
+        """
+        if not self.requires_losses:
+            return
+        t, losses = t.detach(), losses.detach().float()
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            t, losses = self.all_gather(t, losses)
+        self.update_with_all_losses(t, losses)
+
+    def all_gather(self, t, losses):
+        # fixed size buffers, so neither the sizes nor the padding have to be read on the host.
+        # padding gets the timestep num_timesteps, which update_with_all_losses ignores
+        n = t.shape[0]
+        if self.gather_size is None:
+            self.gather_size = n
+        size = self.gather_size
+        assert n <= size, f'batch of {n} losses is larger than gather_size={size}'
+        padded_t = torch.full((size,), self.num_timesteps, dtype=t.dtype, device=t.device)
+        padded_t[:n] = t
+        padded_losses = torch.zeros(size, dtype=losses.dtype, device=losses.device)
+        padded_losses[:n] = losses
+        gathered_t = [torch.empty_like(padded_t) for _ in range(dist.get_world_size())]
+        gathered_losses = [torch.empty_like(padded_losses) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered_t, padded_t)
+        dist.all_gather(gathered_losses, padded_losses)
+        return torch.cat(gathered_t), torch.cat(gathered_losses)
+
+    def update_with_all_losses(self, t, losses):
+        """
+        :param t: [N] timesteps, entries equal to num_timesteps are padding and have to be ignored.
+        :param losses: [N] their losses.
+        """
+        pass
+
+
+class UniformSampler(TimestepSampler):
+    def __init__(self, num_timesteps, **kwargs):
+        super().__init__(num_timesteps, **kwargs)
+        self.register_buffer('_weights', torch.ones(num_timesteps), persistent=False)
+
+    def weights(self):
+        return self._weights
+
+
+class LossSecondMomentResampler(TimestepSampler):
+    """
+    Importance sampling with p(t) proportional to sqrt(E[loss(t)^2]), estimated
+    from the last history_per_term losses of every timestep (Nichol & Dhariwal 2021).
+    Uniform until every timestep has a full history, and mixed with uniform_prob
+    of the uniform distribution afterwards. The history is not saved in checkpoints.
+    """
+    requires_losses = True
+
+    def __init__(self, num_timesteps, history_per_term=10, uniform_prob=0.001, **kwargs):
+        super().__init__(num_timesteps, **kwargs)
+        self.history_per_term = history_per_term
+        self.uniform_prob = uniform_prob
+        # one extra row that collects the padding of gathered losses
+        self.register_buffer('loss_history', torch.zeros(num_timesteps + 1, history_per_term), persistent=False)
+        self.register_buffer('loss_counts', torch.zeros(num_timesteps + 1, dtype=torch.long), persistent=False)
+
+    def warmed_up(self):
+        return (self.loss_counts[:self.num_timesteps] >= self.history_per_term).all()
+
+    def weights(self):
+        weights = torch.sqrt(torch.mean(self.loss_history[:self.num_timesteps] ** 2, dim=-1))
+        weights = weights / weights.sum().clamp(min=1e-12)
+        weights = weights * (1 - self.uniform_prob) + self.uniform_prob / self.num_timesteps
+        # selected on device, no sync for the warm-up check
+        return torch.where(self.warmed_up(), weights, torch.ones_like(weights))
+
+    @torch.no_grad()
+    def update_with_all_losses(self, t, losses):
+        t = t.to(self.loss_counts.device)
+        losses = losses.to(self.loss_history.device)
+        # ring buffer per timestep, examples of the same timestep get consecutive slots
+        t, order = torch.sort(t)
+        losses = losses[order]
+        position = torch.arange(t.shape[0], device=t.device)
+        rank = position - torch.searchsorted(t, t)
+        counts = torch.zeros_like(self.loss_counts).index_add_(0, t, torch.ones_like(t))
+        slot = (self.loss_counts[t] + rank) % self.history_per_term
+        # only the last history_per_term losses of a timestep are kept, earlier examples
+        # that share a slot write the value of the last one, so no masking (and sync) is needed
+        last = position + (counts[t] - rank - 1) // self.history_per_term * self.history_per_term
+        self.loss_history[t, slot] = losses[last]
+        self.loss_counts += counts
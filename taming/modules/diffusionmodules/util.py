@@ -1,5 +1,6 @@
 import os
 import math
+from contextlib import contextmanager
 import torch
 import torch.nn as nn
 import numpy as np
@@ -98,7 +99,8 @@ def checkpoint(func, inputs, params, flag):
                    explicitly take as arguments.
     :param flag: if False, disable gradient checkpointing.
     """
-    if flag:
+    # without gradients there is nothing to recompute, skip the autograd function at inference
+    if flag and torch.is_grad_enabled():
         args = tuple(inputs) + tuple(params)
         return CheckpointFunction.apply(func, len(inputs), *args)
     else:
@@ -240,4 +242,57 @@ def avg_pool_nd(dims, *args, **kwargs):
 def noise_like(shape, device, repeat=False):
     repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
     noise = lambda: torch.randn(shape, device=device)
-    return repeat_noise() if repeat else noise()
\ No newline at end of file
+    return repeat_noise() if repeat else noise()
+
+@contextmanager
+def cached_timestep_embedding(model, timesteps, enabled=True):
+    """
+    Sampler-side helper: precompute the timestep embeddings of the UNet inside the
+    DDPM `model` for the given schedule, if the UNet supports it.
+    """
+    diffusion_model = getattr(getattr(model, 'model', None), 'diffusion_model', None)
+    if not enabled or not hasattr(diffusion_model, 'cached_timestep_embedding'):
+        yield None
+    else:
+        with diffusion_model.cached_timestep_embedding(timesteps) as cache:
+            yield cache
+
+
+def make_feature_reuse_mask(num_steps, segments):
+    """
+    Which sampling steps run the full UNet when reusing deep features.
+    :param num_steps: number of sampling steps, in sampling order.
+    :param segments: list of (start, K) pairs, from the fraction `start` of the
+                     sampling steps onwards every full step is followed by K
+                     cheap steps. The first step is always a full one.
+    :return: list of bools, True for full steps.
+    """
+    segments = sorted(segments, key=lambda segment: segment[0])
+    mask = []
+    cheap_left = 0
+    for i in range(num_steps):
+        K = 0
+        for start, k in segments:
+            if i >= start * num_steps:
+                K = k
+        if i == 0 or cheap_left <= 0:
+            mask.append(True)
+            cheap_left = K
+        else:
+            mask.append(False)
+            cheap_left -= 1
+    return mask
+
+
+@contextmanager
+def deep_feature_reuse(model, branch=None):
+    """
+    Sampler-side helper: reuse the deep UNet features of the DDPM `model`, yields
+    the DeepFeatureReuse state (or None if disabled or unsupported).
+    """
+    diffusion_model = getattr(getattr(model, 'model', None), 'diffusion_model', None)
+    if branch is None or not hasattr(diffusion_model, 'reuse_deep_features'):
+        yield None
+    else:
+        with diffusion_model.reuse_deep_features(branch) as feature_reuse:
+            yield feature_reuse
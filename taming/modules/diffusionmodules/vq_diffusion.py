@@ -6,23 +6,30 @@ https://github.com/CompVis/taming-transformers
 -- merci
 """
 
+import inspect
 import torch
 import torch.nn as nn
 import numpy as np
+from copy import deepcopy
 import pytorch_lightning as pl
 from torch.optim.lr_scheduler import LambdaLR
 from einops import rearrange, repeat
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from functools import partial
 from tqdm import tqdm
 from torchvision.utils import make_grid
 from pytorch_lightning.utilities.distributed import rank_zero_only
 import torchmetrics
-from taming.modules.diffusionmodules.ddpm import DDPM
+from taming.modules.diffusionmodules.ddpm import DDPM, disabled_train
+from taming.modules.diffusionmodules.util import make_ddim_timesteps, extract_into_tensor
+from taming.modules.ema import LitEma
+from taming.modules.attention import attention_backend as use_attention_backend, ATTENTION_BACKENDS
 from taming.modules.losses.lpips import LPIPS
 from taming.modules.metrics.metrics import CodebookUsageMetric, FIDMetric
-from taming.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat, count_params, instantiate_from_config
+from taming.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat, count_params, instantiate_from_config, \
+    get_obj_from_str, images_to_tensor
 from taming.modules.diffusionmodules.ddim import DDIMSampler
+from taming.modules.diffusionmodules.openaimodel import ConditioningCache
 
 
 class VQDiffusion(DDPM):
@@ -34,6 +41,18 @@ class VQDiffusion(DDPM):
                  cond_stage_forward=None,
                  conditioning_key=None,
                  lpips_weight=0.0,
+                 sampler_config=None,
+                 coarse_decoder_config=None,
+                 coarse_weight=1.0,
+                 decode_t_start=None,
+                 tile_params=None,
+                 cond_drop_prob=0.0,
+                 attention_backend=None,
+                 attention_chunk_size=None,
+                 fid_cache_dir=None,
+                 validation_sampling=True,
+                 noise_levels_per_image=1,
+                 freeze_encoder=False,
                  *args, **kwargs):
         self.num_timesteps_cond = default(num_timesteps_cond, 1)
         assert self.num_timesteps_cond <= kwargs['timesteps']
@@ -50,14 +69,41 @@ class VQDiffusion(DDPM):
             self.num_downs = 0
 
         self.encoder = instantiate_from_config(encoder_config)
+        # decoder-only training, the conditioning may then come from cached tokens, see get_input
+        self.freeze_encoder = False
+        if freeze_encoder:
+            self.freeze_encoder_weights()
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None
         self.lpips_weight = lpips_weight
+        self.sampler_config = sampler_config
+        # optional cheap head mapping the quantized tokens to a coarse image, used to warm-start sampling
+        self.use_coarse_decoder = coarse_decoder_config is not None
+        if self.use_coarse_decoder:
+            self.coarse_decoder = instantiate_from_config(coarse_decoder_config)
+            self.coarse_weight = coarse_weight
+        self.decode_t_start = decode_t_start
+        # False: validation only computes the losses, sampling and metrics run in an evaluation worker
+        self.validation_sampling = validation_sampling
+        # training denoises every encoded image at this many stratified timesteps, see forward
+        assert noise_levels_per_image >= 1
+        self.noise_levels_per_image = noise_levels_per_image
+        # tiled denoising for images larger than the training resolution, see apply_model
+        self.tile_params = tile_params
+        # implementation of the attention layers of this model, "math", "sdpa" or "chunked", see
+        # taming.modules.attention. Selected around every denoiser call, other models keep theirs
+        assert attention_backend is None or attention_backend in ATTENTION_BACKENDS
+        self.attention_backend = attention_backend
+        self.attention_chunk_size = attention_chunk_size
+        # learned null token conditioning for classifier-free guidance
+        self.cond_drop_prob = cond_drop_prob
+        if self.cond_drop_prob > 0.0:
+            self.null_cond = nn.Parameter(torch.zeros(1, encoder_config['params']['embed_dim'], 1, 1))
         if self.lpips_weight > 0.0:
             self.perceptual_loss = LPIPS().eval()
         self.metrics_dict = torch.nn.ModuleDict({"PSNR":torchmetrics.PeakSignalNoiseRatio(data_range=1.0),
-                             "FID":FIDMetric(),
+                             "FID":FIDMetric(cache_dir=fid_cache_dir),
                             "CodebookUsage":CodebookUsageMetric(encoder_config['params']['n_embed']),
                             })
         self.restarted_from_ckpt = False
@@ -90,16 +136,45 @@ class VQDiffusion(DDPM):
         denoise_grid = make_grid(denoise_grid, nrow=n_imgs_per_row)
         return denoise_grid
 
+    def freeze_encoder_weights(self):
+        self.freeze_encoder = True
+        self.encoder.eval()
+        self.encoder.train = disabled_train
+        for param in self.encoder.parameters():
+            param.requires_grad = False
+
     def get_input(self, batch):
-        x = batch['image']
-        x = rearrange(x, 'b h w c -> b c h w')
-        x = x.to(memory_format=torch.contiguous_format).float()
-        c = self.encoder(x)
+        x = images_to_tensor(batch['image'], self.device)
+        if self.freeze_encoder and 'tokens' in batch:
+            # tokens of the frozen encoder cached by TokenCachedDataset, skips the encoder forward
+            tokens = batch['tokens'].to(self.device)
+            quant = self.get_codebook_entry(tokens).to(x.dtype)
+            c = (quant, torch.zeros((), device=self.device), (None, None, tokens.reshape(-1)))
+        else:
+            c = self.encoder(x)
+        if self.training and self.cond_drop_prob > 0.0:
+            quant, emb_loss, info = c
+            drop = torch.rand(quant.shape[0], 1, 1, 1, device=quant.device) < self.cond_drop_prob
+            c = (torch.where(drop, self.null_cond.to(quant.dtype).expand_as(quant), quant), emb_loss, info)
         return x, c
 
+    def get_unconditional_conditioning(self, cond):
+        """null token conditioning with the batch size and token grid of cond"""
+        assert self.cond_drop_prob > 0.0, 'guidance needs a model trained with cond_drop_prob > 0'
+        if isinstance(cond, (tuple, list)):
+            cond = cond[0]
+        b, _, h, w = cond.shape
+        return self.null_cond.expand(b, -1, h, w)
+
+    def attention_scope(self):
+        if self.attention_backend is None:
+            return nullcontext()
+        return use_attention_backend(self.attention_backend, self.attention_chunk_size)
+
     def shared_step(self, batch, **kwargs):
         x, c = self.get_input(batch)
-        loss = self(x, c)
+        with self.attention_scope():
+            loss = self(x, c)
         return loss
 
     def training_step(self, batch, batch_idx):
@@ -111,6 +186,9 @@ class VQDiffusion(DDPM):
         self.log("global_step", self.global_step,
                  prog_bar=True, logger=True, on_step=True, on_epoch=False)
 
+        self.log_index_recall('train')
+        self.log_timestep_distribution('train')
+
         if self.use_scheduler:
             lr = self.optimizers().param_groups[0]['lr']
             self.log('lr_abs', lr, prog_bar=True, logger=True, on_step=True, on_epoch=False)
@@ -120,6 +198,11 @@ class VQDiffusion(DDPM):
     def normalize(self,x):
         return (x.clamp(-1,1)+1)/2
 
+    def on_validation_start(self):
+        # the sanity check only runs a few batches, keep it out of the real statistics cache
+        key = None if self.trainer.sanity_checking else FIDMetric.cache_key_from_trainer(self.trainer)
+        self.metrics_dict["FID"].set_cache_key(key)
+
     def validation_step(self, batch, batch_idx):
         x, c = self.get_input(batch)
 
@@ -128,34 +211,164 @@ class VQDiffusion(DDPM):
         self.log_dict(loss_dict,prog_bar=False, logger=True, sync_dist=False, on_step=True, on_epoch=False)
         self.log("val/total_loss", loss,
                  prog_bar=False, logger=True, sync_dist=False, on_step=True, on_epoch=False)
+        self.log_index_recall('val')
+
+        # sampling can be left to an evaluation worker, see taming/evaluation.py
+        if not self.validation_sampling:
+            return self.log_dict
+
+        img = self.sample_and_update_metrics(x, c)
+        self.logger.experiment.add_images('val_images', img, self.global_step, dataformats='NHWC')
+
+        for key_i, metric_i in self.metrics_dict.items():
+            self.log('val_%s' % (key_i), metric_i,on_epoch=True,
+                     prog_bar=True, add_dataloader_idx=False, sync_dist=True)
 
-        samples, _ = self.sample_log(cond=c[0],batch_size=x.shape[0],ddim=True, ddim_steps=self.ddim_timesteps)
+        return self.log_dict
+
+    @torch.no_grad()
+    def sample_and_update_metrics(self, x, c):
+        """decode the batch, update metrics_dict and return samples above inputs as NHWC uint8 images"""
+        samples, _ = self.sample_log(cond=c[0],batch_size=x.shape[0],ddim=True, ddim_steps=self.ddim_timesteps,
+                                     t_start=self.decode_t_start)
         samples = self.normalize(samples.clone())
 
         tokens = c[-1][2]
 
         x = self.normalize(x.clone())
 
-        img = torch.cat([samples,x],dim=-2)
-        img = (img.cpu().numpy()*255).astype(np.uint8)
-        img = np.moveaxis(img, 1, -1)
-        self.logger.experiment.add_images('val_images', img, self.global_step, dataformats='NHWC')
-
         for key_i, metric_i in self.metrics_dict.items():
             if  isinstance(metric_i,CodebookUsageMetric):
                 metric_i.update(tokens)
             else:
                 metric_i.update(samples,x)
-            self.log('val_%s' % (key_i), metric_i,on_epoch=True,
-                     prog_bar=True, add_dataloader_idx=False, sync_dist=True)
 
-        return self.log_dict
+        img = torch.cat([samples,x],dim=-2)
+        img = (img.cpu().numpy()*255).astype(np.uint8)
+        return np.moveaxis(img, 1, -1)
+
+    def log_index_recall(self, prefix):
+        """recall of the approximate codebook search against exact search, if the quantizer uses an index"""
+        index = getattr(self.encoder.quantize, 'index', None)
+        if index is not None and index.last_recall is not None:
+            self.log(f'{prefix}/codebook_index_recall', index.last_recall,
+                     prog_bar=False, logger=True, on_step=True, on_epoch=False)
+
+    @contextmanager
+    def tiled(self, tile_params=None):
+        """temporarily run apply_model with the given tile_params"""
+        if tile_params is None:
+            yield None
+            return
+        old_tile_params = self.tile_params
+        self.tile_params = tile_params
+        try:
+            yield None
+        finally:
+            self.tile_params = old_tile_params
+
+    def get_tile_weighting(self, h, w, device):
+        weighting = self.delta_border(h, w)
+        weighting = torch.clip(weighting, self.tile_params.get("clip_min_weight", 0.01),
+                               self.tile_params.get("clip_max_weight", 0.5))
+        return weighting.view(1, 1, h, w).to(device)
+
+    def get_tile_starts(self, size, tile_size, stride):
+        # like fold/unfold, but the last tile is moved back so that the whole image is covered
+        starts = list(range(0, size - tile_size + 1, stride))
+        if starts[-1] + tile_size < size:
+            starts.append(size - tile_size)
+        return starts
+
+    def apply_model(self, x_noisy, t, cond):
+        """
+        Denoiser call used by the samplers. With tile_params the image is split into
+        overlapping tile_size x tile_size crops (and the token grid into the matching
+        crops), which are denoised tile_batch_size at a time and blended with a
+        delta_border weighting, so activation memory depends on the tile size only.
+        """
+        with self.attention_scope():
+            return self.apply_model_tiled(x_noisy, t, cond)
+
+    def apply_model_tiled(self, x_noisy, t, cond):
+        if self.tile_params is None:
+            return self.model(x_noisy, t, cond)
+
+        b, _, h, w = x_noisy.shape
+        tile_size = self.tile_params["tile_size"]
+        stride = self.tile_params.get("tile_stride", tile_size // 2)
+        tile_batch_size = self.tile_params.get("tile_batch_size", 1)
+        f = 2 ** self.num_downs
+        assert tile_size % f == 0 and stride % f == 0, f'tile_size and tile_stride have to be multiples of {f}'
+        if h <= tile_size and w <= tile_size:
+            return self.model(x_noisy, t, cond)
+
+        conditioning = cond.conditioning if isinstance(cond, ConditioningCache) else cond
+        if isinstance(conditioning, (tuple, list)):
+            conditioning = conditioning[0]
+        cache_features = isinstance(cond, ConditioningCache) and self.tile_params.get("cache_tile_features", False)
+
+        tiles = [(y, x) for y in self.get_tile_starts(h, min(tile_size, h), stride)
+                 for x in self.get_tile_starts(w, min(tile_size, w), stride)]
+        th, tw = min(tile_size, h), min(tile_size, w)
+        weighting = self.get_tile_weighting(th, tw, x_noisy.device).to(x_noisy.dtype)
+
+        output = torch.zeros_like(x_noisy)
+        normalization = torch.zeros((1, 1, h, w), device=x_noisy.device, dtype=x_noisy.dtype)
+        for group_start in range(0, len(tiles), tile_batch_size):
+            group = tiles[group_start:group_start + tile_batch_size]
+            x_tiles = torch.cat([x_noisy[:, :, y:y + th, x:x + tw] for y, x in group])
+            crop_cond = lambda: torch.cat([conditioning[:, :, y // f:(y + th) // f, x // f:(x + tw) // f]
+                                           for y, x in group])
+            c_tiles = cond.child(('tile', group_start, th, tw), crop_cond) if cache_features else crop_cond()
+            out_tiles = self.model(x_tiles, t.repeat(len(group)), c_tiles).chunk(len(group))
+            for (y, x), out_tile in zip(group, out_tiles):
+                output[:, :, y:y + th, x:x + tw] += weighting * out_tile
+                normalization[:, :, y:y + th, x:x + tw] += weighting
+        return output / normalization
+
+    def sample_shape(self, cond):
+        """image shape (C, H, W) matching the token grid of cond"""
+        if cond is None:
+            return (self.channels, self.image_size, self.image_size)
+        f = 2 ** self.num_downs
+        return (self.channels, cond.shape[-2] * f, cond.shape[-1] * f)
+
+    def precompute_conditioning(self, cond):
+        """compute the conditioning features once so they can be reused for every sampling step"""
+        if self.model.conditioning_key == 'crossattn':
+            return self.model.precompute_conditioning(c_crossattn=[cond])
+        return self.model.precompute_conditioning(c_concat=cond)
 
     def forward(self, x, c, *args, **kwargs):
-        t = torch.randint(0, self.num_timesteps, (x.shape[0],), device=self.device).long()
-        return self.p_losses(x, c, t, *args, **kwargs)
+        if not self.training:
+            t = torch.randint(0, self.num_timesteps, (x.shape[0],), device=self.device).long()
+            loss, loss_dict = self.p_losses(x, c, t, *args, **kwargs)
+            return self.add_coarse_loss(x, c, loss, loss_dict)
+        # k timesteps per image from k strata of the timestep sampler
+        k = self.noise_levels_per_image
+        t, weights = self.timestep_sampler.sample(x.shape[0], self.device, strata=k)
+        x_coarse, c_coarse = x, c
+        if k > 1:
+            # encoder output reused for k noise levels, its gradients accumulate over the replicas
+            # while the loss stays a mean over all b * k samples
+            x = x.repeat_interleave(k, dim=0)
+            c = (c[0].repeat_interleave(k, dim=0),) + tuple(c[1:])
+        loss, loss_dict = self.p_losses(x, c, t, *args, weights=weights, **kwargs)
+        # the coarse head does not depend on the noise level, so it sees every image once
+        return self.add_coarse_loss(x_coarse, c_coarse, loss, loss_dict)
+
+    def add_coarse_loss(self, x_start, cond, loss, loss_dict):
+        if not self.use_coarse_decoder:
+            return loss, loss_dict
+        prefix = 'train' if self.training else 'val'
+        # trained on detached tokens so the head does not shape the encoder
+        coarse = self.decode_coarse(cond[0].detach(), size=x_start.shape[-2:])
+        loss_coarse = self.get_loss(coarse, x_start, mean=True)
+        loss_dict.update({f'{prefix}/loss_coarse': loss_coarse})
+        return loss + self.coarse_weight * loss_coarse, loss_dict
 
-    def p_losses(self, x_start, cond, t, noise=None):
+    def p_losses(self, x_start, cond, t, noise=None, weights=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
         x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
         model_output = self.model(x_noisy, t, cond)
@@ -165,8 +378,11 @@ class VQDiffusion(DDPM):
 
         loss_simple = self.get_loss(model_output, noise, mean=False).mean([1, 2, 3])
         loss_dict.update({f'{prefix}/loss_simple': loss_simple.mean()})
+        if self.training:
+            self.timestep_sampler.update_with_local_losses(t, loss_simple)
 
-        loss = self.l_simple_weight * loss_simple.mean()
+        # importance weights of the timestep sampler
+        loss = self.l_simple_weight * (loss_simple if weights is None else loss_simple * weights).mean()
 
         # elbo loss weight, turned off for uniform weighting
         # loss_vlb = self.get_loss(model_output, target, mean=False).mean(dim=(1, 2, 3))
@@ -312,14 +528,64 @@ class VQDiffusion(DDPM):
                                   verbose=verbose, timesteps=timesteps, quantize_denoised=quantize_denoised,
                                   mask=mask, x0=x0)
 
+    def make_sampler(self, sampler_config=None):
+        """
+        sampler_config follows the usual target/params layout, the sampler class is
+        instantiated with this model as first argument. Defaults to DDIMSampler.
+        """
+        sampler_config = default(sampler_config, self.sampler_config)
+        if sampler_config is None:
+            return DDIMSampler(self)
+        return get_obj_from_str(sampler_config["target"])(self, **sampler_config.get("params", dict()))
+
+    def decode_coarse(self, quant, size=None):
+        assert self.use_coarse_decoder, 'warm-start decoding needs a coarse_decoder_config'
+        size = default(size, (self.image_size, self.image_size))
+        coarse = self.coarse_decoder(quant)
+        if tuple(coarse.shape[-2:]) != tuple(size):
+            coarse = nn.functional.interpolate(coarse, size=size, mode='bilinear', align_corners=False)
+        return coarse
+
     @torch.no_grad()
-    def sample_log(self,cond,batch_size,ddim, ddim_steps,**kwargs):
+    def warm_start_sample(self, sampler, cond, batch_size, ddim_steps, t_start, eta=0., x_T=None, **kwargs):
+        """
+        Noise the coarse reconstruction to the t_start-th of ddim_steps DDIM steps and only
+        run the remaining t_start steps of the reverse process.
+        :param kwargs: passed to sampler.decode if it accepts them (e.g. unconditional_guidance_scale,
+            unconditional_conditioning, guidance_interval), the others are ignored.
+        """
+        assert hasattr(sampler, 'decode'), f'{sampler.__class__.__name__} does not support warm-start decoding'
+        decode_params = inspect.signature(sampler.decode).parameters
+        ignored = [k for k in kwargs if k not in decode_params]
+        if ignored:
+            print(f"{sampler.__class__.__name__}.decode ignores {', '.join(ignored)} in warm-start decoding")
+        kwargs = {k: v for k, v in kwargs.items() if k in decode_params}
+        assert 0 < t_start <= ddim_steps
+        sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=eta, verbose=False)
+        x0 = self.decode_coarse(cond[:batch_size], size=self.sample_shape(cond)[1:])
+        t = torch.full((batch_size,), t_start - 1, device=self.device, dtype=torch.long)
+        x_latent = sampler.stochastic_encode(x0, t, noise=x_T)
+        samples = sampler.decode(x_latent, cond[:batch_size], t_start, **kwargs)
+        return samples, {'x_inter': [x_latent], 'pred_x0': [x0]}
 
-        if ddim:
-            ddim_sampler = DDIMSampler(self)
-            shape = (self.channels, self.image_size, self.image_size)
-            samples, intermediates =ddim_sampler.sample(ddim_steps,batch_size,
-                                                        shape,cond,verbose=False,**kwargs)
+    @torch.no_grad()
+    def sample_log(self,cond,batch_size,ddim, ddim_steps,sampler_config=None,t_start=None,tile_params=None,
+                   **kwargs):
+        if kwargs.get('unconditional_guidance_scale', 1.) != 1. and kwargs.get('unconditional_conditioning') is None:
+            kwargs['unconditional_conditioning'] = self.get_unconditional_conditioning(cond[:batch_size])
+
+        if ddim and t_start is not None:
+            sampler = self.make_sampler(sampler_config)
+            with self.tiled(tile_params):
+                samples, intermediates = self.warm_start_sample(sampler, cond, batch_size, ddim_steps, t_start,
+                                                                **kwargs)
+
+        elif ddim:
+            sampler = self.make_sampler(sampler_config)
+            shape = self.sample_shape(cond)
+            with self.tiled(tile_params):
+                samples, intermediates =sampler.sample(ddim_steps,batch_size,
+                                                       shape,cond,verbose=False,**kwargs)
 
         else:
             samples, intermediates = self.sample(cond=cond, batch_size=batch_size,
@@ -327,10 +593,55 @@ class VQDiffusion(DDPM):
 
         return samples, intermediates
 
+    @torch.no_grad()
+    def encode_tokens(self, x):
+        """[B x C x H x W] images in [-1, 1] -> [B x h x w] token indices, see decode_tokens"""
+        quant, _, (_, _, indices) = self.encoder(x)
+        return indices.reshape(quant.shape[0], *quant.shape[2:])
+
+    def get_codebook_entry(self, indices, shape=None):
+        """
+        quantized conditioning for integer token grids, without running the encoder
+        :param indices: [B x H x W] token indices, or flat [B*H*W] indices together with shape=(B, H, W)
+        :return: [B x embed_dim x H x W] conditioning as returned by the encoder
+        """
+        quantize = self.encoder.quantize
+        b, h, w = default(shape, indices.shape)
+        indices = indices.reshape(-1).long().to(self.device)
+        return quantize.get_codebook_entry(indices, (b, h, w, quantize.e_dim))
+
+    @torch.no_grad()
+    def decode_tokens(self, indices, shape=None, steps=None, use_ema=True, **kwargs):
+        """
+        Decode images from stored token grids.
+        :param indices: [B x H x W] token indices, see get_codebook_entry.
+        :param steps: number of sampling steps, defaults to ddim_timesteps.
+        :param kwargs: passed to sample_log, e.g. sampler_config, t_start, tile_params
+            or unconditional_guidance_scale.
+        :return: [B x C x H*f x W*f] images in [-1, 1]
+        """
+        cond = self.get_codebook_entry(indices, shape)
+        kwargs.setdefault('t_start', self.decode_t_start)
+        scope = self.ema_scope() if use_ema else nullcontext()
+        with scope:
+            samples, _ = self.sample_log(cond=cond, batch_size=cond.shape[0], ddim=True,
+                                         ddim_steps=default(steps, self.ddim_timesteps), **kwargs)
+        return samples
+
+    def optimizer_params(self):
+        params = list(self.model.parameters())
+        if not self.freeze_encoder:
+            params = params + list(self.encoder.parameters())
+        if self.use_coarse_decoder:
+            params = params + list(self.coarse_decoder.parameters())
+        if self.cond_drop_prob > 0.0:
+            params.append(self.null_cond)
+        return params
+
     def configure_optimizers(self):
         lr = self.learning_rate
 
-        params = list(self.model.parameters())+list(self.encoder.parameters())
+        params = self.optimizer_params()
         print("Num parameters in optimiser:", sum([i.numel() for i in params]))
 
         # if self.learn_logvar:
@@ -349,4 +660,159 @@ class VQDiffusion(DDPM):
                     'frequency': 1
                 }]
             return [opt], scheduler
-        return opt
\ No newline at end of file
+        return opt
+
+class ProgressiveDistillation(VQDiffusion):
+    """
+    Progressive distillation (https://arxiv.org/abs/2202.00512) of a trained VQDiffusion decoder.
+    The student is initialised from the (EMA) weights in ckpt_path and learns to match two
+    deterministic DDIM steps of the teacher with a single step. Every round_length optimizer
+    steps the student becomes the teacher and the number of student steps is halved, until
+    min_student_steps is reached. The encoder is frozen so teacher and student see the same
+    conditioning.
+    """
+    def __init__(self,
+                 teacher_steps=200,
+                 min_student_steps=4,
+                 round_length=50000,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_student_steps = min_student_steps
+        self.round_length = round_length
+        self.register_buffer('teacher_steps', torch.tensor(teacher_steps, dtype=torch.long))
+        self.register_buffer('student_steps', torch.tensor(self.next_student_steps(teacher_steps), dtype=torch.long))
+        # completed rounds, mirrored in python so the per-step round check needs no device sync
+        self.register_buffer('rounds', torch.tensor(0, dtype=torch.long))
+        self.rounds_value = 0
+        self.ddim_timesteps = int(self.student_steps)
+
+        self.freeze_encoder_weights()
+
+        if self.use_ema:
+            # distill from and start the student at the EMA weights, then track the student
+            self.model_ema.copy_to(self.model)
+            self.model_ema = LitEma(self.model, update_every=self.model_ema.update_every,
+                                    offload=self.model_ema.offload)
+        self.teacher = deepcopy(self.model)
+        self.teacher.eval()
+        self.teacher.train = disabled_train
+        for param in self.teacher.parameters():
+            param.requires_grad = False
+
+    def next_student_steps(self, steps):
+        return max((steps + 1) // 2, self.min_student_steps)
+
+    def ddim_grid(self, steps):
+        # the grid the DDIMSampler uses for this many steps, with t=0 prepended for the last step
+        steps = make_ddim_timesteps('uniform', int(steps), self.num_timesteps, verbose=False)
+        return torch.tensor(np.concatenate([[0], steps]), dtype=torch.long, device=self.device)
+
+    def student_timesteps(self):
+        return self.ddim_grid(self.student_steps)
+
+    def teacher_timesteps(self):
+        return self.ddim_grid(self.teacher_steps)
+
+    def teacher_midpoint(self, t, t_prev):
+        """
+        The point of the teacher's grid between the student step from t to t_prev. The student
+        grid is every other point of the teacher grid when teacher_steps = 2 * student_steps,
+        otherwise the teacher point closest to the middle is used, or t_prev if there is none.
+        """
+        grid = self.teacher_timesteps()
+        # teacher points strictly between t_prev and t have indices lo..hi
+        lo = torch.searchsorted(grid, t_prev, right=True)
+        hi = torch.searchsorted(grid, t) - 1
+        mid = grid[((lo + hi) // 2).clamp(0, grid.shape[0] - 1)]
+        return torch.where(lo <= hi, mid, t_prev)
+
+    def get_input(self, batch):
+        with torch.no_grad():
+            return super().get_input(batch)
+
+    def forward(self, x, c, *args, **kwargs):
+        timesteps = self.student_timesteps()
+        idx = torch.randint(1, timesteps.shape[0], (x.shape[0],), device=self.device).long()
+        return self.p_losses(x, c, timesteps[idx], *args, **kwargs)
+
+    def ddim_step(self, model, x, cond, t, t_next):
+        """deterministic (eta=0) DDIM step of model from t to t_next"""
+        e_t = model(x, t, cond)
+        a_t = extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        a_next = extract_into_tensor(self.alphas_cumprod, t_next, x.shape)
+        pred_x0 = (x - (1. - a_t).sqrt() * e_t) / a_t.sqrt()
+        return a_next.sqrt() * pred_x0 + (1. - a_next).sqrt() * e_t
+
+    def p_losses(self, x_start, cond, t, noise=None, weights=None):
+        """
+        :param t: timesteps of the student grid, the student learns the step to the previous grid point.
+        :param weights: optional per-example loss weights, e.g. importance weights.
+        """
+        noise = default(noise, lambda: torch.randn_like(x_start))
+        x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
+
+        with torch.no_grad():
+            timesteps = self.student_timesteps()
+            t_prev = timesteps[(torch.searchsorted(timesteps, t) - 1).clamp(min=0)]
+            t_mid = self.teacher_midpoint(t, t_prev)
+            x_mid = self.ddim_step(self.teacher, x_noisy, cond, t, t_mid)
+            x_target = self.ddim_step(self.teacher, x_mid, cond, t_mid, t_prev)
+
+            # the x0 (and eps) for which a single student DDIM step from t lands on x_target
+            alpha_t = extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape)
+            sigma_t = extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
+            alpha_prev = extract_into_tensor(self.sqrt_alphas_cumprod, t_prev, x_start.shape)
+            sigma_prev = extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t_prev, x_start.shape)
+            ratio = sigma_prev / sigma_t
+            x0_target = (x_target - ratio * x_noisy) / (alpha_prev - ratio * alpha_t)
+            eps_target = (x_noisy - alpha_t * x0_target) / sigma_t
+
+        model_output = self.model(x_noisy, t, cond)
+
+        loss_dict = {}
+        prefix = 'train' if self.training else 'val'
+
+        loss_distill = self.get_loss(model_output, eps_target, mean=False).mean([1, 2, 3])
+        loss_dict.update({f'{prefix}/loss_distill': loss_distill.mean()})
+        loss_dict.update({f'{prefix}/student_steps': self.student_steps.float()})
+
+        loss = self.l_simple_weight * (loss_distill if weights is None else loss_distill * weights).mean()
+        return loss, loss_dict
+
+    def round_of(self, step):
+        """the round of the optimizer step with index step, i.e. after step completed steps"""
+        return step // self.round_length
+
+    def on_train_start(self):
+        super().on_train_start()
+        # the buffers may have been restored from a checkpoint
+        self.rounds_value = int(self.rounds)
+        self.ddim_timesteps = int(self.student_steps)
+
+    def on_train_batch_end(self, *args, **kwargs):
+        super().on_train_batch_end(*args, **kwargs)
+        # global_step counts the completed optimizer steps here, a new round starts once it
+        # reaches a multiple of round_length, checked per round so accumulation does not repeat it
+        if self.round_of(self.global_step) > self.rounds_value:
+            self.rounds_value = self.round_of(self.global_step)
+            self.rounds.fill_(self.rounds_value)
+            if self.ddim_timesteps > self.min_student_steps:
+                self.start_next_round()
+
+    def start_next_round(self):
+        # the current student (EMA) becomes the teacher for half as many steps,
+        # ddim_timesteps mirrors student_steps
+        with self.ema_scope():
+            self.teacher.load_state_dict(self.model.state_dict())
+        self.teacher_steps.fill_(self.ddim_timesteps)
+        self.ddim_timesteps = self.next_student_steps(self.ddim_timesteps)
+        self.student_steps.fill_(self.ddim_timesteps)
+        print(f"Starting distillation round with {self.ddim_timesteps} student steps")
+
+    def on_validation_start(self):
+        super().on_validation_start()
+        self.ddim_timesteps = int(self.student_steps)
+
+    def optimizer_params(self):
+        teacher = set(id(p) for p in self.teacher.parameters())
+        return [p for p in super().optimizer_params() if id(p) not in teacher]
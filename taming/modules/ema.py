@@ -1,56 +1,196 @@
+from contextlib import contextmanager
+
 import torch
 from torch import nn
 
 
 class LitEma(nn.Module):
-    def __init__(self, model, decay=0.9999, use_num_upates=True):
+    """
+    Exponential moving average of the trainable parameters of a model.
+    The shadow weights live in one contiguous buffer and are updated with the
+    torch._foreach kernels. They are still saved and loaded under one state dict
+    key per parameter, so checkpoints are compatible with the per-buffer layout.
+    :param update_every: update every n-th call only, with the decay raised to the n-th power.
+    :param offload: keep the shadow weights in (pinned) CPU memory instead of on the model's device.
+        The weights are copied to the host asynchronously and folded in one update later.
+    """
+    def __init__(self, model, decay=0.9999, use_num_upates=True, update_every=1, offload=False):
         super().__init__()
         if decay < 0.0 or decay > 1.0:
             raise ValueError('Decay must be between 0 and 1')
+        assert update_every >= 1
 
         self.m_name2s_name = {}
         self.register_buffer('decay', torch.tensor(decay, dtype=torch.float32))
         self.register_buffer('num_updates', torch.tensor(0,dtype=torch.int) if use_num_upates
                              else torch.tensor(-1,dtype=torch.int))
+        # python copies of the buffers, so forward needs no device sync
+        self.decay_value = decay
+        self.num_updates_value = 0 if use_num_upates else -1
+        self.update_every = update_every
+        self.offload = offload
+        self.num_calls = 0
 
+        params = []
         for name, p in model.named_parameters():
             if p.requires_grad:
                 #remove as '.'-character is not allowed in buffers
                 s_name = name.replace('.','')
                 self.m_name2s_name.update({name:s_name})
-                self.register_buffer(s_name,p.clone().detach().data)
+                params.append(p.detach())
+        self.shapes = [p.shape for p in params]
+        shadow = torch.cat([p.reshape(-1) for p in params]) if params else torch.zeros(0)
+        if offload:
+            shadow = shadow.cpu()
+            if torch.cuda.is_available():
+                shadow = shadow.pin_memory()
+        self.shadow = shadow
+        self.shadow_params = self.views(self.shadow)
+        # offload: the weights of the last update are copied asynchronously into a pinned
+        # staging buffer and folded into the shadow weights at the next update (or use)
+        self.staging = None
+        self.staging_event = None
+        self.pending_decay = None
+        self._model_id = None
+        self._model_params = None
 
         self.collected_params = []
 
+    def views(self, flat):
+        numels = [shape.numel() for shape in self.shapes]
+        return [chunk.view(shape) for chunk, shape in zip(flat.split(numels), self.shapes)]
+
+    def _apply(self, fn):
+        super()._apply(fn)
+        # the shadow weights are a plain attribute so they can stay on the CPU when offloaded
+        if not self.offload:
+            self.shadow = fn(self.shadow)
+            self.shadow_params = self.views(self.shadow)
+        return self
+
+    def model_params(self, model):
+        # the tracked parameters of model in shadow order, resolved once per model
+        if self._model_params is None or self._model_id != id(model):
+            m_param = dict(model.named_parameters())
+            for key in m_param:
+                if not m_param[key].requires_grad:
+                    assert not key in self.m_name2s_name
+            self._model_params = [m_param[key] for key in self.m_name2s_name]
+            self._model_id = id(model)
+        return self._model_params
+
     def forward(self,model):
-        decay = self.decay
+        self.num_calls += 1
+        decay = self.decay_value
 
-        if self.num_updates >= 0:
-            self.num_updates += 1
-            decay = min(self.decay,(1 + self.num_updates) / (10 + self.num_updates))
+        if self.num_updates_value >= 0:
+            self.num_updates_value += 1
+            self.num_updates.fill_(self.num_updates_value)
+            decay = min(decay,(1 + self.num_updates_value) / (10 + self.num_updates_value))
 
-        one_minus_decay = 1.0 - decay
+        if self.num_calls % self.update_every != 0:
+            return
+        # one update stands in for update_every steps
+        one_minus_decay = 1.0 - decay ** self.update_every
 
         with torch.no_grad():
-            m_param = dict(model.named_parameters())
-            shadow_params = dict(self.named_buffers())
-
-            for key in m_param:
-                if m_param[key].requires_grad:
-                    sname = self.m_name2s_name[key]
-                    shadow_params[sname] = shadow_params[sname].type_as(m_param[key])
-                    shadow_params[sname].sub_(one_minus_decay * (shadow_params[sname] - m_param[key]))
+            params = [p.detach() for p in self.model_params(model)]
+            if not params:
+                return
+            if self.offload:
+                self.flush()
+                if self.staging is None:
+                    self.staging = torch.empty(self.shadow.shape, dtype=self.shadow.dtype,
+                                               pin_memory=torch.cuda.is_available())
+                for staged, p in zip(self.views(self.staging), params):
+                    staged.copy_(p, non_blocking=True)
+                self.staging_event = None
+                if params[0].is_cuda:
+                    self.staging_event = torch.cuda.Event()
+                    self.staging_event.record()
+                self.pending_decay = one_minus_decay
+            else:
+                params = [p if p.dtype == s.dtype else p.to(s.dtype) for p, s in zip(params, self.shadow_params)]
+                if hasattr(torch, "_foreach_mul_"):
+                    torch._foreach_mul_(self.shadow_params, 1.0 - one_minus_decay)
+                    torch._foreach_add_(self.shadow_params, params, alpha=one_minus_decay)
                 else:
-                    assert not key in self.m_name2s_name
+                    for s, p in zip(self.shadow_params, params):
+                        s.sub_(one_minus_decay * (s - p))
+
+    @torch.no_grad()
+    def flush(self):
+        """fold a pending offloaded update into the shadow weights"""
+        if self.pending_decay is None:
+            return
+        if self.staging_event is not None:
+            # recorded one update ago, usually long done
+            self.staging_event.synchronize()
+        self.shadow.lerp_(self.staging, self.pending_decay)
+        self.pending_decay = None
+        self.staging_event = None
 
     def copy_to(self, model):
-        m_param = dict(model.named_parameters())
-        shadow_params = dict(self.named_buffers())
-        for key in m_param:
-            if m_param[key].requires_grad:
-                m_param[key].data.copy_(shadow_params[self.m_name2s_name[key]].data)
-            else:
-                assert not key in self.m_name2s_name
+        self.flush()
+        # in-place under no_grad instead of through .data so the version counters of the parameters change
+        with torch.no_grad():
+            for param, s_param in zip(self.model_params(model), self.shadow_params):
+                param.copy_(s_param)
+
+    @contextmanager
+    def swap(self, model):
+        """
+        Temporarily point the parameters of model at the shadow weights, without copying
+        the training weights. The training weights are put back on exit.
+        """
+        self.flush()
+        params = self.model_params(model)
+        stored = [param.data for param in params]
+        with torch.no_grad():
+            for param, s_param in zip(params, self.shadow_params):
+                param.data = s_param.to(param.device, param.dtype)
+                # .data does not change the version counter, bump it so caches keyed on
+                # (data_ptr, _version) of the weights see a change
+                param.view(-1)[:0].zero_()
+        try:
+            yield None
+        finally:
+            for param, data in zip(params, stored):
+                param.data = data
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        self.flush()
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+        for s_name, s_param in zip(self.m_name2s_name.values(), self.shadow_params):
+            destination[prefix + s_name] = s_param if keep_vars else s_param.detach()
+        # phase of update_every
+        destination[prefix + 'num_calls'] = torch.tensor(self.num_calls, dtype=torch.long)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # a pending update is superseded by the loaded weights
+        self.pending_decay = None
+        self.staging_event = None
+        s_keys = {prefix + 'num_calls'}
+        if prefix + 'num_calls' in state_dict:
+            self.num_calls = int(state_dict[prefix + 'num_calls'])
+        with torch.no_grad():
+            for s_name, s_param in zip(self.m_name2s_name.values(), self.shadow_params):
+                key = prefix + s_name
+                s_keys.add(key)
+                if key not in state_dict:
+                    missing_keys.append(key)
+                elif state_dict[key].shape != s_param.shape:
+                    error_msgs.append(f'size mismatch for {key}: copying a param with shape '
+                                      f'{tuple(state_dict[key].shape)}, the shape in current model is '
+                                      f'{tuple(s_param.shape)}.')
+                else:
+                    s_param.copy_(state_dict[key])
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+        unexpected_keys[:] = [key for key in unexpected_keys if key not in s_keys]
+        self.decay_value = self.decay.item()
+        self.num_updates_value = int(self.num_updates.item())
 
     def store(self, parameters):
         """
@@ -72,5 +212,6 @@ class LitEma(nn.Module):
           parameters: Iterable of `torch.nn.Parameter`; the parameters to be
             updated with the stored parameters.
         """
-        for c_param, param in zip(self.collected_params, parameters):
-            param.data.copy_(c_param.data)
\ No newline at end of file
+        with torch.no_grad():
+            for c_param, param in zip(self.collected_params, parameters):
+                param.copy_(c_param)
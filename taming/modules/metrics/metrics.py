@@ -1,17 +1,85 @@
+import hashlib
+import os
+
 import torch
+import torch.distributed as dist
 import torchmetrics
+from omegaconf import OmegaConf
 from torchmetrics.image.fid import FrechetInceptionDistance
 from torchmetrics.image.inception import InceptionScore
 
 
+REAL_STATES = ["real_features_sum", "real_features_cov_sum", "real_features_num_samples"]
+
 
 class FIDMetric(FrechetInceptionDistance):
+    """
+    FID between samples and ground truth. With a cache_dir the Inception statistics of the
+    ground truth are stored on disk after the first validation and loaded on later ones,
+    so that only the samples go through Inception. The cache is keyed by set_cache_key,
+    see cache_key_from_trainer, and the image resolution. On multiple devices cache_dir
+    has to be shared.
+    """
+    def __init__(self, cache_dir=None, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_dir = cache_dir
+        self.cache_key = None
+        self.cache_path = None
+        self.real_from_cache = False
+
+    @staticmethod
+    def cache_key_from_trainer(trainer):
+        """key of the validation subset: dataset config, batch size, number of batches and devices"""
+        datamodule = getattr(trainer, "datamodule", None)
+        configs = getattr(datamodule, "dataset_configs", {})
+        config = configs.get("validation")
+        if config is not None and OmegaConf.is_config(config):
+            config = OmegaConf.to_container(config, resolve=True)
+        return repr((config, getattr(datamodule, "batch_size", None), trainer.limit_val_batches,
+                     getattr(trainer, "num_val_batches", None), trainer.world_size))
+
+    def set_cache_key(self, key):
+        self.cache_key = key
+        self.cache_path = None
+        self.real_from_cache = False
+
+    def get_cache_path(self, gt):
+        key = hashlib.sha1(repr((self.cache_key, tuple(gt.shape[-3:]))).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"fid_real_{key}.pt")
+
+    def load_real_statistics(self):
+        # summed over devices on compute, so only the first holds the cached statistics
+        if dist.is_available() and dist.is_initialized() and dist.get_rank() != 0:
+            return
+        states = torch.load(self.cache_path, map_location=self.real_features_sum.device)
+        for name in REAL_STATES:
+            setattr(self, name, states[name].to(getattr(self, name)))
+
     def update(self, pred, gt):
         # convert to 255 uint8 as required by the module (as normalising has a bug)
         pred = (pred*255).to(torch.uint8).view(-1,*pred.shape[-3:])
         gt = (gt * 255).to(torch.uint8).view(-1,*gt.shape[-3:])
         super().update(pred,real=False)
-        super().update(gt, real=True )
+        if self.cache_dir is not None and self.cache_key is not None and self.cache_path is None:
+            self.cache_path = self.get_cache_path(gt)
+            self.real_from_cache = os.path.exists(self.cache_path)
+            if self.real_from_cache:
+                self.load_real_statistics()
+        if not self.real_from_cache:
+            super().update(gt, real=True )
+
+    def compute(self):
+        # runs on the statistics synced across devices
+        if self.cache_path is not None and not self.real_from_cache and self.real_features_num_samples > 0:
+            if not (dist.is_available() and dist.is_initialized() and dist.get_rank() != 0):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                torch.save({name: getattr(self, name).cpu() for name in REAL_STATES}, self.cache_path)
+        return super().compute()
+
+    def reset(self):
+        super().reset()
+        self.cache_path = None
+        self.real_from_cache = False
 
 
 class InceptionMetric(InceptionScore):
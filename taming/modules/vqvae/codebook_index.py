@@ -0,0 +1,192 @@
+import torch
+import torch.nn as nn
+
+
+def squared_distances(z, embedding):
+    # (z - e)^2 = z^2 + e^2 - 2 e * z
+    return torch.sum(z ** 2, dim=1, keepdim=True) + torch.sum(embedding ** 2, dim=1) - 2 * z @ embedding.t()
+
+
+class IVFCodebookIndex(nn.Module):
+    """
+    Inverted file index for the nearest-codebook search of very large codebooks.
+    The codebook is clustered by k-means into n_lists coarse centroids, and every
+    query only computes exact distances to the entries of its n_probe nearest
+    lists, about n_e * n_probe / n_lists instead of n_e distances.
+    Used by VectorQuantizer2 and SamplingQuantizer through index_config, e.g.
+        index_config:
+          target: taming.modules.vqvae.codebook_index.IVFCodebookIndex
+          params:
+            n_lists: 512
+            n_probe: 16
+    :param n_lists: number of k-means clusters of the codebook.
+    :param n_probe: number of clusters searched per query.
+    :param kmeans_iters: Lloyd iterations per build.
+    :param rebuild_every: rebuild the clusters after this many training searches.
+        In eval the index is frozen and only rebuilt if the codebook weights change.
+    :param recall_every: every recall_every searches, compare against exact search
+        and store the recall@k of that batch in last_recall. 0 disables it.
+    :param query_chunk_size: queries per block.
+    :param max_gather_elements: bounds the candidate vectors gathered per block,
+        blocks hold fewer queries if query_chunk_size x n_probe x max list size x
+        embed_dim would exceed it.
+    :param seed: seed of the k-means initialisation, so all ranks build the same index.
+    """
+    def __init__(self, n_lists=256, n_probe=8, kmeans_iters=10, rebuild_every=1000, recall_every=100,
+                 query_chunk_size=4096, max_gather_elements=2**22, seed=0):
+        super().__init__()
+        assert 0 < n_probe <= n_lists
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.kmeans_iters = kmeans_iters
+        self.rebuild_every = rebuild_every
+        self.recall_every = recall_every
+        self.query_chunk_size = query_chunk_size
+        self.max_gather_elements = max_gather_elements
+        self.seed = seed
+        # built lazily from the codebook, not part of the state dict
+        self.centroids = None
+        self.order = None
+        self.starts = None
+        self.counts = None
+        self.list_size = None
+        self.codebook_key = None
+        # the codebook in cluster order, refreshed whenever it changes
+        self.sorted_vectors = None
+        self.sorted_norms = None
+        self.vectors_key = None
+        self.steps_since_build = 0
+        self.num_searches = 0
+        self.last_recall = None
+
+    @staticmethod
+    def key(embedding):
+        return embedding.data_ptr(), embedding._version, embedding.shape, embedding.device
+
+    def nearest_centroid(self, embedding, centroids):
+        return torch.cat([squared_distances(chunk, centroids).argmin(dim=1)
+                          for chunk in embedding.split(self.query_chunk_size)])
+
+    @torch.no_grad()
+    def build(self, embedding, weight=None):
+        weight = embedding if weight is None else weight
+        embedding = embedding.detach().float()
+        n_e = embedding.shape[0]
+        n_lists = min(self.n_lists, n_e)
+        # fixed generator on the cpu, the same initialisation on every rank and device
+        generator = torch.Generator().manual_seed(self.seed)
+        init = torch.randperm(n_e, generator=generator)[:n_lists].to(embedding.device)
+        centroids = embedding[init].clone()
+        for _ in range(self.kmeans_iters):
+            assignment = self.nearest_centroid(embedding, centroids)
+            counts = torch.bincount(assignment, minlength=n_lists)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, embedding)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None].float()
+        assignment = self.nearest_centroid(embedding, centroids)
+
+        # codebook ids sorted by cluster, cluster l holds order[starts[l]:starts[l] + counts[l]].
+        # the extra last entry is the padding of shorter lists
+        counts = torch.bincount(assignment, minlength=n_lists)
+        order = torch.argsort(assignment)
+        self.order = torch.cat([order, order.new_zeros(1)])
+        self.starts = torch.cumsum(counts, 0) - counts
+        self.counts = counts
+        self.list_size = int(counts.max())
+        self.centroids = centroids
+        self.codebook_key = self.key(weight)
+        self.steps_since_build = 0
+        self.refresh(embedding, weight)
+
+    @torch.no_grad()
+    def refresh(self, embedding, weight=None):
+        """gather the codebook in cluster order, once per change of the codebook"""
+        weight = embedding if weight is None else weight
+        embedding = embedding.detach()
+        n_e = embedding.shape[0]
+        self.sorted_vectors = torch.cat([embedding[self.order[:n_e]], embedding.new_zeros(1, embedding.shape[1])])
+        norms = torch.sum(self.sorted_vectors.float() ** 2, dim=1)
+        norms[n_e] = float('inf')
+        self.sorted_norms = norms
+        self.vectors_key = self.key(weight)
+
+    def update(self, embedding, training, weight=None):
+        """
+        (re)build the index if it is missing or out of date
+        :param embedding: the vectors searched, e.g. the normalised codebook.
+        :param weight: the codebook parameter they are computed from, used to detect changes.
+        """
+        weight = embedding if weight is None else weight
+        if self.centroids is None or self.centroids.device != embedding.device:
+            self.build(embedding, weight)
+        elif training:
+            self.steps_since_build += 1
+            if self.steps_since_build >= self.rebuild_every:
+                self.build(embedding, weight)
+        elif self.key(weight) != self.codebook_key:
+            self.build(embedding, weight)
+        if self.key(weight) != self.vectors_key:
+            # the clusters may be stale in training, the distances are not
+            self.refresh(embedding, weight)
+
+    @torch.no_grad()
+    def exact_search(self, z, embedding, k=1):
+        dists, inds = [], []
+        for chunk in z.split(self.query_chunk_size):
+            dist, ind = torch.topk(squared_distances(chunk, embedding), k, dim=1, largest=False)
+            dists.append(dist)
+            inds.append(ind)
+        return torch.cat(dists), torch.cat(inds)
+
+    @torch.no_grad()
+    def search(self, z, embedding, k=1):
+        """
+        approximate k nearest codebook entries of every row of z, distances are exact
+        to the current embedding, only the clusters may be stale
+        :param embedding: the embedding the index was last updated with.
+        :return: [N x k] distances and indices, nearest first
+        """
+        n_lists, list_size = self.starts.shape[0], self.list_size
+        n_probe = min(self.n_probe, n_lists)
+        assert n_probe * list_size >= k, f'n_probe={n_probe} lists hold fewer than k={k} entries'
+        n_e, embed_dim = self.sorted_vectors.shape[0] - 1, self.sorted_vectors.shape[1]
+        chunk_size = max(1, min(self.query_chunk_size, self.max_gather_elements // (n_probe * list_size * embed_dim)))
+        slots = torch.arange(list_size, device=z.device)
+
+        dists, inds = [], []
+        for chunk in z.split(chunk_size):
+            probe = torch.topk(squared_distances(chunk, self.centroids.to(chunk.dtype)), n_probe, dim=1,
+                               largest=False).indices
+            # positions of the probed entries in the sorted codebook, [chunk x n_probe * list_size],
+            # slots past the end of a list point at the padding entry
+            position = self.starts[probe][..., None] + slots
+            position = torch.where(slots < self.counts[probe][..., None], position, torch.full_like(position, n_e))
+            position = position.reshape(chunk.shape[0], -1)
+            candidates = self.order[position]
+            # one batched matmul of every query with its candidates, no grouping on the host
+            vectors = self.sorted_vectors[position].to(chunk.dtype)
+            dots = torch.bmm(vectors, chunk[:, :, None]).squeeze(-1)
+            d = torch.sum(chunk ** 2, dim=1, keepdim=True) + self.sorted_norms[position].to(chunk.dtype) - 2 * dots
+            dist, slot = torch.topk(d, k, dim=1, largest=False)
+            ind = candidates.gather(1, slot)
+            # fewer than k valid candidates, fall back to the nearest one
+            missing = torch.isinf(dist)
+            dist = torch.where(missing, dist[:, :1], dist)
+            ind = torch.where(missing, ind[:, :1], ind)
+            dists.append(dist)
+            inds.append(ind)
+        dists, inds = torch.cat(dists), torch.cat(inds)
+
+        self.num_searches += 1
+        if self.recall_every and (self.num_searches - 1) % self.recall_every == 0:
+            self.last_recall = self.recall(z, embedding, k, inds)
+        return dists, inds
+
+    @torch.no_grad()
+    def recall(self, z, embedding, k=1, inds=None):
+        """fraction of the exact k nearest entries found by the index"""
+        if inds is None:
+            inds = self.search(z, embedding, k)[1]
+        exact = self.exact_search(z, embedding, k)[1]
+        found = (inds[:, :, None] == exact[:, None, :]).any(dim=1)
+        return found.float().mean().item()
@@ -5,6 +5,8 @@ import numpy as np
 from torch import einsum
 from einops import rearrange
 
+from taming.util import instantiate_from_config
+
 
 class VectorQuantizer(nn.Module):
     """
@@ -107,7 +109,59 @@ class VectorQuantizer(nn.Module):
         return z_q
 
 
-class GumbelQuantize(nn.Module):
+class RemapMixin(object):
+    """
+    Post-hoc remapping of codebook indices to the subset `used` stored in the .npy file remap.
+    Both directions are lookups in dense tables instead of comparisons against `used`.
+    """
+    def init_remap(self, remap, unknown_index, n_embed):
+        self.remap = remap
+        if self.remap is not None:
+            self.register_buffer("used", torch.tensor(np.load(self.remap)))
+            self.re_embed = self.used.shape[0]
+            self.unknown_index = unknown_index # "random" or "extra" or integer
+            if self.unknown_index == "extra":
+                self.unknown_index = self.re_embed
+                self.re_embed = self.re_embed+1
+            print(f"Remapping {n_embed} indices to {self.re_embed} indices. "
+                  f"Using {self.unknown_index} for unknown indices.")
+            # to_used[i] is the position of codebook index i in used, -1 if unused. derived from
+            # used, so not part of the state dict and rebuilt whenever used is loaded
+            self.register_buffer("to_used", self.build_remap_table(n_embed), persistent=False)
+        else:
+            self.re_embed = n_embed
+        self.remap_n_embed = n_embed
+
+    def build_remap_table(self, n_embed):
+        used = self.used.cpu().numpy()
+        table = np.full(n_embed, -1, dtype=np.int64)
+        _, first = np.unique(used, return_index=True)  # duplicates map to their first position
+        table[used[first]] = first
+        return torch.from_numpy(table).to(self.used.device)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        if self.remap is not None:
+            self.to_used = self.build_remap_table(self.remap_n_embed)
+
+    def remap_to_used(self, inds):
+        assert len(inds.shape)>1
+        new = self.to_used[inds.long()]
+        unknown = new < 0
+        if self.unknown_index == "random":
+            new = torch.where(unknown, torch.randint_like(new, 0, self.re_embed), new)
+        else:
+            new = new.masked_fill(unknown, self.unknown_index)
+        return new.to(inds.dtype)
+
+    def unmap_to_all(self, inds):
+        assert len(inds.shape)>1
+        if self.re_embed > self.used.shape[0]: # extra token
+            inds = inds.masked_fill(inds>=self.used.shape[0], 0) # simply set to zero
+        return self.used[inds.long()].to(inds.dtype)
+
+
+class GumbelQuantize(RemapMixin, nn.Module):
     """
     credit to @karpathy: https://github.com/karpathy/deep-vector-quantization/blob/main/model.py (thanks!)
     Gumbel Softmax trick quantizer
@@ -131,42 +185,7 @@ class GumbelQuantize(nn.Module):
 
         self.use_vqinterface = use_vqinterface
 
-        self.remap = remap
-        if self.remap is not None:
-            self.register_buffer("used", torch.tensor(np.load(self.remap)))
-            self.re_embed = self.used.shape[0]
-            self.unknown_index = unknown_index # "random" or "extra" or integer
-            if self.unknown_index == "extra":
-                self.unknown_index = self.re_embed
-                self.re_embed = self.re_embed+1
-            print(f"Remapping {self.n_embed} indices to {self.re_embed} indices. "
-                  f"Using {self.unknown_index} for unknown indices.")
-        else:
-            self.re_embed = n_embed
-
-    def remap_to_used(self, inds):
-        ishape = inds.shape
-        assert len(ishape)>1
-        inds = inds.reshape(ishape[0],-1)
-        used = self.used.to(inds)
-        match = (inds[:,:,None]==used[None,None,...]).long()
-        new = match.argmax(-1)
-        unknown = match.sum(2)<1
-        if self.unknown_index == "random":
-            new[unknown]=torch.randint(0,self.re_embed,size=new[unknown].shape).to(device=new.device)
-        else:
-            new[unknown] = self.unknown_index
-        return new.reshape(ishape)
-
-    def unmap_to_all(self, inds):
-        ishape = inds.shape
-        assert len(ishape)>1
-        inds = inds.reshape(ishape[0],-1)
-        used = self.used.to(inds)
-        if self.re_embed > self.used.shape[0]: # extra token
-            inds[inds>=self.used.shape[0]] = 0 # simply set to zero
-        back=torch.gather(used[None,:][inds.shape[0]*[0],:], 1, inds)
-        return back.reshape(ishape)
+        self.init_remap(remap, unknown_index, n_embed)
 
     def forward(self, z, temp=None, return_logits=False):
         # force hard = True when we are in eval mode, as we must quantize. actually, always true seems to work
@@ -210,7 +229,7 @@ class GumbelQuantize(nn.Module):
         return z_q
 
 
-class VectorQuantizer2(nn.Module):
+class VectorQuantizer2(RemapMixin, nn.Module):
     """
     Improved version over VectorQuantizer, can be used as a drop-in replacement. Mostly
     avoids costly matrix multiplications and allows for post-hoc remapping of indices.
@@ -219,53 +238,50 @@ class VectorQuantizer2(nn.Module):
     # backwards compatibility we use the buggy version by default, but you can
     # specify legacy=False to fix it.
     def __init__(self, n_e, e_dim, beta, remap=None, unknown_index="random",
-                 sane_index_shape=False):
+                 sane_index_shape=False, search_chunk_size=None, index_config=None):
         super().__init__()
         self.n_e = n_e
         self.e_dim = e_dim
         self.beta = beta
+        # rows per block of the codebook search, bounds the distance matrix to search_chunk_size x n_e
+        self.search_chunk_size = search_chunk_size
+        # optional approximate search, see taming.modules.vqvae.codebook_index
+        self.index = instantiate_from_config(index_config) if index_config is not None else None
 
         self.embedding = nn.Embedding(self.n_e, self.e_dim)
         self.embedding.weight.data.uniform_(-1.0 / self.n_e, 1.0 / self.n_e)
 
-        self.remap = remap
-        if self.remap is not None:
-            self.register_buffer("used", torch.tensor(np.load(self.remap)))
-            self.re_embed = self.used.shape[0]
-            self.unknown_index = unknown_index # "random" or "extra" or integer
-            if self.unknown_index == "extra":
-                self.unknown_index = self.re_embed
-                self.re_embed = self.re_embed+1
-            print(f"Remapping {self.n_e} indices to {self.re_embed} indices. "
-                  f"Using {self.unknown_index} for unknown indices.")
-        else:
-            self.re_embed = n_e
+        self.init_remap(remap, unknown_index, n_e)
 
         self.sane_index_shape = sane_index_shape
 
-    def remap_to_used(self, inds):
-        ishape = inds.shape
-        assert len(ishape)>1
-        inds = inds.reshape(ishape[0],-1)
-        used = self.used.to(inds)
-        match = (inds[:,:,None]==used[None,None,...]).long()
-        new = match.argmax(-1)
-        unknown = match.sum(2)<1
-        if self.unknown_index == "random":
-            new[unknown]=torch.randint(0,self.re_embed,size=new[unknown].shape).to(device=new.device)
-        else:
-            new[unknown] = self.unknown_index
-        return new.reshape(ishape)
+    @staticmethod
+    def codebook_distances(z_flattened, embedding):
+        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
+        return torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
+            torch.sum(embedding ** 2, dim=1) - 2 * \
+            torch.einsum('bd,dn->bn', z_flattened, rearrange(embedding, 'n d -> d n'))
 
-    def unmap_to_all(self, inds):
-        ishape = inds.shape
-        assert len(ishape)>1
-        inds = inds.reshape(ishape[0],-1)
-        used = self.used.to(inds)
-        if self.re_embed > self.used.shape[0]: # extra token
-            inds[inds>=self.used.shape[0]] = 0 # simply set to zero
-        back=torch.gather(used[None,:][inds.shape[0]*[0],:], 1, inds)
-        return back.reshape(ishape)
+    @torch.no_grad()
+    def search(self, z_flattened, embedding, k=1):
+        """
+        k nearest codebook entries of every row, in blocks of search_chunk_size rows
+        :return: [N x k] distances and indices, nearest first
+        """
+        if self.index is not None:
+            self.index.update(embedding, self.training, weight=self.embedding.weight)
+            return self.index.search(z_flattened, embedding, k)
+        chunk_size = self.search_chunk_size or z_flattened.shape[0]
+        dists, inds = [], []
+        for z_chunk in z_flattened.split(chunk_size):
+            d = self.codebook_distances(z_chunk, embedding)
+            if k == 1:
+                dist, ind = d.min(dim=1, keepdim=True)
+            else:
+                dist, ind = torch.topk(d, k, dim=1, largest=False)
+            dists.append(dist)
+            inds.append(ind)
+        return torch.cat(dists), torch.cat(inds)
 
     def forward(self, z, temp=None, rescale_logits=False, return_logits=False):
         assert temp is None or temp==1.0, "Only for interface compatible with Gumbel"
@@ -274,13 +290,8 @@ class VectorQuantizer2(nn.Module):
         # reshape z -> (batch, height, width, channel) and flatten
         z = rearrange(z, 'b c h w -> b h w c').contiguous()
         z_flattened = z.view(-1, self.e_dim)
-        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
-
-        d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
-            torch.sum(self.embedding.weight**2, dim=1) - 2 * \
-            torch.einsum('bd,dn->bn', z_flattened, rearrange(self.embedding.weight, 'n d -> d n'))
 
-        min_encoding_indices = torch.argmin(d, dim=1)
+        min_encoding_indices = self.search(z_flattened, self.embedding.weight)[1][:, 0]
         z_q = self.embedding(min_encoding_indices).view(z.shape)
         perplexity = None
         min_encodings = None
@@ -328,14 +339,42 @@ class SamplingQuantizer(VectorQuantizer2):
     """
     Improved version over VectorQuantizer2 with L2 norm and top k.
     """
+    # training samples among the sample_top_k nearest entries, softmax(1 / d / sample_temperature)
+    sample_top_k = 16
+    sample_temperature = 0.5
+
     def __init__(self, n_e, e_dim, beta, remap=None, unknown_index="random",
-                 sane_index_shape=False):
+                 sane_index_shape=False, search_chunk_size=None, index_config=None):
         super().__init__(n_e, e_dim, beta, remap=remap, unknown_index=unknown_index,
-                         sane_index_shape=sane_index_shape)
+                         sane_index_shape=sane_index_shape, search_chunk_size=search_chunk_size,
+                         index_config=index_config)
+        self._normalized_embedding = None
+        self._normalized_embedding_key = None
 
     def normalise(self, z):
         return torch.nn.functional.normalize(z,dim=-1)
 
+    def normalized_codebook(self):
+        """the normalised codebook, cached in eval mode until the weights change"""
+        weight = self.embedding.weight
+        if self.training or (torch.is_grad_enabled() and weight.requires_grad):
+            self._normalized_embedding = self._normalized_embedding_key = None
+            return self.normalise(weight)
+        key = (weight.data_ptr(), weight._version, weight.dtype)
+        if key != self._normalized_embedding_key:
+            self._normalized_embedding = self.normalise(weight.detach())
+            self._normalized_embedding_key = key
+        return self._normalized_embedding
+
+    @torch.no_grad()
+    def sample_codes(self, z_search, normalized_embedding):
+        """sample among the sample_top_k nearest entries per row, searched in chunks"""
+        dists, inds = self.search(z_search, normalized_embedding, k=self.sample_top_k)
+        logits = 1 / dists.clamp(min=1e-8)  # dist may go close to 0
+        probs = torch.nn.functional.softmax(logits / self.sample_temperature, dim=-1)
+        choice = torch.multinomial(probs, num_samples=1)
+        return inds.gather(1, choice).squeeze(1)
+
     def forward(self, z, temp=None, rescale_logits=False, return_logits=False, sample=True):
         assert temp is None or temp==1.0, "Only for interface compatible with Gumbel"
         assert rescale_logits==False, "Only for interface compatible with Gumbel"
@@ -345,25 +384,23 @@ class SamplingQuantizer(VectorQuantizer2):
         z_flattened = z.view(-1, self.e_dim)
 
         z_search = self.normalise(z_flattened)
-        normalized_embedding = self.normalise(self.embedding.weight)
-
-        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
-        d = torch.sum(z_search ** 2, dim=1, keepdim=True) + \
-            torch.sum(normalized_embedding **2, dim=1) - 2 * \
-            torch.einsum('bd,dn->bn', z_search, rearrange(normalized_embedding, 'n d -> d n'))
+        normalized_embedding = self.normalized_codebook()
 
-        if sample and self.training:
+        if sample and self.training and (self.search_chunk_size is not None or self.index is not None):
+            min_encoding_indices = self.sample_codes(z_search, normalized_embedding)
+        elif sample and self.training:
+            d = self.codebook_distances(z_search, normalized_embedding)
             logits = 1 / d.clamp(min=1e-8) # dist may go close to 0
             logits = logits - logits.amax(dim=-1, keepdim=True).detach()  # numerical stability for softmax
-            v, _ = torch.topk(logits, 16, dim=-1)
+            v, _ = torch.topk(logits, self.sample_top_k, dim=-1)
             min_logit_per_token = v.min(-1)[0].unsqueeze(-1)
             min_logit_per_token = min_logit_per_token.repeat(1,logits.shape[-1])
             logits[logits<min_logit_per_token] = -float('Inf')
 
-            probs = torch.nn.functional.softmax(logits/0.5, dim=-1)
+            probs = torch.nn.functional.softmax(logits/self.sample_temperature, dim=-1)
             min_encoding_indices = torch.multinomial(probs, num_samples=1).squeeze()
         else:
-            min_encoding_indices = torch.argmin(d, dim=1)
+            min_encoding_indices = self.search(z_search, normalized_embedding)[1][:, 0]
 
         z_q = self.embedding(min_encoding_indices).view(z.shape)
         min_encodings = None
@@ -96,6 +96,19 @@ def count_params(model, verbose=False):
     return total_params
 
 
+def images_to_tensor(x, device=None):
+    """
+    [B x H x W x C] image batch -> contiguous float [B x C x H x W] in [-1, 1]. uint8 batches
+    (datasets with uint8: true) are moved to device first and normalised there.
+    """
+    if x.dtype == torch.uint8:
+        x = x.to(device, non_blocking=True) if device is not None else x
+        x = x.permute(0, 3, 1, 2).to(torch.float32, memory_format=torch.contiguous_format)
+        return x.mul_(1 / 127.5).sub_(1.0)
+    x = x.permute(0, 3, 1, 2).to(memory_format=torch.contiguous_format)
+    return x.float()
+
+
 def instantiate_from_config(config):
     if not "target" in config:
         if config == '__is_first_stage__':
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import torch
+
+from taming.modules.diffusionmodules.dpm_solver import DPMSolverSampler
+from taming.modules.diffusionmodules.util import make_beta_schedule
+
+
+class GaussianData(object):
+    """
+    eps-prediction model of the exact denoiser for data from N(0, std^2 I). The
+    probability flow ODE then only rescales x with the marginal standard deviation,
+    x_t = x_T * sqrt(a_t std^2 + 1 - a_t) / sqrt(a_T std^2 + 1 - a_T).
+    """
+    def __init__(self, std=0.5, num_timesteps=1000):
+        self.std = std
+        self.num_timesteps = num_timesteps
+        self.parameterization = "eps"
+        self.betas = torch.as_tensor(make_beta_schedule("linear", num_timesteps, 1e-4, 2e-2))
+        self.alphas_cumprod = torch.cumprod(1. - self.betas, dim=0)
+
+    def marginal_std(self, t):
+        a = self.alphas_cumprod[t]
+        return (a * self.std ** 2 + 1. - a).sqrt()
+
+    def apply_model(self, x, t, cond):
+        a = self.alphas_cumprod[t].view(-1, 1, 1, 1).to(x.dtype)
+        return (1. - a).sqrt() * x / (a * self.std ** 2 + 1. - a)
+
+
+def exponential_integrator(sampler, x, i, coefficients):
+    """
+    Closed form of the DPM-Solver++ ODE from time point i-1 to i for a data prediction
+    that is a polynomial c0 + c1 * lambda + c2 * lambda^2 in the log-SNR lambda:
+    x_i = sigma_i / sigma_{i-1} * x + sigma_i * int exp(lambda) x0(lambda) dlambda
+    """
+    c0, c1, c2 = (list(coefficients) + [0., 0., 0.])[:3]
+    antiderivative = lambda l: np.exp(l) * (c0 + c1 * (l - 1.) + c2 * (l * l - 2. * l + 2.))
+    integral = antiderivative(sampler.lambdas[i]) - antiderivative(sampler.lambdas[i - 1])
+    return sampler.sigmas[i] / sampler.sigmas[i - 1] * x + sampler.sigmas[i] * integral
+
+
+@pytest.mark.parametrize("order, coefficients", [(1, [0.7]), (2, [0.7]), (3, [0.7]), (3, [0.7, -0.3])])
+@pytest.mark.parametrize("i", [3, 6, 9])
+def test_update_is_exact_for_polynomial_data_predictions(order, coefficients, i):
+    # the order k update integrates data predictions exactly up to degree max(k - 2, 0)
+    sampler = DPMSolverSampler(GaussianData(), order=order)
+    sampler.make_schedule(10, verbose=False)
+    x = torch.tensor(0.4, dtype=torch.float64)
+    x0 = lambda l: torch.tensor(sum(c * l ** n for n, c in enumerate(coefficients)), dtype=torch.float64)
+    model_outputs = [x0(sampler.lambdas[j]) for j in range(i - order, i)]
+    expected = exponential_integrator(sampler, 0.4, i, coefficients)
+    assert sampler.update(x, model_outputs, i, order).item() == pytest.approx(expected, abs=1e-12)
+
+
+def test_second_order_update_has_third_order_local_error():
+    errors = []
+    for num_steps in [20, 40, 80]:
+        sampler = DPMSolverSampler(GaussianData(), order=2)
+        sampler.make_schedule(num_steps, verbose=False)
+        i = num_steps // 2
+        model_outputs = [torch.tensor(0.7 - 0.3 * sampler.lambdas[j], dtype=torch.float64) for j in (i - 2, i - 1)]
+        x = sampler.update(torch.tensor(0.4, dtype=torch.float64), model_outputs, i, 2).item()
+        errors.append(abs(x - exponential_integrator(sampler, 0.4, i, [0.7, -0.3])))
+    assert errors[0] / errors[1] > 6 and errors[1] / errors[2] > 6
+
+
+def test_sampling_gaussian_data_matches_closed_form():
+    model = GaussianData()
+    torch.manual_seed(0)
+    x_T = torch.randn(4, 3, 4, 4, dtype=torch.float64)
+    expected = x_T * model.marginal_std(0) / model.marginal_std(model.num_timesteps - 1)
+    errors = []
+    for order in [1, 2, 3]:
+        sampler = DPMSolverSampler(model, order=order, discretize="quad")
+        samples, _ = sampler.sample(10, 4, (3, 4, 4), None, x_T=x_T, verbose=False)
+        errors.append(((samples - expected).abs().max() / expected.abs().max()).item())
+    assert errors[0] < 0.2
+    assert errors[1] < errors[0] / 4 and errors[2] < errors[1]
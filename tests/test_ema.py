@@ -0,0 +1,113 @@
+import pytest
+import torch
+from torch import nn
+
+from taming.modules.ema import LitEma
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(4, 8), nn.ReLU(), nn.Linear(8, 2))
+    model[0].bias.requires_grad_(False)
+    return model
+
+
+def perturb(model, seed):
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(0.1 * torch.randn_like(p))
+
+
+class ReferenceEma(object):
+    """the per-parameter update of the original LitEma"""
+    def __init__(self, model, decay, use_num_updates=True):
+        self.decay = decay
+        self.num_updates = 0 if use_num_updates else -1
+        self.shadow = {name: p.detach().clone() for name, p in model.named_parameters() if p.requires_grad}
+
+    def __call__(self, model):
+        decay = self.decay
+        if self.num_updates >= 0:
+            self.num_updates += 1
+            decay = min(self.decay, (1 + self.num_updates) / (10 + self.num_updates))
+        for name, p in model.named_parameters():
+            if name in self.shadow:
+                self.shadow[name].sub_((1.0 - decay) * (self.shadow[name] - p.detach()))
+
+
+def assert_matches(ema, reference):
+    ema.flush()
+    for name, s_param in zip(ema.m_name2s_name, ema.shadow_params):
+        assert torch.allclose(s_param, reference.shadow[name], atol=1e-6), name
+
+
+@pytest.mark.parametrize("offload", [False, True])
+@pytest.mark.parametrize("use_num_updates", [True, False])
+def test_update_matches_reference(offload, use_num_updates):
+    model = make_model()
+    ema = LitEma(model, decay=0.9, use_num_upates=use_num_updates, offload=offload)
+    reference = ReferenceEma(model, decay=0.9, use_num_updates=use_num_updates)
+    for step in range(5):
+        perturb(model, step)
+        ema(model)
+        reference(model)
+    assert_matches(ema, reference)
+    assert int(ema.num_updates) == reference.num_updates
+
+
+def test_update_every_folds_the_skipped_steps():
+    # with unchanged weights between the calls, one update with decay ** n equals n updates
+    model = make_model()
+    ema = LitEma(model, decay=0.9, use_num_upates=False, update_every=2)
+    reference = ReferenceEma(model, decay=0.9, use_num_updates=False)
+    for step in range(3):
+        perturb(model, step)
+        for _ in range(2):
+            ema(model)
+            reference(model)
+    assert_matches(ema, reference)
+
+
+@pytest.mark.parametrize("offload", [False, True])
+def test_copy_to_and_swap(offload):
+    model = make_model()
+    ema = LitEma(model, decay=0.5, offload=offload)
+    perturb(model, 0)
+    ema(model)
+    weights = [p.detach().clone() for p in model.parameters()]
+    versions = [p._version for p in model.parameters() if p.requires_grad]
+
+    with ema.swap(model):
+        swapped = [p for p in model.parameters() if p.requires_grad]
+        assert all(torch.equal(p, s) for p, s in zip(swapped, ema.shadow_params))
+        assert all(p._version > v for p, v in zip(swapped, versions))
+    assert all(torch.equal(p, w) for p, w in zip(model.parameters(), weights))
+
+    other = make_model()
+    ema.copy_to(other)
+    trainable = [p for p in other.parameters() if p.requires_grad]
+    assert all(torch.equal(p, s) for p, s in zip(trainable, ema.shadow_params))
+
+
+def test_state_dict_keeps_the_per_parameter_layout():
+    model = make_model()
+    ema = LitEma(model, decay=0.9, update_every=3)
+    perturb(model, 0)
+    for _ in range(4):
+        ema(model)
+    state = ema.state_dict()
+    # one key per trainable parameter as in the original per-buffer layout, plus the update phase
+    assert set(state) == {"decay", "num_updates", "num_calls", "0weight", "2weight", "2bias"}
+    assert torch.equal(state["2bias"], ema.shadow_params[-1])
+
+    restored = LitEma(make_model(), decay=0.9, update_every=3)
+    restored.load_state_dict(state)
+    assert restored.num_calls == 4 and restored.num_updates_value == 4
+    assert all(torch.equal(a, b) for a, b in zip(restored.shadow_params, ema.shadow_params))
+
+    # checkpoints of the original LitEma have no num_calls
+    old_state = {k: v for k, v in state.items() if k != "num_calls"}
+    restored = LitEma(make_model(), decay=0.9)
+    restored.load_state_dict(old_state, strict=True)
+    assert all(torch.equal(a, b) for a, b in zip(restored.shadow_params, ema.shadow_params))
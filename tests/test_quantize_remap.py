@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import torch
+
+from taming.modules.vqvae.quantize import VectorQuantizer2, GumbelQuantize
+
+
+N_EMBED = 16
+# 7 appears twice, remapping uses its first position
+USED = np.array([3, 7, 1, 12, 7, 0])
+
+
+@pytest.fixture
+def remap(tmp_path):
+    path = str(tmp_path / "used.npy")
+    np.save(path, USED)
+    return path
+
+
+def reference_remap_to_used(quantizer, inds):
+    """the per-quantizer comparison against used of the original implementation"""
+    ishape = inds.shape
+    inds = inds.reshape(ishape[0], -1)
+    used = quantizer.used.to(inds)
+    match = (inds[:, :, None] == used[None, None, ...]).long()
+    new = match.argmax(-1)
+    unknown = match.sum(2) < 1
+    if quantizer.unknown_index == "random":
+        new[unknown] = torch.randint(0, quantizer.re_embed, size=new[unknown].shape).to(device=new.device)
+    else:
+        new[unknown] = quantizer.unknown_index
+    return new.reshape(ishape)
+
+
+def reference_unmap_to_all(quantizer, inds):
+    ishape = inds.shape
+    inds = inds.reshape(ishape[0], -1).clone()
+    used = quantizer.used.to(inds)
+    if quantizer.re_embed > quantizer.used.shape[0]:
+        inds[inds >= quantizer.used.shape[0]] = 0
+    back = torch.gather(used[None, :][inds.shape[0] * [0], :], 1, inds)
+    return back.reshape(ishape)
+
+
+def make_quantizer(cls, remap, unknown_index):
+    if cls is GumbelQuantize:
+        return GumbelQuantize(8, 4, N_EMBED, remap=remap, unknown_index=unknown_index)
+    return VectorQuantizer2(N_EMBED, 4, 0.25, remap=remap, unknown_index=unknown_index)
+
+
+@pytest.mark.parametrize("cls", [VectorQuantizer2, GumbelQuantize])
+@pytest.mark.parametrize("unknown_index", ["extra", 2])
+def test_remap_matches_reference(remap, cls, unknown_index):
+    quantizer = make_quantizer(cls, remap, unknown_index)
+    inds = torch.arange(N_EMBED).repeat(3, 1).reshape(3, 4, 4)
+    remapped = quantizer.remap_to_used(inds)
+    assert torch.equal(remapped, reference_remap_to_used(quantizer, inds))
+    assert torch.equal(quantizer.unmap_to_all(remapped), reference_unmap_to_all(quantizer, remapped))
+
+
+def test_random_unknown_index(remap):
+    quantizer = make_quantizer(VectorQuantizer2, remap, "random")
+    inds = torch.arange(N_EMBED).repeat(4, 1)
+    remapped = quantizer.remap_to_used(inds)
+    known = torch.from_numpy(np.isin(np.arange(N_EMBED), USED)).repeat(4, 1)
+    assert torch.equal(remapped[known], reference_remap_to_used(quantizer, inds)[known])
+    assert ((remapped[~known] >= 0) & (remapped[~known] < quantizer.re_embed)).all()
+
+
+def test_table_follows_loaded_used(remap):
+    quantizer = make_quantizer(VectorQuantizer2, remap, "extra")
+    state = quantizer.state_dict()
+    state["used"] = torch.from_numpy(USED[::-1].copy())
+    quantizer.load_state_dict(state)
+    inds = torch.arange(N_EMBED).repeat(2, 1)
+    assert torch.equal(quantizer.remap_to_used(inds), reference_remap_to_used(quantizer, inds))
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+
+from taming.data.shards import ShardWriter, ShardedDataset
+
+
+@pytest.fixture(scope="module")
+def shard_dir(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("shards"))
+    with ShardWriter(path, examples_per_shard=7) as writer:
+        for i in range(61):
+            image = np.random.RandomState(i).randint(0, 256, (8, 8, 3)).astype(np.uint8)
+            writer.write({"image": image, "class_label": i})
+    return path
+
+
+def labels(path, rank, world_size, batch_size, num_workers, epoch=0, start_batch=0, epochs=1):
+    # set up like DataModuleFromConfig, which always sets the position before building the loader
+    dataset = ShardedDataset(path, shuffle_buffer=5, uint8=True)
+    dataset.set_distributed(rank, world_size)
+    dataset.set_position(epoch, start_batch, batch_size)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                        persistent_workers=num_workers > 0)
+    return [[[int(l) for l in batch["class_label"]] for batch in loader] for _ in range(epochs)]
+
+
+def test_image_roundtrip(shard_dir):
+    example = next(iter(ShardedDataset(shard_dir, shuffle_buffer=1, uint8=True)))
+    expected = np.random.RandomState(example["class_label"]).randint(0, 256, (8, 8, 3)).astype(np.uint8)
+    assert (example["image"] == expected).all()
+
+
+@pytest.mark.parametrize("num_workers", [0, 2, 3])
+def test_ranks_get_whole_batches(shard_dir, num_workers):
+    batch_size = 4
+    per_rank = []
+    for rank in range(2):
+        epoch, = labels(shard_dir, rank, 2, batch_size, num_workers)
+        assert all(len(batch) == batch_size for batch in epoch[:-1])
+        per_rank.append([l for batch in epoch for l in batch])
+    assert len(per_rank[0]) == len(per_rank[1]) == 61 // 2
+
+
+@pytest.mark.parametrize("num_workers", [0, 2, 3])
+@pytest.mark.parametrize("start_batch", [0, 1, 4])
+def test_resume_matches_uninterrupted_run(shard_dir, num_workers, start_batch):
+    batch_size = 3
+    for rank in range(2):
+        uninterrupted = labels(shard_dir, rank, 2, batch_size, num_workers, epochs=2)
+        resumed = labels(shard_dir, rank, 2, batch_size, num_workers, start_batch=start_batch, epochs=2)
+        assert resumed[0] == uninterrupted[0][start_batch:]
+        assert resumed[1] == uninterrupted[1]
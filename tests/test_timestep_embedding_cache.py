@@ -0,0 +1,89 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from taming.modules.diffusionmodules.ddim import DDIMSampler
+from taming.modules.diffusionmodules.dpm_solver import DPMSolverSampler
+from taming.modules.diffusionmodules.openaimodel import UNetModel, ResBlock
+from taming.modules.diffusionmodules.util import make_beta_schedule
+
+
+class TinyDiffusion(nn.Module):
+    """the parts of a DDPM the samplers use, around a small UNet"""
+    def __init__(self, num_timesteps=100):
+        super().__init__()
+        torch.manual_seed(0)
+        self.model = nn.Module()
+        self.model.diffusion_model = UNetModel(image_size=16, in_channels=3, out_channels=3, model_channels=32,
+                                               attention_resolutions=[], num_res_blocks=1, channel_mult=[1, 2],
+                                               num_head_channels=8, context_dim=8)
+        self.num_timesteps = num_timesteps
+        self.parameterization = "eps"
+        betas = torch.as_tensor(make_beta_schedule("linear", num_timesteps, 1e-3, 2e-2))
+        alphas_cumprod = torch.cumprod(1. - betas, dim=0)
+        self.register_buffer("betas", betas.float())
+        self.register_buffer("alphas_cumprod", alphas_cumprod.float())
+        self.register_buffer("alphas_cumprod_prev", torch.cat([torch.ones(1), alphas_cumprod[:-1]]).float())
+
+    @property
+    def device(self):
+        return self.betas.device
+
+    def apply_model(self, x, t, cond):
+        return self.model.diffusion_model(x, t, context=cond)
+
+
+@pytest.fixture
+def model():
+    return TinyDiffusion().eval()
+
+
+def count_calls(module):
+    calls = []
+    module.register_forward_hook(lambda *args: calls.append(1))
+    return calls
+
+
+def sample(sampler, steps=8, **kwargs):
+    torch.manual_seed(1)
+    cond = torch.randn(2, 8, 8, 8)
+    x_T = torch.randn(2, 3, 16, 16)
+    return sampler.sample(steps, 2, (3, 16, 16), cond, x_T=x_T, verbose=False, **kwargs)[0]
+
+
+@pytest.mark.parametrize("make_sampler", [lambda m, **kw: DDIMSampler(m, **kw),
+                                          lambda m, **kw: DDIMSampler(m, fast_path=True, **kw),
+                                          lambda m, **kw: DPMSolverSampler(m, **kw)],
+                         ids=["ddim", "ddim_fast_path", "dpm_solver"])
+def test_cached_sampling_skips_embeddings(model, make_sampler):
+    unet = model.model.diffusion_model
+    reference = sample(make_sampler(model, cache_timestep_embedding=False))
+
+    time_embed_calls = count_calls(unet.time_embed)
+    emb_layers_calls = [count_calls(module.emb_layers) for module in unet.modules() if isinstance(module, ResBlock)]
+    sampler = make_sampler(model)
+    sample(sampler)  # builds the cache
+    time_embed_calls.clear()
+    for calls in emb_layers_calls:
+        calls.clear()
+
+    samples = sample(sampler)
+    assert len(time_embed_calls) == 0
+    assert all(len(calls) == 0 for calls in emb_layers_calls)
+    assert torch.allclose(samples, reference, atol=1e-5)
+
+
+def test_timesteps_outside_the_schedule_are_computed(model):
+    unet = model.model.diffusion_model
+    x, cond = torch.randn(2, 3, 16, 16), torch.randn(2, 8, 8, 8)
+    t, t_cached = torch.tensor([5, 5]), torch.tensor([20, 20])
+    with torch.no_grad():
+        reference = unet(x, t, context=cond)
+        reference_cached = unet(x, t_cached, context=cond)
+        with unet.cached_timestep_embedding([10, 20, 30]) as cache:
+            # no set_step and a timestep missing from the schedule both compute the embeddings
+            assert torch.allclose(unet(x, t, context=cond), reference, atol=1e-6)
+            cache.set_step(5)
+            assert torch.allclose(unet(x, t, context=cond), reference, atol=1e-6)
+            cache.set_step(20)
+            assert torch.allclose(unet(x, t_cached, context=cond), reference_cached, atol=1e-6)
@@ -0,0 +1,69 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from taming.data.token_archive import TokenArchive, TokenArchiveWriter, bits_per_token, pack_tokens, unpack_tokens
+
+
+@pytest.mark.parametrize("n_embed", [2, 3, 256, 1000, 8192, 16384])
+def test_pack_roundtrip(n_embed):
+    bits = bits_per_token(n_embed)
+    assert 2 ** bits >= n_embed and (bits == 1 or 2 ** (bits - 1) < n_embed)
+    indices = np.random.RandomState(0).randint(0, n_embed, 37)
+    indices[:2] = [0, n_embed - 1]
+    packed = pack_tokens(indices, bits)
+    assert packed.size == -(-37 * bits // 8)
+    assert np.array_equal(unpack_tokens(packed, bits, 37), indices)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = str(tmp_path / "tokens")
+    rng = np.random.RandomState(0)
+    grids = [rng.randint(0, 1000, (2, 4, 4)), rng.randint(0, 1000, (1, 3, 5))]
+    paths = ["a/0.png", "b/ünïcode.jpg", ""]
+    with TokenArchiveWriter(path, n_embed=1000) as writer:
+        writer.add(torch.from_numpy(grids[0]), file_path_=paths[:2], class_label=[4, 2])
+        writer.add(grids[1][0], file_path_=paths[2], class_label=7)
+    return path, [grids[0][0], grids[0][1], grids[1][0]], paths, [4, 2, 7]
+
+
+def test_archive_roundtrip(archive):
+    path, grids, paths, labels = archive
+    tokens = TokenArchive(path)
+    assert len(tokens) == 3 and tokens.bits == 10
+    for i in range(3):
+        example = tokens[i]
+        assert np.array_equal(example["tokens"], grids[i])
+        assert example["file_path_"] == paths[i]
+        assert example["class_label"] == labels[i]
+
+
+def test_string_labels_are_stored_as_bytes(archive):
+    path, _, paths, _ = archive
+    index = np.load(path + ".npz")
+    assert "label_file_path_" not in index.files
+    assert index["strlabel_data_file_path_"].dtype == np.uint8
+    assert index["strlabel_data_file_path_"].size == sum(len(p.encode("utf-8")) for p in paths)
+
+
+def test_archive_pickles_without_the_memmap(archive):
+    path, grids, _, _ = archive
+    tokens = TokenArchive(path)
+    tokens.get_tokens(0)
+    copy = pickle.loads(pickle.dumps(tokens))
+    assert copy._data is None
+    assert np.array_equal(copy.get_tokens(2), grids[2])
+
+
+def test_reads_unicode_label_arrays(archive):
+    # archives written before string labels were stored as bytes
+    path, _, paths, _ = archive
+    index = dict(np.load(path + ".npz"))
+    del index["strlabel_data_file_path_"], index["strlabel_offsets_file_path_"]
+    index["label_file_path_"] = np.asarray(paths)
+    np.savez(path + ".npz", **index)
+    tokens = TokenArchive(path)
+    assert [str(tokens[i]["file_path_"]) for i in range(3)] == paths